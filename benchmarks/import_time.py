@@ -0,0 +1,93 @@
+"""
+Бенчмарк холодного старта: время импорта модуля по python -X importtime в отдельном процессе.
+
+Запуск из корня репозитория:
+    python benchmarks/import_time.py                          # src.recognition, бюджет 5000 мс
+    python benchmarks/import_time.py --module src.utils --budget 8000 --forbid ""
+
+Скрипт печатает время импорта (медиану по --repeat запускам), самые дорогие пакеты и завершается с кодом 1,
+если время больше бюджета или импортирован один из запрещенных пакетов (по умолчанию - пакеты для обучения
+и графиков, которые не нужны процессам распознавания).
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_FORBIDDEN = 'matplotlib,timm,pandas,albumentations,comet_ml'
+
+
+def measure_import(module):
+    """
+    Импорт модуля в новом процессе с -X importtime.
+
+    Returns:
+    tuple: Общее время импорта модуля (мс) и словарь пакет верхнего уровня -> время импорта его модулей (мс).
+
+    """
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'import {module} failed:\n{result.stderr}')
+
+    packages, total = {}, 0
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        # собственное время всех модулей пакета, без вложенных импортов других пакетов
+        top_level = name.split('.')[0]
+        packages[top_level] = packages.get(top_level, 0) + int(self_us) / 1000
+        if name == module:
+            total = int(cumulative_us) / 1000
+    return total, packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time benchmark')
+    parser.add_argument('--module', default='src.recognition', help='Модуль, импорт которого измеряется')
+    parser.add_argument('--budget', type=float, default=5000, help='Бюджет времени импорта, мс')
+    parser.add_argument('--repeat', type=int, default=5, help='Количество запусков, берется медиана')
+    parser.add_argument('--forbid', default=DEFAULT_FORBIDDEN, help='Пакеты через запятую, которые нельзя импортировать')
+    parser.add_argument('--top', type=int, default=10, help='Сколько самых дорогих пакетов показать')
+    parser.add_argument('--json', action='store_true', help='Вывести результат в формате json')
+    args = parser.parse_args()
+
+    runs = [measure_import(args.module) for _ in range(args.repeat)]
+    total = statistics.median(run[0] for run in runs)
+    imported = set().union(*(run[1] for run in runs))
+    heaviest = sorted(runs[-1][1].items(), key=lambda item: -item[1])[:args.top]
+
+    forbidden = sorted(imported & {name for name in args.forbid.split(',') if name})
+    report = {
+        'module': args.module,
+        'import_ms': round(total, 1),
+        'budget_ms': args.budget,
+        'forbidden_imported': forbidden,
+        'heaviest_ms': {name: round(ms, 1) for name, ms in heaviest},
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"import {args.module}: {report['import_ms']} ms (budget {args.budget} ms)")
+        for name, ms in heaviest:
+            print(f'    {name:<24}{ms:10.1f} ms')
+        if forbidden:
+            print('forbidden packages imported:', ', '.join(forbidden))
+
+    if total > args.budget or forbidden:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+"""
+Набор бенчмарков скорости на синтетических данных (benchmarks/synthetic_data.py), все на CPU:
+- datasets: задержка __getitem__ одного примера для каждого класса датасета;
+- dataloaders: батчей в секунду у даталоадеров детекции и распознавания с настройками из config.yaml;
+- models: задержка forward InspectorGadjet, VGG4, GoogLeNet и efficientnet_b1 при разных размерах батча;
+- gallery: время поиска по базе данных людей (EmbeddingIndex) в зависимости от ее размера;
+- recognition: кадров в секунду у цикла распознавания (recognize_frame), который читает кадры из видео.
+
+Запуск из корня репозитория:
+    python benchmarks/run_benchmarks.py                               # все секции, сравнение с baseline.json
+    python benchmarks/run_benchmarks.py --quick --only models,gallery
+    python benchmarks/run_benchmarks.py --save-baseline               # записать текущие результаты как baseline
+
+Результаты пишутся в json (--output), каждая метрика - значение, единица и направление (lower/higher is better).
+Если есть baseline, метрики, ухудшившиеся больше чем на --tolerance, печатаются и скрипт завершается с кодом 1.
+Baseline имеет смысл только для той же машины, количества потоков и режима (--quick или нет).
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import synthetic_data
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+SECTIONS = ['datasets', 'dataloaders', 'models', 'gallery', 'recognition']
+
+# размеры данных и количество повторов: полный режим и --quick
+SETTINGS = {
+    'full': {'images': 200, 'people': 50, 'triplets': 400, 'frames': 60, 'samples': 100, 'batches': 20,
+             'batch_sizes': [1, 8, 32], 'repeat': 10, 'gallery_sizes': [1000, 10000, 100000], 'queries': 200,
+             'max_seconds': 10},
+    'quick': {'images': 40, 'people': 20, 'triplets': 100, 'frames': 20, 'samples': 20, 'batches': 4,
+              'batch_sizes': [1, 8], 'repeat': 3, 'gallery_sizes': [1000, 10000], 'queries': 50,
+              'max_seconds': 3},
+}
+
+
+def metric(value, unit, better='lower'):
+    return {'value': round(float(value), 4), 'unit': unit, 'better': better}
+
+
+def time_ms(fn, repeat, warmup=1, max_seconds=None):
+    """
+    Медиана времени вызова fn() в миллисекундах после warmup вызовов.
+    Если задан max_seconds, повторы прекращаются, когда измерение длится дольше (но хотя бы один повтор будет).
+
+    """
+
+    for _ in range(warmup):
+        fn()
+    times = []
+    deadline = time.perf_counter() + max_seconds if max_seconds else None
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started_at) * 1000)
+        if deadline and time.perf_counter() > deadline:
+            break
+    return statistics.median(times)
+
+
+def bench_datasets(settings):
+    from src import dataloaders
+
+    transform, transform_faces = dataloaders.transform, dataloaders.transform_faces
+    ten_thousand = dataloaders.TenThousandFaceDataSet(
+        dataloaders.csv_file_path_for_ten_thousand_dataset, dataloaders.image_dir_for_ten_thousand_dataset,
+        transform, transform_faces)
+    datasets = {
+        'TenThousandFaceDataSet': ten_thousand,
+        'ThreeThousandFaceDataSet': dataloaders.ThreeThousandFaceDataSet(
+            dataloaders.image_path, dataloaders.get_y_labels(), transform, transform_faces),
+        'BackgroundDataset': dataloaders.BackgroundDataset(dataloaders.backg_image_path, transform),
+        'CachedDetectionDataset': dataloaders.build_detection_cache(ten_thousand, 'cache/ten_thousand'),
+        # без кэша каждое изображение декодируется заново, с кэшем (build_image_cache) - читается из mmap
+        'CelebATriplets_cold': dataloaders.CelebATriplets(dataloaders.celeb_images, dataloaders.celeb_triplets_csv),
+        'CelebATriplets_warm': dataloaders.get_celeba_dataset(),
+    }
+    datasets['CelebAIdentities'] = dataloaders.CelebAIdentities(datasets['CelebATriplets_warm'])
+
+    results = {}
+    for name, dataset in datasets.items():
+        indices = range(min(settings['samples'], len(dataset)))
+        # первый проход (прогрев) заполняет кэш файлов ОС
+        ms = time_ms(lambda: [dataset[i] for i in indices], settings['repeat'])
+        results[f'datasets.{name}.getitem_ms'] = metric(ms / len(indices), 'ms')
+    return results
+
+
+def _batches_per_sec(loader, n_batches):
+    # первый батч не считается: в него входит запуск worker процессов
+    batches = iter(loader)
+    next(batches)
+    started_at, n_done = time.perf_counter(), 0
+    for _ in range(n_batches):
+        if next(batches, None) is None:
+            break
+        n_done += 1
+    elapsed = time.perf_counter() - started_at
+    del batches
+    return n_done / elapsed if elapsed > 0 else 0.0
+
+
+def bench_dataloaders(settings):
+    from src import dataloaders
+
+    train_detection, _ = dataloaders.get_detection_dataloaders()
+    multi_face_train, _ = dataloaders.get_multi_face_train_test_dataloaders(0.1)
+    loaders = {
+        'detection': train_detection,
+        'multi_face_detection': multi_face_train,
+        'recognition': dataloaders.get_recognition_dataloader(),
+        'pk_recognition': dataloaders.get_pk_recognition_dataloader(k=2),
+    }
+    return {f'dataloaders.{name}.batches_per_sec': metric(_batches_per_sec(loader, settings['batches']),
+                                                          'batches/s', 'higher')
+            for name, loader in loaders.items()}
+
+
+def _recognition_encoder():
+    # энкодер распознавания как в get_models_with_weights, без загрузки весов
+    import timm
+    import torch.nn as nn
+
+    encoder = timm.create_model('efficientnet_b1', pretrained=False)
+    encoder.classifier = nn.Linear(encoder.classifier.in_features, 512)
+    return encoder
+
+
+def bench_models(settings, config):
+    import torch
+    from src import models
+
+    img_size = config['img_size']
+    # модель, размер входа и наибольший размер батча: GoogLeNet считает первые слои в полном разрешении,
+    # и на CPU один батч из 32 изображений идет около минуты
+    candidates = {
+        'InspectorGadjet': (models.InspectorGadjet, img_size, None),
+        'VGG4': (lambda: models.VGG4(5, img_size), img_size, None),
+        'GoogLeNet': (lambda: models.GoogLeNet(512), config['img_size_recog'], 8),
+        'efficientnet_b1': (_recognition_encoder, 160, None),
+    }
+
+    results = {}
+    for name, (build, size, max_batch_size) in candidates.items():
+        model = build().eval()
+        for batch_size in settings['batch_sizes']:
+            if max_batch_size and batch_size > max_batch_size:
+                continue
+            x = torch.rand(batch_size, 3, size, size)
+            with torch.inference_mode():
+                ms = time_ms(lambda: model(x), settings['repeat'], max_seconds=settings['max_seconds'])
+            results[f'models.{name}.bs{batch_size}.forward_ms'] = metric(ms, 'ms')
+    return results
+
+
+def bench_gallery(settings):
+    from src.gallery import GalleryStore, load_index
+
+    rng = np.random.default_rng(0)
+    results = {}
+    for size in settings['gallery_sizes']:
+        path = f'gallery_{size}'
+        synthetic_data.make_gallery(path, size, rng)
+
+        # GalleryStore напрямую: load_index берет хранилище из кэша open_store и не читает файлы
+        load = time_ms(lambda: GalleryStore(path).to_index(), settings['repeat'])
+        results[f'gallery.{size}.load_ms'] = metric(load, 'ms')
+        index = load_index(path)
+
+        queries = rng.standard_normal((settings['queries'], index.dim), np.float32)
+        # один запрос (одно лицо на кадре) и батч запросов (все лица кадра или офлайн обработка)
+        single = time_ms(lambda: [index.search(query) for query in queries], 1) / len(queries)
+        batch = time_ms(lambda: index.search(queries), settings['repeat'])
+        results[f'gallery.{size}.search_single_ms'] = metric(single, 'ms')
+        results[f'gallery.{size}.search_batch{len(queries)}_ms'] = metric(batch, 'ms')
+    return results
+
+
+def bench_recognition(settings, config):
+    import cv2
+    import torch
+    from src import models
+    from src.gallery import load_index
+    from src.recognition import recognize_frame
+
+    torch.manual_seed(0)
+    det_model = models.InspectorGadjet().eval()
+    embedding_model = _recognition_encoder().eval()
+    synthetic_data.make_gallery('gallery', 1000, np.random.default_rng(0))
+    index = load_index('gallery')
+
+    cap = cv2.VideoCapture('video.avi')
+    frames = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+
+    # det_threshold=-inf: у случайных весов уверенность любая, а нужно, чтобы каждый кадр проходил весь путь
+    # детекция -> вырезание лица -> эмбеддинг -> поиск
+    recognize_frame(frames[0], det_model, embedding_model, index, det_threshold=-float('inf'))
+
+    started_at = time.perf_counter()
+    cap = cv2.VideoCapture('video.avi')
+    n_frames = 0
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        recognize_frame(frame, det_model, embedding_model, index, det_threshold=-float('inf'))
+        n_frames += 1
+    cap.release()
+    fps = n_frames / (time.perf_counter() - started_at)
+
+    return {'recognition.video.fps': metric(fps, 'frames/s', 'higher'),
+            'recognition.video.frame_ms': metric(1000 / fps, 'ms')}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Сравнение результатов с baseline.
+
+    Returns:
+    list: Строки (имя, baseline, текущее значение, изменение в процентах, регрессия ли это).
+
+    """
+
+    rows = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None or previous['value'] == 0:
+            continue
+        change = current['value'] / previous['value'] - 1
+        worse = change > tolerance if current['better'] == 'lower' else change < -tolerance
+        rows.append((name, previous['value'], current['value'], change * 100, worse))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Speed benchmarks on synthetic data')
+    parser.add_argument('--quick', action='store_true', help='Меньше данных и повторов (для быстрой проверки)')
+    parser.add_argument('--only', default=','.join(SECTIONS), help='Секции через запятую: ' + ', '.join(SECTIONS))
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'face_id_benchmarks'),
+                        help='Папка для синтетических данных, переиспользуется между запусками')
+    parser.add_argument('--output', default='benchmark_results.json', help='Файл для результатов')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Результаты, с которыми сравнивать')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Допустимое ухудшение, доля')
+    parser.add_argument('--save-baseline', action='store_true', help='Записать результаты в --baseline')
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads, по умолчанию как есть')
+    parser.add_argument('--num-workers', type=int, default=2, help='num_workers даталоадеров')
+    args = parser.parse_args()
+
+    mode = 'quick' if args.quick else 'full'
+    settings = SETTINGS[mode]
+    sections = [name for name in args.only.split(',') if name]
+    unknown = set(sections) - set(SECTIONS)
+    if unknown:
+        parser.error(f'unknown sections: {", ".join(sorted(unknown))}')
+
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline)
+
+    # src читает config.yaml и данные по относительным путям, поэтому работаем из папки с синтетическими данными
+    workdir = os.path.join(args.workdir, mode)
+    config = synthetic_data.make_workspace(
+        workdir, settings['images'], settings['people'], settings['triplets'], settings['frames'],
+        config_overrides={'dataloader': {'num_workers': args.num_workers, 'seed': 0}})
+    sys.path.insert(0, ROOT)
+    os.chdir(workdir)
+
+    import torch
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    results = {}
+    for section in sections:
+        started_at = time.perf_counter()
+        if section == 'datasets':
+            results.update(bench_datasets(settings))
+        elif section == 'dataloaders':
+            results.update(bench_dataloaders(settings))
+        elif section == 'models':
+            results.update(bench_models(settings, config))
+        elif section == 'gallery':
+            results.update(bench_gallery(settings))
+        elif section == 'recognition':
+            results.update(bench_recognition(settings, config))
+        print(f'{section}: done in {time.perf_counter() - started_at:.1f} s', file=sys.stderr)
+
+    report = {
+        'meta': {
+            'mode': mode,
+            'torch': torch.__version__,
+            'threads': torch.get_num_threads(),
+            'num_workers': args.num_workers,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+
+    for name, current in results.items():
+        print(f"{name:<55}{current['value']:12.3f} {current['unit']}")
+    print('results written to', output)
+
+    if args.save_baseline:
+        with open(baseline_path, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        print('baseline written to', baseline_path)
+        return
+
+    if not os.path.exists(baseline_path):
+        print('no baseline to compare with, use --save-baseline')
+        return
+
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline['meta']['mode'] != mode or baseline['meta']['threads'] != report['meta']['threads']:
+        print(f"warning: baseline was measured with mode={baseline['meta']['mode']}, "
+              f"threads={baseline['meta']['threads']}")
+
+    rows = compare(results, baseline['results'], args.tolerance)
+    regressions = [row for row in rows if row[4]]
+    print(f'\ncompared with {baseline_path} ({baseline["meta"]["timestamp"]}), tolerance {args.tolerance:.0%}')
+    for name, previous, current, change, worse in rows:
+        print(f"{'REGRESSION ' if worse else '           '}{name:<55}{previous:12.3f} -> {current:12.3f} "
+              f"({change:+.1f}%)")
+
+    if regressions:
+        print(f'{len(regressions)} regressions')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
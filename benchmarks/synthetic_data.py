@@ -0,0 +1,227 @@
+"""
+Синтетические данные для бенчмарков: та же структура папок data/, что у датасетов с kaggle, config.yaml,
+база данных людей (GalleryStore) и видео для цикла распознавания. Все создается локально, без скачивания.
+
+Запуск из корня репозитория (обычно вызывается из benchmarks/run_benchmarks.py):
+    python benchmarks/synthetic_data.py --workdir /tmp/face_bench
+"""
+
+import argparse
+import os
+import shutil
+import sys
+
+import cv2
+import numpy as np
+import pandas as pd
+import yaml
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ROOM_TYPES = ['Bathroom', 'Bedroom', 'Dinning', 'Kitchen', 'Livingroom']
+
+# пути внутри рабочей папки, как в src/dataloaders.py
+TEN_THOUSAND_DIR = 'data/face-detection-dataset'
+THREE_THOUSAND_DIR = 'data/human-faces-object-detection'
+BACKGROUNDS_DIR = 'data/house-rooms-image-dataset/House_Room_Dataset'
+CELEBA_DIR = 'data/celeba-face-recognition-triplets/CelebA FR Triplets/CelebA FR Triplets'
+
+
+def random_image(rng, height, width, faces=()):
+    """
+    Изображение BGR uint8 с шумом и эллипсами "лиц" в рамках faces, чтобы JPEG был похож по размеру на фото.
+
+    """
+
+    img = rng.integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+    img = cv2.resize(img, (width, height), interpolation=cv2.INTER_LINEAR)
+    for x1, y1, x2, y2 in faces:
+        center = ((x1 + x2) // 2, (y1 + y2) // 2)
+        axes = (max(1, (x2 - x1) // 2), max(1, (y2 - y1) // 2))
+        cv2.ellipse(img, center, axes, 0, 0, 360, (90, 140, 200), -1)
+    return img
+
+
+def random_boxes(rng, height, width, n_faces):
+    boxes = []
+    for _ in range(n_faces):
+        w = int(rng.integers(width // 8, width // 3))
+        h = int(rng.integers(height // 8, height // 3))
+        x1, y1 = int(rng.integers(0, width - w)), int(rng.integers(0, height - h))
+        boxes.append((x1, y1, x1 + w, y1 + h))
+    return boxes
+
+
+def write_config(workdir, overrides=None):
+    # config.yaml репозитория с путями внутри рабочей папки и переопределенными ключами
+    with open(os.path.join(ROOT, 'config.yaml')) as config_file:
+        config = yaml.safe_load(config_file)
+
+    config.update({'use_colab': False, 'detection_cache_dir': '', 'teacher_cache_dir': '',
+                   'gpu_augmentation': False, 'path_to_gallery': 'gallery'})
+    for key, value in (overrides or {}).items():
+        if isinstance(value, dict):
+            config[key] = {**config.get(key, {}), **value}
+        else:
+            config[key] = value
+
+    with open(os.path.join(workdir, 'config.yaml'), 'w') as config_file:
+        yaml.safe_dump(config, config_file, allow_unicode=True, sort_keys=False)
+    return config
+
+
+def make_detection_data(workdir, rng, n_images=200, size=(480, 640), max_faces=3):
+    """
+    Датасеты детекции: 10к (csv с одной и со всеми рамками), 3к (faces.csv) и фоны комнат.
+
+    """
+
+    height, width = size
+
+    # датасет 10к: имена без расширения, несколько строк на изображение с несколькими лицами
+    images_dir = os.path.join(workdir, TEN_THOUSAND_DIR, 'images')
+    os.makedirs(images_dir, exist_ok=True)
+    rows = []
+    for i in range(n_images):
+        boxes = random_boxes(rng, height, width, int(rng.integers(1, max_faces + 1)))
+        # имя не должно читаться pandas как число, иначе '00001' превратится в 1
+        cv2.imwrite(os.path.join(images_dir, f'face_{i:05d}.jpg'), random_image(rng, height, width, boxes))
+        rows += [(f'face_{i:05d}', *box) for box in boxes]
+    all_faces = pd.DataFrame(rows, columns=['name', 'x1', 'y1', 'x2', 'y2'])
+    all_faces.to_csv(os.path.join(workdir, TEN_THOUSAND_DIR, 'labels_and_coordinates_all.csv'), index=False)
+    all_faces.drop_duplicates('name').to_csv(
+        os.path.join(workdir, TEN_THOUSAND_DIR, 'labels_and_coordinates.csv'), index=False)
+
+    # датасет 3к
+    images_dir = os.path.join(workdir, THREE_THOUSAND_DIR, 'images')
+    os.makedirs(images_dir, exist_ok=True)
+    rows = []
+    for i in range(n_images):
+        boxes = random_boxes(rng, height, width, int(rng.integers(1, max_faces + 1)))
+        cv2.imwrite(os.path.join(images_dir, f'{i:05d}.jpg'), random_image(rng, height, width, boxes))
+        rows += [(f'{i:05d}.jpg', width, height, *box) for box in boxes]
+    pd.DataFrame(rows, columns=['image_name', 'width', 'height', 'x0', 'y0', 'x1', 'y1']).to_csv(
+        os.path.join(workdir, THREE_THOUSAND_DIR, 'faces.csv'), index=False)
+
+    # фоны без лиц
+    for i in range(n_images):
+        room_dir = os.path.join(workdir, BACKGROUNDS_DIR, ROOM_TYPES[i % len(ROOM_TYPES)])
+        os.makedirs(room_dir, exist_ok=True)
+        cv2.imwrite(os.path.join(room_dir, f'{i:05d}.jpg'), random_image(rng, height, width))
+
+
+def make_celeba_data(workdir, rng, n_people=50, photos_per_person=4, n_triplets=400, size=(218, 178)):
+    """
+    Изображения CelebA (имена вида <личность>_<номер>.jpg) и triplets.csv с колонками anchor, pos, neg.
+
+    """
+
+    height, width = size
+    images_dir = os.path.join(workdir, CELEBA_DIR, 'images')
+    os.makedirs(images_dir, exist_ok=True)
+
+    face = [(width // 4, height // 4, 3 * width // 4, 3 * height // 4)]
+    for person in range(n_people):
+        for photo in range(photos_per_person):
+            cv2.imwrite(os.path.join(images_dir, f'{person}_{photo}.jpg'), random_image(rng, height, width, face))
+
+    rows = []
+    for _ in range(n_triplets):
+        person, other = rng.choice(n_people, 2, replace=False)
+        anchor, pos = rng.choice(photos_per_person, 2, replace=False)
+        neg = rng.integers(photos_per_person)
+        rows.append((f'{person}_{anchor}.jpg', f'{person}_{pos}.jpg', f'{other}_{neg}.jpg'))
+    pd.DataFrame(rows, columns=['anchor', 'pos', 'neg']).to_csv(
+        os.path.join(workdir, CELEBA_DIR, 'triplets.csv'), index=False)
+
+
+def make_gallery(path, n_people, rng, dim=512):
+    """
+    База данных людей GalleryStore из n_people случайных эмбеддингов (один снимок .npy, без журнала).
+
+    """
+
+    from src.gallery import GalleryStore
+
+    if os.path.isdir(path):
+        store = GalleryStore(path, dim=dim, compact_every=None)
+        if len(store) == n_people:
+            return store
+        shutil.rmtree(path)
+
+    store = GalleryStore(path, dim=dim, compact_every=None)
+    store.add_many([f'person_{i}' for i in range(n_people)], rng.standard_normal((n_people, dim), np.float32))
+    store.compact()
+    return store
+
+
+def make_video(path, rng, n_frames=60, size=(480, 640), fps=25):
+    """
+    Видео MJPG с движущимся "лицом" для цикла распознавания.
+
+    """
+
+    height, width = size
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f'cv2 cannot write video {path}')
+
+    background = random_image(rng, height, width)
+    for i in range(n_frames):
+        frame = background.copy()
+        x = int((width - 200) * i / max(1, n_frames - 1))
+        cv2.ellipse(frame, (x + 100, height // 2), (70, 95), 0, 0, 360, (90, 140, 200), -1)
+        writer.write(frame)
+    writer.release()
+
+
+def make_workspace(workdir, n_images=200, n_people=50, n_triplets=400, n_frames=60, config_overrides=None, seed=0):
+    """
+    Рабочая папка бенчмарков: config.yaml, data/ со всеми датасетами и video.avi.
+    Данные создаются один раз, повторный вызов с теми же размерами только переписывает config.yaml.
+
+    Parameters:
+    - workdir (str): Рабочая папка.
+    - n_images (int): Количество изображений в каждом датасете детекции.
+    - n_people (int): Количество личностей CelebA (по 4 фото).
+    - n_triplets (int): Количество триплетов.
+    - n_frames (int): Количество кадров видео.
+    - config_overrides (dict): Ключи config.yaml, которые нужно переопределить.
+    - seed (int): Зерно генератора.
+
+    Returns:
+    dict: Прочитанный config.yaml рабочей папки.
+
+    """
+
+    os.makedirs(workdir, exist_ok=True)
+    config = write_config(workdir, config_overrides)
+
+    marker = os.path.join(workdir, 'data', f'.done_{n_images}_{n_people}_{n_triplets}_{n_frames}_{seed}')
+    if not os.path.exists(marker):
+        rng = np.random.default_rng(seed)
+        make_detection_data(workdir, rng, n_images)
+        make_celeba_data(workdir, rng, n_people, n_triplets=n_triplets)
+        make_video(os.path.join(workdir, 'video.avi'), rng, n_frames)
+        open(marker, 'w').close()
+
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic data for benchmarks')
+    parser.add_argument('--workdir', required=True, help='Папка, в которой создаются данные')
+    parser.add_argument('--images', type=int, default=200, help='Изображений в каждом датасете детекции')
+    parser.add_argument('--people', type=int, default=50, help='Личностей CelebA')
+    parser.add_argument('--triplets', type=int, default=400, help='Триплетов CelebA')
+    parser.add_argument('--frames', type=int, default=60, help='Кадров видео')
+    args = parser.parse_args()
+
+    make_workspace(args.workdir, args.images, args.people, args.triplets, args.frames)
+    print('synthetic data written to', os.path.abspath(args.workdir))
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, ROOT)
+    main()
@@ -0,0 +1,418 @@
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from src.gallery import UNKNOWN, l2_normalize
+
+
+def kmeans(x, n_clusters, n_iter=20, seed=0, chunk_size=65536):
+    """
+    Кластеризация k-means (алгоритм Ллойда) на torch.
+
+    Parameters:
+    - x (np.ndarray): Матрица векторов формы (N, D).
+    - n_clusters (int): Количество кластеров.
+    - n_iter (int): Количество итераций.
+    - seed (int): Зерно генератора для выбора начальных центроидов.
+    - chunk_size (int): Сколько векторов назначать кластерам за один раз, чтобы не держать матрицу N x K целиком.
+
+    Returns:
+    np.ndarray: Центроиды формы (n_clusters, D).
+
+    """
+
+    x = torch.from_numpy(np.ascontiguousarray(x, dtype=np.float32))
+    generator = torch.Generator().manual_seed(seed)
+    centroids = x[torch.randperm(x.shape[0], generator=generator)[:n_clusters]].clone()
+
+    for _ in range(n_iter):
+        assignment = _assign(x, centroids, chunk_size)
+
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, x)
+        counts = torch.bincount(assignment, minlength=n_clusters).to(x.dtype)
+
+        # пустые кластеры переинициализируем случайными точками
+        empty = counts == 0
+        if empty.any():
+            refill = torch.randint(0, x.shape[0], (int(empty.sum()),), generator=generator)
+            sums[empty] = x[refill]
+            counts[empty] = 1
+
+        centroids = sums / counts[:, None]
+
+    return centroids.numpy()
+
+
+def _assign(x, centroids, chunk_size=65536):
+    # номер ближайшего центроида для каждого вектора (квадрат евклидова расстояния)
+    centroids_norm = (centroids ** 2).sum(dim=1)
+    result = []
+    for start in range(0, x.shape[0], chunk_size):
+        chunk = x[start:start + chunk_size]
+        distances = centroids_norm[None, :] - 2 * chunk @ centroids.T
+        result.append(distances.argmin(dim=1))
+    return torch.cat(result) if result else torch.empty(0, dtype=torch.long)
+
+
+class ProductQuantizer:
+
+    '''
+    Product quantization: вектор размера D делится на m подвекторов, каждый кодируется
+    номером ближайшего центроида из своего словаря на 256 слов, то есть одним байтом.
+
+    dim - размер вектора
+    m - количество подвекторов, dim должен делиться на m
+    '''
+
+    def __init__(self, dim, m=64):
+        if dim % m != 0:
+            raise ValueError(f'dim={dim} must be divisible by m={m}')
+        self.dim = dim
+        self.m = m
+        self.sub_dim = dim // m
+        self.codebooks = None  # (m, 256, sub_dim)
+
+    def train(self, x, n_iter=20, seed=0):
+        x = np.asarray(x, dtype=np.float32).reshape(-1, self.m, self.sub_dim)
+        n_codes = min(256, x.shape[0])
+        self.codebooks = np.stack([kmeans(x[:, j], n_codes, n_iter=n_iter, seed=seed + j)
+                                   for j in range(self.m)])
+        return self
+
+    def encode(self, x):
+        x = torch.from_numpy(np.ascontiguousarray(x, dtype=np.float32).reshape(-1, self.m, self.sub_dim))
+        codebooks = torch.from_numpy(self.codebooks)
+        codes = np.empty((x.shape[0], self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = _assign(x[:, j], codebooks[j]).numpy()
+        return codes
+
+    def inner_product_table(self, query):
+        # таблица скалярных произведений подвекторов запроса со всеми словами словарей, (m, 256)
+        query = query.reshape(self.m, 1, self.sub_dim)
+        return (self.codebooks * query).sum(axis=2)
+
+
+class IVFIndex:
+
+    '''
+    Приближенный поиск ближайших соседей (inverted file index) для больших баз данных людей.
+
+    Векторы делятся на n_lists кластеров k-means, при поиске просматриваются только nprobe
+    ближайших к запросу кластеров. Если задан pq_m, то внутри кластеров хранятся не сами векторы,
+    а коды product quantization их остатков относительно центроида (IVF-PQ), 1 байт на подвектор.
+
+    Интерфейс search совпадает с EmbeddingIndex, поэтому индекс можно передать в recognition_cam.
+
+    n_lists - количество кластеров
+    nprobe - количество просматриваемых кластеров при поиске, баланс скорости и полноты
+    pq_m - количество подвекторов для product quantization, None - хранить векторы целиком
+    '''
+
+    def __init__(self, dim=512, n_lists=1024, nprobe=8, pq_m=None):
+        self.dim = dim
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.pq = ProductQuantizer(dim, pq_m) if pq_m else None
+
+        self.centroids = None
+        self.list_ids = [np.empty(0, dtype=np.int64) for _ in range(n_lists)]
+        self.list_data = [self._empty_data() for _ in range(n_lists)]
+
+        # id -> (имя, номер кластера)
+        self.entries = {}
+
+    def _empty_data(self):
+        if self.pq is not None:
+            return np.empty((0, self.pq.m), dtype=np.uint8)
+        return np.empty((0, self.dim), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, embeddings, n_iter=20, max_train_size=None, seed=0):
+        """
+        Обучение центроидов кластеров (и словарей PQ) на выборке эмбеддингов.
+
+        Parameters:
+        - embeddings (np.ndarray): Эмбеддинги формы (N, D).
+        - n_iter (int): Количество итераций k-means.
+        - max_train_size (int): Максимальный размер обучающей выборки, по умолчанию 256 * n_lists.
+        - seed (int): Зерно генератора.
+
+        """
+
+        embeddings = l2_normalize(embeddings)
+        max_train_size = max_train_size or 256 * self.n_lists
+        if embeddings.shape[0] > max_train_size:
+            rows = np.random.default_rng(seed).choice(embeddings.shape[0], max_train_size, replace=False)
+            embeddings = embeddings[np.sort(rows)]
+
+        if embeddings.shape[0] < self.n_lists:
+            raise ValueError(f'need at least n_lists={self.n_lists} embeddings to train, got {embeddings.shape[0]}')
+
+        self.centroids = kmeans(embeddings, self.n_lists, n_iter=n_iter, seed=seed)
+
+        if self.pq is not None:
+            assignment = _assign(torch.from_numpy(embeddings), torch.from_numpy(self.centroids)).numpy()
+            self.pq.train(embeddings - self.centroids[assignment], n_iter=n_iter, seed=seed)
+
+        return self
+
+    def add(self, embeddings, names, ids):
+        """
+        Добавление людей в индекс.
+
+        Parameters:
+        - embeddings (np.ndarray): Эмбеддинги формы (N, D).
+        - names (list): Имена людей.
+        - ids (list): Уникальные id людей (те же, что в GalleryStore), нужны для удаления.
+
+        """
+
+        if not self.is_trained:
+            raise RuntimeError('IVFIndex must be trained before add')
+
+        embeddings = l2_normalize(np.asarray(embeddings).reshape(-1, self.dim))
+        ids = np.asarray(ids, dtype=np.int64)
+        assignment = _assign(torch.from_numpy(embeddings), torch.from_numpy(self.centroids)).numpy()
+
+        if self.pq is not None:
+            data = self.pq.encode(embeddings - self.centroids[assignment])
+        else:
+            data = embeddings
+
+        for list_id in np.unique(assignment):
+            rows = assignment == list_id
+            self.list_ids[list_id] = np.concatenate([self.list_ids[list_id], ids[rows]])
+            self.list_data[list_id] = np.concatenate([self.list_data[list_id], data[rows]])
+
+        for person_id, name, list_id in zip(ids.tolist(), names, assignment.tolist()):
+            self.entries[person_id] = (name, list_id)
+
+    def remove(self, ids):
+        """
+        Удаление людей из индекса по id.
+
+        Parameters:
+        - ids (list): id людей для удаления, неизвестные id пропускаются.
+
+        """
+
+        by_list = {}
+        for person_id in ids:
+            entry = self.entries.pop(person_id, None)
+            if entry is not None:
+                by_list.setdefault(entry[1], []).append(person_id)
+
+        for list_id, removed in by_list.items():
+            keep = ~np.isin(self.list_ids[list_id], removed)
+            self.list_ids[list_id] = self.list_ids[list_id][keep]
+            self.list_data[list_id] = self.list_data[list_id][keep]
+
+    def search(self, embeddings, k=1, threshold=1.2, nprobe=None, return_ids=False):
+        """
+        Приближенный поиск k ближайших людей для батча эмбеддингов.
+
+        Parameters:
+        - embeddings (torch.Tensor | np.ndarray): Эмбеддинги лиц формы (B, D) или (D,).
+        - k (int): Количество ближайших людей для каждого запроса.
+        - threshold (float): Если расстояние больше порога, вместо имени возвращается 'unknown'.
+        - nprobe (int): Количество просматриваемых кластеров, по умолчанию self.nprobe.
+        - return_ids (bool): Вернуть еще и id найденных людей, как в EmbeddingIndex.search.
+
+        Returns:
+        tuple: Массив имен формы (B, k) и массив расстояний float32 формы (B, k), при return_ids - еще массив id.
+        Если кандидатов меньше k, недостающие места заполняются 'unknown', inf и id -1.
+
+        """
+
+        if isinstance(embeddings, torch.Tensor):
+            embeddings = embeddings.detach().to('cpu', torch.float32).numpy()
+        queries = l2_normalize(np.asarray(embeddings).reshape(-1, self.dim))
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+
+        names = np.full((queries.shape[0], k), UNKNOWN, dtype=object)
+        distances = np.full((queries.shape[0], k), np.inf, dtype=np.float32)
+        found_ids = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        if not self.is_trained or len(self) == 0:
+            return (names, distances, found_ids) if return_ids else (names, distances)
+
+        # центроиды не нормализованы, поэтому кластеры выбираем по евклидову расстоянию
+        centroid_similarity = queries @ self.centroids.T
+        centroid_distances = (self.centroids ** 2).sum(axis=1)[None, :] - 2 * centroid_similarity
+        probes = np.argpartition(centroid_distances, nprobe - 1, axis=1)[:, :nprobe]
+
+        for i, query in enumerate(queries):
+            if self.pq is not None:
+                table = self.pq.inner_product_table(query)
+                columns = np.arange(self.pq.m)
+
+            candidate_ids, similarity = [], []
+            for list_id in probes[i]:
+                if self.list_ids[list_id].shape[0] == 0:
+                    continue
+                candidate_ids.append(self.list_ids[list_id])
+                if self.pq is not None:
+                    # q . (c + r) = q . c + сумма по подвекторам из таблицы
+                    codes = self.list_data[list_id]
+                    similarity.append(centroid_similarity[i, list_id] + table[columns, codes].sum(axis=1))
+                else:
+                    similarity.append(self.list_data[list_id] @ query)
+
+            if not candidate_ids:
+                continue
+
+            candidate_ids = np.concatenate(candidate_ids)
+            candidate_distances = np.maximum(2 - 2 * np.concatenate(similarity), 0)
+
+            top = min(k, candidate_ids.shape[0])
+            best = np.argpartition(candidate_distances, top - 1)[:top]
+            best = best[np.argsort(candidate_distances[best])]
+
+            distances[i, :top] = candidate_distances[best]
+            found_ids[i, :top] = candidate_ids[best]
+            names[i, :top] = [self.entries[person_id][0] for person_id in candidate_ids[best].tolist()]
+
+        names[distances > threshold] = UNKNOWN
+        return (names, distances, found_ids) if return_ids else (names, distances)
+
+    def sync(self, store):
+        """
+        Синхронизация индекса с хранилищем GalleryStore: добавляются новые люди и удаляются отсутствующие.
+
+        Parameters:
+        - store (GalleryStore): Хранилище базы данных людей.
+
+        """
+
+        store_ids = store.ids
+        stale = set(self.entries) - set(store_ids)
+        self.remove(list(stale))
+
+        missing = [row for row, person_id in enumerate(store_ids) if person_id not in self.entries]
+        if missing:
+            names = store.names
+            self.add(store.embeddings()[missing], [names[row] for row in missing],
+                     [store_ids[row] for row in missing])
+
+    @classmethod
+    def from_store(cls, store, n_lists=None, nprobe=8, pq_m=None, n_iter=20):
+        """
+        Обучение индекса на всех людях из хранилища GalleryStore и их добавление.
+
+        Parameters:
+        - store (GalleryStore): Хранилище базы данных людей.
+        - n_lists (int): Количество кластеров, по умолчанию примерно 4 * sqrt(N).
+        - nprobe (int): Количество просматриваемых кластеров при поиске.
+        - pq_m (int): Количество подвекторов для product quantization, None - без PQ.
+        - n_iter (int): Количество итераций k-means.
+
+        Returns:
+        IVFIndex: Обученный индекс со всеми людьми из хранилища.
+
+        """
+
+        embeddings = store.embeddings()
+        if n_lists is None:
+            n_lists = max(1, min(int(4 * np.sqrt(embeddings.shape[0])), embeddings.shape[0]))
+
+        index = cls(dim=store.dim, n_lists=n_lists, nprobe=nprobe, pq_m=pq_m)
+        index.train(embeddings, n_iter=n_iter)
+        index.add(embeddings, store.names, store.ids)
+        return index
+
+    def save(self, path):
+        """
+        Сохранение индекса (центроидов, словарей PQ и содержимого кластеров) в файл .npz.
+
+        Parameters:
+        - path (str): Путь к файлу.
+
+        """
+
+        lengths = np.array([ids.shape[0] for ids in self.list_ids], dtype=np.int64)
+        ids = np.concatenate(self.list_ids)
+        meta = {'dim': self.dim, 'n_lists': self.n_lists, 'nprobe': self.nprobe,
+                'pq_m': self.pq.m if self.pq is not None else None,
+                'names': [self.entries[person_id][0] for person_id in ids.tolist()]}
+
+        arrays = {'centroids': self.centroids, 'lengths': lengths, 'ids': ids,
+                  'data': np.concatenate(self.list_data), 'meta': np.array(json.dumps(meta))}
+        if self.pq is not None:
+            arrays['codebooks'] = self.pq.codebooks
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Загрузка индекса, сохраненного методом save.
+
+        Parameters:
+        - path (str): Путь к файлу .npz.
+
+        Returns:
+        IVFIndex: Загруженный индекс.
+
+        """
+
+        with np.load(Path(path)) as arrays:
+            meta = json.loads(str(arrays['meta']))
+            index = cls(dim=meta['dim'], n_lists=meta['n_lists'], nprobe=meta['nprobe'], pq_m=meta['pq_m'])
+            index.centroids = arrays['centroids']
+            if index.pq is not None:
+                index.pq.codebooks = arrays['codebooks']
+
+            offsets = np.concatenate([[0], np.cumsum(arrays['lengths'])])
+            ids, data = arrays['ids'], arrays['data']
+
+        for list_id in range(index.n_lists):
+            start, end = offsets[list_id], offsets[list_id + 1]
+            index.list_ids[list_id] = ids[start:end]
+            index.list_data[list_id] = data[start:end]
+            for row, person_id in enumerate(ids[start:end].tolist(), start=start):
+                index.entries[person_id] = (meta['names'][row], list_id)
+
+        return index
+
+
+def recall_report(ann_index, exact_index, queries, k=1, nprobes=(1, 2, 4, 8, 16, 32)):
+    """
+    Сравнение приближенного поиска с точным: полнота (recall@k) и время поиска для разных nprobe.
+
+    Parameters:
+    - ann_index (IVFIndex): Приближенный индекс.
+    - exact_index (EmbeddingIndex): Точный индекс по тем же людям.
+    - queries (np.ndarray): Эмбеддинги запросов формы (B, D).
+    - k (int): Количество ближайших людей.
+    - nprobes (tuple): Значения nprobe для проверки.
+
+    Returns:
+    list: Список словарей {'nprobe', 'recall', 'ms_per_query'}.
+
+    """
+
+    # порог inf, чтобы сравнивать соседей, а не решение "известен / неизвестен";
+    # сравниваются id, а не имена: у человека с несколькими фото несколько записей с одним именем
+    _, _, exact_ids = exact_index.search(queries, k=k, threshold=np.inf, return_ids=True)
+    exact_sets = [set(row[row >= 0].tolist()) for row in exact_ids]
+    n_exact = sum(len(row) for row in exact_sets)
+
+    report = []
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        _, _, ann_ids = ann_index.search(queries, k=k, threshold=np.inf, nprobe=nprobe, return_ids=True)
+        elapsed = time.perf_counter() - start
+
+        hits = sum(len(exact_row & set(ann_row.tolist())) for exact_row, ann_row in zip(exact_sets, ann_ids))
+        report.append({'nprobe': nprobe,
+                       'recall': hits / n_exact if n_exact else 1.0,
+                       'ms_per_query': 1000 * elapsed / len(exact_ids)})
+    return report
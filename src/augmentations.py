@@ -0,0 +1,186 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def to_uint8_tensor(img):
+    """
+    transform для датасетов детекции при аугментациях на GPU: изображение RGB uint8 (H, W, 3) -> тензор uint8 (3, H, W)
+    без нормализации, чтобы в даталоадере и при копировании на GPU было в 4 раза меньше данных, чем в float32.
+
+    """
+
+    return torch.from_numpy(img).permute(2, 0, 1).contiguous()
+
+
+def _uniform(low, high, size, device):
+    return torch.empty(size, device=device).uniform_(low, high)
+
+
+def _rotation_about(center_x, center_y, angle, scale):
+    # матрицы (B, 3, 3) поворота на angle градусов и масштабирования вокруг центра, как cv2.getRotationMatrix2D
+    angle = torch.deg2rad(angle)
+    alpha, beta = scale * torch.cos(angle), scale * torch.sin(angle)
+    matrix = torch.zeros(len(angle), 3, 3, device=angle.device)
+    matrix[:, 0, 0], matrix[:, 0, 1] = alpha, beta
+    matrix[:, 1, 0], matrix[:, 1, 1] = -beta, alpha
+    matrix[:, 0, 2] = (1 - alpha) * center_x - beta * center_y
+    matrix[:, 1, 2] = beta * center_x + (1 - alpha) * center_y
+    matrix[:, 2, 2] = 1
+    return matrix
+
+
+class BatchDetectionAugment(nn.Module):
+
+    '''
+    Аугментации transform_faces из src/dataloaders.py (Rotate, RandomBrightnessContrast, Flip, ShiftScaleRotate,
+    GaussianBlur с min_visibility для рамок), но для целого батча на устройстве батча (GPU), а не для каждого
+    изображения на CPU в __getitem__.
+
+    Геометрические преобразования каждого изображения собираются в одну аффинную матрицу и применяются
+    одним grid_sample на весь батч, рамки преобразуются той же матрицей (по четырем углам, как largest_box
+    в albumentations), обрезаются по границам изображения и выбрасываются, если после обрезки от них осталось
+    меньше min_visibility площади. Отличие от albumentations: область за границей изображения везде заполняется
+    нулями (у albumentations Rotate по умолчанию отражает изображение), а рамки проверяются один раз после
+    всех преобразований, а не после каждого.
+
+    Вход - батч uint8 (B, 3, H, W) (датасет с transform=to_uint8_tensor и без transform_bbox) и рамки
+    (B, 5) или (B, N, 5) в формате [p, x1, y1, x2, y2] в пикселях, выброшенные рамки становятся [0, -1, -1, -1, -1].
+    Выход - батч float32, умноженный на scale (по умолчанию как transform из src/dataloaders.py).
+
+    Вероятности и диапазоны по умолчанию - как в transform_faces.
+    '''
+
+    def __init__(self, rotate_limit=30, rotate_p=0.1,
+                 brightness_limit=0.1, contrast_limit=0.1, brightness_contrast_p=0.1,
+                 flip_p=0.2,
+                 shift_limit=0.4, scale_limit=0.1, shift_rotate_limit=45, shift_scale_rotate_p=0.5,
+                 blur_limit=(3, 7), blur_p=0.01,
+                 min_visibility=0.5, scale=1 / 255 ** 2):
+        super().__init__()
+        self.rotate_limit, self.rotate_p = rotate_limit, rotate_p
+        self.brightness_limit, self.contrast_limit = brightness_limit, contrast_limit
+        self.brightness_contrast_p = brightness_contrast_p
+        self.flip_p = flip_p
+        self.shift_limit, self.scale_limit = shift_limit, scale_limit
+        self.shift_rotate_limit, self.shift_scale_rotate_p = shift_rotate_limit, shift_scale_rotate_p
+        self.blur_limit, self.blur_p = blur_limit, blur_p
+        self.min_visibility = min_visibility
+        self.scale = scale
+
+    def geometry(self, batch_size, height, width, device):
+        """
+        Случайные аффинные матрицы (B, 3, 3) в пикселях: Rotate, затем Flip, затем ShiftScaleRotate.
+
+        """
+
+        center_x, center_y = width / 2, height / 2
+        eye = torch.eye(3, device=device).repeat(batch_size, 1, 1)
+
+        # Rotate
+        angle = _uniform(-self.rotate_limit, self.rotate_limit, batch_size, device)
+        rotate = _rotation_about(center_x, center_y, angle, torch.ones_like(angle))
+        rotate = torch.where((torch.rand(batch_size, device=device) < self.rotate_p)[:, None, None], rotate, eye)
+
+        # Flip: по горизонтали, по вертикали или оба сразу с равной вероятностью
+        flip = eye.clone()
+        mode = torch.randint(0, 3, (batch_size,), device=device)
+        flipped = torch.rand(batch_size, device=device) < self.flip_p
+        horizontal = flipped & (mode != 1)
+        vertical = flipped & (mode != 0)
+        flip[horizontal, 0, 0], flip[horizontal, 0, 2] = -1, width
+        flip[vertical, 1, 1], flip[vertical, 1, 2] = -1, height
+
+        # ShiftScaleRotate
+        angle = _uniform(-self.shift_rotate_limit, self.shift_rotate_limit, batch_size, device)
+        scale = 1 + _uniform(-self.scale_limit, self.scale_limit, batch_size, device)
+        shift_scale_rotate = _rotation_about(center_x, center_y, angle, scale)
+        shift_scale_rotate[:, 0, 2] += _uniform(-self.shift_limit, self.shift_limit, batch_size, device) * width
+        shift_scale_rotate[:, 1, 2] += _uniform(-self.shift_limit, self.shift_limit, batch_size, device) * height
+        applied = torch.rand(batch_size, device=device) < self.shift_scale_rotate_p
+        shift_scale_rotate = torch.where(applied[:, None, None], shift_scale_rotate, eye)
+
+        return shift_scale_rotate @ flip @ rotate
+
+    def brightness_contrast(self, images, max_value):
+        batch_size = len(images)
+        alpha = 1 + _uniform(-self.contrast_limit, self.contrast_limit, batch_size, images.device)
+        beta = _uniform(-self.brightness_limit, self.brightness_limit, batch_size, images.device) * max_value
+        applied = torch.rand(batch_size, device=images.device) < self.brightness_contrast_p
+        alpha = torch.where(applied, alpha, torch.ones_like(alpha))
+        beta = torch.where(applied, beta, torch.zeros_like(beta))
+        return (images * alpha[:, None, None, None] + beta[:, None, None, None]).clamp(0, max_value)
+
+    def warp(self, images, matrix):
+        # grid_sample берет для каждого пикселя результата точку исходного изображения, поэтому нужна обратная
+        # матрица, переведенная в нормированные координаты [-1, 1] (align_corners=False: -1 - край изображения)
+        height, width = images.shape[2:]
+        to_normalized = torch.tensor([[2 / width, 0, -1], [0, 2 / height, -1], [0, 0, 1]], device=images.device)
+        theta = to_normalized @ torch.linalg.inv(matrix) @ torch.linalg.inv(to_normalized)
+        grid = F.affine_grid(theta[:, :2], list(images.shape), align_corners=False)
+        return F.grid_sample(images, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+    def blur(self, images):
+        applied = (torch.rand(len(images), device=images.device) < self.blur_p).nonzero().flatten().tolist()
+        for i in applied:
+            kernel_size = 2 * int(torch.randint(self.blur_limit[0] // 2, self.blur_limit[1] // 2 + 1, ())) + 1
+            sigma = 0.3 * ((kernel_size - 1) * 0.5 - 1) + 0.8  # как cv2.getGaussianKernel при sigma=0
+            x = torch.arange(kernel_size, device=images.device) - kernel_size // 2
+            kernel = torch.exp(-x ** 2 / (2 * sigma ** 2))
+            kernel = kernel / kernel.sum()
+            kernel_2d = (kernel[:, None] * kernel[None, :]).expand(images.shape[1], 1, -1, -1)
+            padded = F.pad(images[i:i + 1], [kernel_size // 2] * 4, mode='reflect')
+            images[i] = F.conv2d(padded, kernel_2d, groups=images.shape[1])[0]
+        return images
+
+    def transform_boxes(self, targets, matrix, height, width):
+        single = targets.dim() == 2
+        if single:
+            targets = targets[:, None]
+
+        boxes = targets[..., 1:]
+        x1, y1, x2, y2 = boxes.unbind(-1)
+        corners = torch.stack([torch.stack([x1, y1], -1), torch.stack([x2, y1], -1),
+                               torch.stack([x1, y2], -1), torch.stack([x2, y2], -1)], dim=2)  # (B, N, 4, 2)
+        corners = corners @ matrix[:, None, :2, :2].transpose(-1, -2) + matrix[:, None, None, :2, 2]
+
+        transformed = torch.cat([corners.min(dim=2).values, corners.max(dim=2).values], dim=-1)
+        clipped = torch.stack([transformed[..., 0].clamp(0, width), transformed[..., 1].clamp(0, height),
+                               transformed[..., 2].clamp(0, width), transformed[..., 3].clamp(0, height)], dim=-1)
+
+        area = (transformed[..., 2] - transformed[..., 0]) * (transformed[..., 3] - transformed[..., 1])
+        clipped_area = (clipped[..., 2] - clipped[..., 0]) * (clipped[..., 3] - clipped[..., 1])
+        keep = (targets[..., 0] > 0) & (clipped_area > 0) & (clipped_area >= self.min_visibility * area)
+
+        empty = torch.tensor([0, -1, -1, -1, -1], dtype=targets.dtype, device=targets.device)
+        result = torch.where(keep[..., None], torch.cat([targets[..., :1], clipped.to(targets.dtype)], dim=-1), empty)
+        return result[:, 0] if single else result
+
+    @torch.no_grad()
+    def forward(self, images, targets, augment=True):
+        """
+        Parameters:
+        - images (torch.Tensor): Батч uint8 (B, 3, H, W).
+        - targets (torch.Tensor): Рамки (B, 5) или (B, N, 5).
+        - augment (bool): Если False, только перевод в float и нормализация (для валидации).
+
+        Returns:
+        tuple: Батч float32 (B, 3, H, W) и рамки той же формы, что targets.
+
+        """
+
+        max_value = 255.0 if images.dtype == torch.uint8 else 1.0
+        images = images.float()
+
+        if not augment:
+            return images * (self.scale * 255 / max_value), targets
+
+        batch_size, _, height, width = images.shape
+
+        images = self.brightness_contrast(images, max_value)
+        matrix = self.geometry(batch_size, height, width, images.device)
+        images = self.warp(images, matrix)
+        images = self.blur(images)
+
+        targets = self.transform_boxes(targets.float(), matrix, height, width)
+        return images * (self.scale * 255 / max_value), targets
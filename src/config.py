@@ -0,0 +1,31 @@
+from functools import lru_cache
+
+import yaml
+
+
+# функция для загрузки конфига
+def get_options():
+    """
+    Загрузка конфигурационных опций из файла config.yaml.
+
+    Returns:
+    dict: Словарь с конфигурационными опциями.
+
+    """
+    options_path = 'config.yaml'
+    with open(options_path, 'r') as option_file:
+        options = yaml.safe_load(option_file)
+    return options
+
+
+@lru_cache(maxsize=None)
+def get_config():
+    """
+    Опции из config.yaml, прочитанные один раз при первом обращении (а не при импорте модуля).
+    Для кода, который вызывается на каждом кадре; чтобы перечитать файл, используйте get_options.
+
+    Returns:
+    dict: Словарь с конфигурационными опциями.
+
+    """
+    return get_options()
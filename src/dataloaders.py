@@ -1,129 +1,185 @@
 import os
+import hashlib
+import json
+import time
+from functools import lru_cache
+import shutil
 from pathlib import Path
 import random
+from concurrent.futures import ThreadPoolExecutor
 
-import pandas as pd
 import numpy as np
 import cv2
-import albumentations as A
 
 import torch
 from torchvision import transforms
-from torch.utils.data import DataLoader, Dataset, ConcatDataset, random_split
+from torch.utils.data import DataLoader, Dataset, ConcatDataset, Sampler, random_split
 
-import src.utils as utils
+from src.augmentations import to_uint8_tensor
+from src.config import get_config
 
 
-# загружаем данные из конфига
-config = utils.get_options()
+# config.yaml читается при первом обращении (get_config), а не при импорте модуля, поэтому модуль импортируется
+# из любой папки; pandas и albumentations тоже импортируются только в тех местах, где они нужны
 
-batch_size = config['batch_size']
-img_size = config['img_size']
-img_size_recog = config['img_size_recog']
 
+def _root():
+    # корневая папка данных
+    return '/content/Face_id_and_detection/' if get_config()['use_colab'] else ""
 
-# задаем корневую папку
-root = '/content/Face_id_and_detection/' if config['use_colab'] else ""
 
-# пути к папкам датасета с 3к изображениям лиц
-y_labels = pd.read_csv(f'{root}data/human-faces-object-detection/faces.csv')
-image_path = f'{root}data/human-faces-object-detection/images'
+# пути к данным относительно корневой папки
+_data_paths = {
+    # датасет с 3к изображениями лиц
+    'y_labels_csv': 'data/human-faces-object-detection/faces.csv',
+    'image_path': 'data/human-faces-object-detection/images',
+    # картинки комнат
+    'backg_image_path': 'data/house-rooms-image-dataset/House_Room_Dataset',
+    # датасет с 10к изображениями
+    'image_dir_for_ten_thousand_dataset': 'data/face-detection-dataset/images',
+    'csv_file_path_for_ten_thousand_dataset': 'data/face-detection-dataset/labels_and_coordinates.csv',
+    'all_faces_csv_file_path_for_ten_thousand_dataset': 'data/face-detection-dataset/labels_and_coordinates_all.csv',
+    # celebA
+    'celeb_images': 'data/celeba-face-recognition-triplets/CelebA FR Triplets/CelebA FR Triplets/images',
+    'celeb_triplets_csv': 'data/celeba-face-recognition-triplets/CelebA FR Triplets/CelebA FR Triplets/triplets.csv',
+}
 
-# путь к папке с картинками комнат
-backg_image_path = f'{root}data/house-rooms-image-dataset/House_Room_Dataset'
 
-# Путь к папке с изображениями и CSV файлу для датасета с 10к изображениями
-image_dir_for_ten_thousand_dataset = f"{root}data/face-detection-dataset/images"
-csv_file_path_for_ten_thousand_dataset = f"{root}data/face-detection-dataset/labels_and_coordinates.csv"
+def data_path(name):
+    """
+    Путь к данным по имени из _data_paths (например 'image_path') с учетом use_colab.
+
+    """
+
+    return _root() + _data_paths[name]
 
 
 ### ЗАДАЕМ КЛАСССЫ ДАТАСЕТОВ ###
 
+def apply_detection_transforms(img, boxes, transform=None, transform_bbox=None, all_boxes=False):
+
+    """
+    Общая часть __getitem__ датасетов детекции: аугментации albumentations и сборка ответа.
+
+    Parameters:
+    - img (np.ndarray): Изображение RGB uint8 размера img_size x img_size.
+    - boxes (np.ndarray): Рамки [x1, y1, x2, y2] формы (N, 4) в пикселях img (N может быть 0).
+    - transform: Преобразования изображения (torchvision).
+    - transform_bbox: Аугментации albumentations с bbox_params.
+    - all_boxes (bool): Если True, возвращаются все рамки формы (N, 5),
+      иначе только первая в формате [p, x1, y1, x2, y2] (как раньше для InspectorGadjet).
+
+    Returns:
+    tuple: Изображение и тензор рамок float32.
+
+    """
+
+    if transform_bbox:
+        items = transform_bbox(image=img, bboxes=list(boxes), class_labels=[1] * len(boxes))
+        img = items['image']
+        # if bbox is too small after the augmentation albumentations drops it
+        boxes = np.array(items['bboxes'], dtype=np.float32).reshape(-1, 4)
+
+    if all_boxes:
+        target = np.concatenate([np.ones((len(boxes), 1), dtype=np.float32), boxes], axis=1)
+    elif len(boxes) > 0:
+        target = np.array([1, *boxes[0]], dtype=np.float32)
+    else:
+        target = np.array([0, -1, -1, -1, -1], dtype=np.float32)
+
+    if transform:
+        img = transform(img)
+
+    return img, torch.tensor(target, dtype=torch.float32)
+
+
+def detection_collate(batch):
+
+    """
+    collate_fn для датасетов с all_boxes=True: дополняет рамки до одинакового количества
+    пустыми строками [0, -1, -1, -1, -1].
+
+    Returns:
+    tuple: Батч изображений (B, 3, H, W) и рамок (B, N_max, 5).
+
+    """
+
+    images = torch.stack([img for img, _ in batch])
+    max_boxes = max(1, max(len(boxes) for _, boxes in batch))
+
+    targets = torch.tensor([0, -1, -1, -1, -1], dtype=torch.float32).repeat(len(batch), max_boxes, 1)
+    for i, (_, boxes) in enumerate(batch):
+        targets[i, :len(boxes)] = boxes
+
+    return images, targets
+
+
 class ThreeThousandFaceDataSet(Dataset):
 
-    def __init__(self, images_path, dataset, transform=None, transform_bbox=None):
+    def __init__(self, images_path, dataset, transform=None, transform_bbox=None, all_boxes=False):
         ''' Loading dataset
         images_path: path where images are stored
         dataset: dataframe where image names and box bounds are stored
         transform: functions for data augmentation (from albumentations lib)
+        all_boxes: return every face of the image (N, 5) instead of the first one
         height: height used to resize the image
         width: width used to resize the image
-        images_list: list where all image paths are stored
-        bboxes: list where all the bounding boxes are stored
+        names: names of the images present both in dataset and in images_path
+        starts: row span of every image: image index -> rows [starts[index], starts[index + 1]) of boxes
+        boxes: np.array (M, 4) with the bounding boxes of all faces grouped per image
         '''
         self.images_path = Path(images_path)
-        self.dataset = dataset
-        self.n_samples = dataset.shape[0]
-
-        self.images_list = sorted(list(self.images_path.glob('*.jpg')))
-        self.images_names = [image.name for image in self.images_list]
-        self.bboxes_names = dataset['image_name'].tolist()
 
         self.transform_bbox = transform_bbox
         self.transform = transform
+        self.all_boxes = all_boxes
 
         #img size from config
-        self.size = img_size
+        self.size = get_config()['img_size']
 
-        # cut down to only images present in dataset
-        self.images = []
-        for i in self.bboxes_names:
-            for j in self.images_names:
-                if i == j:
-                    self.images.append(i)
+        # cut down to only images present in dataset (set lookup instead of comparing every pair of names)
+        images_names = {image.name for image in self.images_path.glob('*.jpg')}
+        dataset = dataset[dataset['image_name'].isin(images_names)]
 
+        # group the rows by image, so that every image is one sample with all its faces
+        self.dataset = dataset.sort_values('image_name', kind='stable').reset_index(drop=True)
+        names = self.dataset['image_name'].values
+        self.starts = np.flatnonzero(np.r_[True, names[1:] != names[:-1], True]) if len(names) else np.zeros(1, int)
+        self.names = names[self.starts[:-1]]
+        self.boxes = self.dataset[['x0', 'y0', 'x1', 'y1']].values.astype(int).astype(np.float32)
 
-    def __getitem__(self, index):
+        self.n_samples = len(self.names)
 
-        # Получение изображения как массива numpy 
-        image_name = self.images[index]
-        image_path = self.images_path / image_name
-        img = cv2.imread(str(image_path))
 
+    def image_file(self, index):
+        return self.images_path / self.names[index]
+
+    def load_original(self, index):
+        # изображение RGB в исходном разрешении и рамки в его пикселях
+        img = cv2.imread(str(self.image_file(index)))
 
         # by default in cv2 represents image in BGR order, so we have to convert it back to RGB
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        
-        # извлекаем ширину и высоту текущего изображения
-        cur_height, cur_width = img.shape[:2]
-
-        # img = img.astype(float) / 255.0   # custom normalization
-        
-        image_labels = self.dataset[self.dataset['image_name'] == image_name]
-
-        for i in range(len(image_labels)):
-            # cur_height = image_labels['height'].iloc[i]
-            # cur_width = image_labels['width'].iloc[i]
+        return img, self.boxes[self.starts[index]:self.starts[index + 1]].copy()
 
-            x0 = (int(image_labels['x0'].iloc[i]) / cur_width) * self.size
-            y0 = (int(image_labels['y0'].iloc[i]) / cur_height) * self.size
-            x1 = (int(image_labels['x1'].iloc[i]) / cur_width)  * self.size
-            y1 = (int(image_labels['y1'].iloc[i]) / cur_height) * self.size
+    def load(self, index):
 
-            bbox = np.array([1, x0, y0, x1, y1])
-            break
+        img, boxes = self.load_original(index)
 
-        # at this point we have img as RGB like np.array not normalized and
-        # bbox as np.array
+        # извлекаем ширину и высоту текущего изображения
+        cur_height, cur_width = img.shape[:2]
+        boxes *= np.array([self.size / cur_width, self.size / cur_height] * 2, dtype=np.float32)
 
         # resize изображение, чтобы применить albumentations
         img = cv2.resize(img, (self.size, self.size))
 
-        if self.transform_bbox:
-            items = self.transform_bbox(image=img, bboxes=[bbox[1:]], class_labels=[1])
-            img = items['image'] 
-
-            if len(items['bboxes']) > 0:
-                bbox = [1] + list(items['bboxes'][0])
-                # bbox = list(items['bboxes'][0])
-            else:
-                # if bbox is too small after the augmentation we drop the bbox
-                bbox = [0, -1, -1, -1, -1]
-
-        if self.transform:
-            img = self.transform(img)
+        # at this point we have img as RGB like np.array not normalized and
+        # boxes as np.array of shape (N, 4)
+        return img, boxes
 
-        return img, torch.tensor(bbox)
+    def __getitem__(self, index):
+        img, boxes = self.load(index)
+        return apply_detection_transforms(img, boxes, self.transform, self.transform_bbox, self.all_boxes)
 
     def __len__(self):
         return self.n_samples
@@ -131,13 +187,15 @@ class ThreeThousandFaceDataSet(Dataset):
 
 class BackgroundDataset(Dataset):
 
-    def __init__(self, folder_path, transform = None):
+    def __init__(self, folder_path, transform = None, all_boxes=False):
         ''' Loading dataset
         folder_path: path of images of background
+        all_boxes: return an empty (0, 5) box tensor instead of [0, -1, -1, -1, -1]
         '''
         self.folder_path = Path(folder_path)
-        self.size = img_size
+        self.size = get_config()['img_size']
         self.transform = transform
+        self.all_boxes = all_boxes
 
         self.types = ['Bathroom', 'Bedroom',
                       'Dinning', 'Kitchen', 'Livingroom']
@@ -156,26 +214,31 @@ class BackgroundDataset(Dataset):
 
         self.n_samples = len(self.images_path)
 
-    def __getitem__(self, index):
+    def image_file(self, index):
+        return self.images_path[index]
+
+    def load(self, index):
         # Получение изображения как массива numpy 
-        image_path = self.images_path[index]
-        img = cv2.imread(str(image_path))
+        img = cv2.imread(str(self.image_file(index)))
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
         img = cv2.resize(img, (self.size, self.size))
 
-        if self.transform:
-            img = self.transform(img)
+        return img, np.empty((0, 4), dtype=np.float32)
 
-        return img, torch.tensor([0, -1, -1, -1, -1]).float()
+    def __getitem__(self, index):
+        img, boxes = self.load(index)
+        return apply_detection_transforms(img, boxes, self.transform, all_boxes=self.all_boxes)
 
     def __len__(self):
         return self.n_samples
 
 
 class TenThousandFaceDataSet(Dataset):
-    def __init__(self, csv_file, image_dir, transform=None, transform_bbox=None):
-        # csv file with bbox values
+    def __init__(self, csv_file, image_dir, transform=None, transform_bbox=None, all_boxes=False):
+        # csv file with bbox values (one row per face, an image with several faces has several rows)
+        import pandas as pd
+
         self.data = pd.read_csv(csv_file)
 
         #path to dir with images
@@ -185,143 +248,710 @@ class TenThousandFaceDataSet(Dataset):
         self.transform = transform
         self.transform_bbox = transform_bbox
 
+        # return every face of the image (N, 5) instead of the first one
+        self.all_boxes = all_boxes
+
+        # row span of every image in the csv: image idx -> rows [starts[idx], starts[idx + 1])
+        self.data = self.data.sort_values('name', kind='stable').reset_index(drop=True)
+        names = self.data['name'].values
+        self.starts = np.flatnonzero(np.r_[True, names[1:] != names[:-1], True]) if len(names) else np.zeros(1, int)
+        self.names = names[self.starts[:-1]]
+        self.boxes = self.data[['x1', 'y1', 'x2', 'y2']].values.astype(np.float32)
+
         #img size from config
-        self.size = img_size
+        self.size = get_config()['img_size']
         
 
     def __len__(self):
-        return len(self.data)
+        return len(self.names)
 
-    def __getitem__(self, idx):
-        
-        # Получение изображения как массива numpy 
-        img_name = os.path.join(self.image_dir.joinpath(f"{self.data.iloc[idx, 0]}"))  
-        img = cv2.imread(str(img_name)+'.jpg')
+    def image_file(self, idx):
+        return self.image_dir / f"{self.names[idx]}.jpg"
+
+    def load_original(self, idx):
+        # изображение RGB в исходном разрешении и рамки в его пикселях
+        img = cv2.imread(str(self.image_file(idx)))
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        return img, self.boxes[self.starts[idx]:self.starts[idx + 1]].copy()
 
-        # Извлекаем координаты bbox из CSV файла
-        x1, y1, x2, y2 = self.data.iloc[idx, 1:5].values.astype(np.float32)
+    def load(self, idx):
+        
+        img, boxes = self.load_original(idx)
 
         # извлекаем ширину и высоту текущего изображения
         cur_height, cur_width = img.shape[:2]
 
-        # Создаем ограничивающий прямоугольник (bbox)
-        bbox = np.array([1, x1/cur_width*self.size, y1/cur_height*self.size, x2/cur_width*self.size, y2/cur_height*self.size])
+        # переводим координаты bbox из CSV файла в размер img_size
+        boxes *= np.array([self.size / cur_width, self.size / cur_height] * 2, dtype=np.float32)
         
         ### at this point we have img as RGB like np.array not normalized and
-        ### bbox as np.array
+        ### boxes as np.array of shape (N, 4)
 
-        # img = img.astype(float) / 255.0   # custom normalization
-        
         img = cv2.resize(img, (self.size, self.size))
 
-        # apply transform for bbox if needed
-        if self.transform_bbox:
-            items = self.transform_bbox(image=img, bboxes=[bbox[1:]], class_labels=[1])
-            img = items['image'] 
+        return img, boxes
 
-            if len(items['bboxes']) > 0:
-                bbox = [1] + list(items['bboxes'][0])
-                # bbox = list(items['bboxes'][0])
-            else:
-                # if bbox is too small after the augmentation we drop the bbox
-                bbox = [0, -1, -1, -1, -1]
+    def __getitem__(self, idx):
+        img, boxes = self.load(idx)
+        return apply_detection_transforms(img, boxes, self.transform, self.transform_bbox, self.all_boxes)
+
+
+def _files_digest(paths):
+    # sha1 по пути, размеру и времени изменения каждого файла, без учета порядка файлов
+    files = []
+    for path in paths:
+        stat = os.stat(path)
+        files.append(f'{path}|{stat.st_size}|{stat.st_mtime_ns}')
+    return hashlib.sha1('\n'.join(sorted(files)).encode())
+
+
+def source_fingerprint(dataset):
+
+    """
+    Отпечаток исходных данных датасета детекции: путь, размер и время изменения каждого изображения
+    (без учета порядка, BackgroundDataset перемешивает файлы) и содержимое разметки (рамки всех изображений).
+    Меняется, если изменились изображения или csv с разметкой, даже при том же количестве изображений.
+
+    Parameters:
+    - dataset: Датасет детекции с методом image_file (TenThousandFaceDataSet, ThreeThousandFaceDataSet,
+      BackgroundDataset).
+
+    Returns:
+    str: sha1 в hex.
+
+    """
+
+    digest = _files_digest(dataset.image_file(idx) for idx in range(len(dataset)))
+    for name in ('boxes', 'starts'):
+        labels = getattr(dataset, name, None)
+        if labels is not None:
+            digest.update(np.ascontiguousarray(labels).tobytes())
+    return digest.hexdigest()
+
+
+def build_detection_cache(dataset, cache_dir, num_workers=8, rebuild=False):
+
+    """
+    Однократная сборка кэша датасета детекции: все изображения, уже декодированные и приведенные
+    к img_size, записываются в один файл images.npy (N, img_size, img_size, 3) uint8,
+    рамки нормированные в [0, 1] - в boxes.npy (M, 4), а границы рамок каждого изображения - в starts.npy.
+
+    Кэш собирается во временной папке и переносится на место целиком, поэтому прерванная сборка
+    не оставляет испорченный кэш. Если кэш уже собран для того же количества изображений, размера
+    и тех же исходных файлов и разметки (source_fingerprint), он не пересобирается.
+
+    Parameters:
+    - dataset: Датасет детекции с методом load (TenThousandFaceDataSet, ThreeThousandFaceDataSet, BackgroundDataset).
+    - cache_dir (str): Папка кэша.
+    - num_workers (int): Количество потоков для декодирования (cv2 отпускает GIL).
+    - rebuild (bool): Пересобрать кэш, даже если он уже есть.
+
+    Returns:
+    CachedDetectionDataset: Датасет, читающий из кэша, с теми же аугментациями, что у исходного.
+
+    """
+
+    cache_dir = Path(cache_dir)
+    n_images = len(dataset)
+    meta = {'n_images': n_images, 'size': dataset.size, 'fingerprint': source_fingerprint(dataset)}
+
+    meta_path = cache_dir / 'meta.json'
+    if rebuild or not meta_path.exists() or json.loads(meta_path.read_text()) != meta:
+        tmp_dir = cache_dir.with_name(cache_dir.name + '.tmp')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+
+        images = np.lib.format.open_memmap(tmp_dir / 'images.npy', mode='w+', dtype=np.uint8,
+                                           shape=(n_images, dataset.size, dataset.size, 3))
+        boxes = [None] * n_images
+
+        def load(idx):
+            img, img_boxes = dataset.load(idx)
+            images[idx] = img
+            boxes[idx] = img_boxes / dataset.size
+
+        with ThreadPoolExecutor(num_workers) as executor:
+            # list() чтобы пробросить исключения из потоков
+            list(executor.map(load, range(n_images)))
+        images.flush()
+        del images
+
+        np.save(tmp_dir / 'boxes.npy', np.concatenate([np.empty((0, 4), dtype=np.float32), *boxes]))
+        np.save(tmp_dir / 'starts.npy', np.cumsum([0] + [len(b) for b in boxes]))
+        (tmp_dir / 'meta.json').write_text(json.dumps(meta))
+
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.replace(tmp_dir, cache_dir)
 
+    return CachedDetectionDataset(cache_dir, dataset.transform, getattr(dataset, 'transform_bbox', None),
+                                  getattr(dataset, 'all_boxes', False))
 
-        # Применяем преобразования к изображению (если указаны)
-        if self.transform:
-            img = self.transform(img)
 
-        return img, torch.tensor(bbox)
+class CachedDetectionDataset(Dataset):
+    def __init__(self, cache_dir, transform=None, transform_bbox=None, all_boxes=False):
+        # кэш, собранный build_detection_cache
+        self.cache_dir = Path(cache_dir)
+
+        # изображения не читаются в память: mmap с копированием при записи (mode 'c') дает
+        # изображение без копирования, а аугментации не могут испортить файл
+        self.images = np.load(self.cache_dir / 'images.npy', mmap_mode='c')
+        self.boxes = np.load(self.cache_dir / 'boxes.npy')
+        self.starts = np.load(self.cache_dir / 'starts.npy')
+
+        self.transform = transform
+        self.transform_bbox = transform_bbox
+        self.all_boxes = all_boxes
+
+        self.size = self.images.shape[1]
+
+    def __len__(self):
+        return len(self.images)
+
+    def load(self, idx):
+        boxes = self.boxes[self.starts[idx]:self.starts[idx + 1]] * self.size
+        return self.images[idx], boxes
+
+    def __getitem__(self, idx):
+        img, boxes = self.load(idx)
+        return apply_detection_transforms(img, boxes, self.transform, self.transform_bbox, self.all_boxes)
 
 
 class CelebATriplets(Dataset):
+    # сторона декодированного изображения
+    decoded_size = 160
+
     def __init__(self, images, triplets_path, transform=None):
         self.images_path = Path(images)
         self.triplets_path = Path(triplets_path)
+        import pandas as pd
+
         self.triplets = pd.read_csv(self.triplets_path)
         self.transform = transform
-        self.size = img_size_recog
-        
+        self.size = get_config()['img_size_recog']
+
+        # одно и то же изображение встречается во многих триплетах, поэтому храним список уникальных
+        # изображений и триплеты как номера в нем: triplet_ids[index] -> (anchor, pos, neg)
+        names = self.triplets[['anchor', 'pos', 'neg']].values.astype(str)
+        self.image_names, triplet_ids = np.unique(names, return_inverse=True)
+        self.triplet_ids = triplet_ids.reshape(names.shape).astype(np.int32)
+
+        # декодированные изображения (n_images, 160, 160, 3) uint8, задаются build_image_cache; файл открывается
+        # через mmap, поэтому все workers даталоадера читают одни и те же страницы без копий
+        self.images = None
+        self.images_file = None
+
+        # эмбеддинги учителя для дистилляции (n_images, dim), задаются build_teacher_cache
+        self.teacher_embeddings = None
+
+    def __getstate__(self):
+        # при spawn в worker передается путь к кэшу, а не содержимое mmap
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+    def image_file(self, image_id):
+        return self.images_path / self.image_names[image_id]
+
+    def decode(self, image_id):
+        img = cv2.imread(str(self.image_file(image_id)))
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        return cv2.resize(img, (self.decoded_size, self.decoded_size))
+
+    def get_img(self, image_id):
+        if self.images is None and self.images_file is not None:
+            self.images = np.load(self.images_file, mmap_mode='r')
+        img = self.images[image_id] if self.images is not None else self.decode(image_id)
+
+        # img /= 255.0
+        return np.transpose(img, (2, 0, 1)).astype(np.float32)
 
     def __getitem__(self, index):
-        triplet = self.triplets[self.triplets.index == index]
+        anc_id, pos_id, neg_id = self.triplet_ids[index]
+        triplet = [self.get_img(anc_id), self.get_img(pos_id), self.get_img(neg_id)]
+
+        # если эмбеддинги учителя посчитаны, к триплету добавляется эмбеддинг учителя для anchor
+        if self.teacher_embeddings is not None:
+            triplet.append(np.array(self.teacher_embeddings[anc_id]))
+        return triplet
 
-        def get_img(image_path):
-            img = cv2.imread(str(image_path))
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            img = cv2.resize(img, (160, 160)).astype(np.float32)
-            # img /= 255.0
-            img = np.transpose(img, (2, 0, 1))
-            return img
+    def __len__(self):
+        return len(self.triplet_ids)
 
-        anc_path = Path(triplet.anchor.values[0])
-        pos_path = Path(triplet.pos.values[0])
-        neg_path = Path(triplet.neg.values[0])
 
-        anc = get_img(self.images_path.joinpath(anc_path))
-        pos = get_img(self.images_path.joinpath(pos_path))
-        neg = get_img(self.images_path.joinpath(neg_path))
 
-        return [anc, pos, neg]
+def build_image_cache(dataset, cache_dir, num_workers=8, rebuild=False):
+
+    """
+    Однократное декодирование всех уникальных изображений CelebATriplets в один файл images.npy
+    (n_images, 160, 160, 3) uint8 по номеру изображения в dataset.image_names.
+
+    Одно изображение встречается во многих триплетах, а файл открывается через mmap, поэтому каждое изображение
+    декодируется один раз на все эпохи и на все workers даталоадера. Кэш собирается во временной папке
+    и переносится на место целиком. Если кэш собран для тех же файлов (путь, размер и время изменения),
+    он не пересобирается.
+
+    Parameters:
+    - dataset (CelebATriplets): Датасет триплетов.
+    - cache_dir (str): Папка кэша.
+    - num_workers (int): Количество потоков для декодирования (cv2 отпускает GIL).
+    - rebuild (bool): Пересобрать кэш, даже если он уже есть.
+
+    Returns:
+    np.memmap: Декодированные изображения.
+
+    """
+
+    cache_dir = Path(cache_dir)
+    n_images = len(dataset.image_names)
+    meta = {'n_images': n_images, 'size': dataset.decoded_size,
+            'fingerprint': _files_digest(dataset.image_file(i) for i in range(n_images)).hexdigest()}
+
+    meta_path = cache_dir / 'meta.json'
+    if rebuild or not meta_path.exists() or json.loads(meta_path.read_text()) != meta:
+        tmp_dir = cache_dir.with_name(cache_dir.name + '.tmp')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+
+        images = np.lib.format.open_memmap(tmp_dir / 'images.npy', mode='w+', dtype=np.uint8,
+                                           shape=(n_images, dataset.decoded_size, dataset.decoded_size, 3))
+
+        def load(image_id):
+            images[image_id] = dataset.decode(image_id)
+
+        with ThreadPoolExecutor(num_workers) as executor:
+            # list() чтобы пробросить исключения из потоков
+            list(executor.map(load, range(n_images)))
+        images.flush()
+        del images
+
+        (tmp_dir / 'meta.json').write_text(json.dumps(meta))
+
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.replace(tmp_dir, cache_dir)
+
+    dataset.images_file = cache_dir / 'images.npy'
+    dataset.images = np.load(dataset.images_file, mmap_mode='r')
+    return dataset.images
+
+
+def build_teacher_cache(dataset, teacher, cache_dir, device='cpu', batch_size=64, rebuild=False):
+
+    """
+    Однократный подсчет эмбеддингов учителя (например, InceptionResnetV1 для дистилляции) для всех изображений
+    CelebATriplets. Эмбеддинги пишутся в embeddings.npy (n_images, dim) по номеру изображения в dataset.image_names,
+    имена изображений - в names.npy, и открываются через mmap.
+
+    После вызова dataset (и CelebAIdentities поверх него) возвращает эмбеддинг учителя вместе с изображениями,
+    поэтому учителя не нужно запускать на каждом шаге обучения. Учитель переводится в режим eval.
+
+    Parameters:
+    - dataset (CelebATriplets): Датасет триплетов.
+    - teacher (nn.Module): Замороженная модель учителя.
+    - cache_dir (str): Папка кэша.
+    - device (str): Устройство для учителя.
+    - batch_size (int): Размер батча.
+    - rebuild (bool): Пересчитать эмбеддинги, даже если кэш для тех же изображений уже есть.
+
+    Returns:
+    np.memmap: Эмбеддинги учителя.
+
+    """
+
+    cache_dir = Path(cache_dir)
+    names_path = cache_dir / 'names.npy'
+
+    if rebuild or not names_path.exists() or not np.array_equal(np.load(names_path), dataset.image_names):
+        tmp_dir = cache_dir.with_name(cache_dir.name + '.tmp')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+
+        teacher.eval()
+        embeddings = None
+        with torch.no_grad():
+            for start in range(0, len(dataset.image_names), batch_size):
+                ids = range(start, min(start + batch_size, len(dataset.image_names)))
+                images = torch.from_numpy(np.stack([dataset.get_img(i) for i in ids]))
+                output = teacher(images.to(device)).float().cpu().numpy()
+
+                if embeddings is None:
+                    embeddings = np.lib.format.open_memmap(tmp_dir / 'embeddings.npy', mode='w+', dtype=np.float32,
+                                                           shape=(len(dataset.image_names), output.shape[1]))
+                embeddings[start:start + len(output)] = output
+        embeddings.flush()
+        del embeddings
+
+        np.save(tmp_dir / 'names.npy', dataset.image_names)
+
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.replace(tmp_dir, cache_dir)
+
+    dataset.teacher_embeddings = np.load(cache_dir / 'embeddings.npy', mmap_mode='r')
+    return dataset.teacher_embeddings
+
+
+def identities_from_pairs(pairs, n_images):
+
+    """
+    Разметка изображений по личностям: пары (anchor, pos) изображают одного человека, поэтому личности -
+    это компоненты связности графа этих пар (система непересекающихся множеств).
+
+    Parameters:
+    - pairs (np.ndarray): Пары номеров изображений одного человека формы (N, 2).
+    - n_images (int): Количество изображений.
+
+    Returns:
+    np.ndarray: Номер личности каждого изображения (0 .. n_identities - 1).
+
+    """
+
+    parent = np.arange(n_images)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for a, b in pairs:
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[root_b] = root_a
+
+    roots = np.array([find(i) for i in range(n_images)])
+    return np.unique(roots, return_inverse=True)[1]
+
+
+class CelebAIdentities(Dataset):
+    def __init__(self, triplets_dataset):
+        # изображения CelebA по одному с номером личности, для PKSampler и mining лоссов
+        # (изображения и их кэш общие с датасетом триплетов)
+        self.triplets_dataset = triplets_dataset
+        self.labels = identities_from_pairs(triplets_dataset.triplet_ids[:, :2], len(triplets_dataset.image_names))
+
+    def __getitem__(self, index):
+        teacher_embeddings = self.triplets_dataset.teacher_embeddings
+        if teacher_embeddings is not None:
+            return self.triplets_dataset.get_img(index), self.labels[index], np.array(teacher_embeddings[index])
+        return self.triplets_dataset.get_img(index), self.labels[index]
+
+    def __len__(self):
+        return len(self.labels)
+
+
+class PKSampler(Sampler):
+
+    '''
+    batch_sampler, который собирает батч из p личностей по k изображений каждой, чтобы в каждом батче
+    были и позитивные, и негативные пары для каждого изображения.
+
+    Личности с одним изображением не используются, у личностей с меньше чем k изображениями
+    изображения берутся с повторением.
+
+    labels - номер личности каждого изображения
+    p - количество личностей в батче
+    k - количество изображений одной личности в батче
+    n_batches - количество батчей за эпоху, по умолчанию столько, чтобы каждое изображение встретилось примерно один раз
+    '''
+
+    def __init__(self, labels, p, k, n_batches=None, seed=None):
+        self.p, self.k = p, k
+        self.rng = np.random.default_rng(seed)
+
+        order = np.argsort(labels, kind='stable')
+        _, starts, counts = np.unique(np.asarray(labels)[order], return_index=True, return_counts=True)
+        self.groups = [order[start:start + count] for start, count in zip(starts, counts) if count > 1]
+
+        n_images = sum(len(group) for group in self.groups)
+        self.n_batches = n_batches or max(1, n_images // (p * k))
+
+    def __iter__(self):
+        for _ in range(self.n_batches):
+            batch = []
+            for identity in self.rng.choice(len(self.groups), self.p, replace=len(self.groups) < self.p):
+                group = self.groups[identity]
+                batch.extend(self.rng.choice(group, self.k, replace=len(group) < self.k).tolist())
+            yield batch
 
     def __len__(self):
-        return len(self.triplets)
+        return self.n_batches
 
 
 
 ### TRANSFORMS SECTION ###
-transform_faces = A.Compose([
-    A.Rotate(limit=30, p=0.1),
-    A.RandomBrightnessContrast(brightness_limit=0.1, contrast_limit=0.1, p=0.1),
-    A.Flip(p=0.2),
-    A.ShiftScaleRotate(shift_limit=0.4, p=0.5, border_mode=cv2.BORDER_CONSTANT, value=0),
-    A.GaussianBlur(p=0.01)
-], bbox_params=A.BboxParams(format='pascal_voc', min_visibility=0.5, label_fields=['class_labels'])) # min_area=1024 min_visibility=0.1
+
+@lru_cache(maxsize=None)
+def get_transform_faces():
+    # аугментации albumentations для детекции, albumentations импортируется только здесь
+    import albumentations as A
+
+    return A.Compose([
+        A.Rotate(limit=30, p=0.1),
+        A.RandomBrightnessContrast(brightness_limit=0.1, contrast_limit=0.1, p=0.1),
+        A.Flip(p=0.2),
+        A.ShiftScaleRotate(shift_limit=0.4, p=0.5, border_mode=cv2.BORDER_CONSTANT, value=0),
+        A.GaussianBlur(p=0.01)
+    ], bbox_params=A.BboxParams(format='pascal_voc', min_visibility=0.5, label_fields=['class_labels'])) # min_area=1024 min_visibility=0.1
+
+def normalize(x):
+    # обычная функция вместо lambda, чтобы transform можно было передать в worker процессы даталоадера (spawn)
+    return x / 255.0
 
 #transform for each img 
 transform = transforms.Compose([
     transforms.ToTensor(),
-    transforms.Lambda(lambda x: x / 255.0), # normalization
+    transforms.Lambda(normalize), # normalization
 ])
 
 
+### DATALOADER SETTINGS ###
+
+def seed_worker(worker_id):
+    # torch задает каждому worker свое зерно, а numpy и random (их используют albumentations) при fork
+    # копируют состояние главного процесса, и без этого все workers делают одинаковые аугментации
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+_tuned_num_workers = {}
+
+
+def autotune_num_workers(dataset, batch_size=None, candidates=None, n_batches=20, collate_fn=None):
+
+    """
+    Подбор количества worker процессов даталоадера: для каждого варианта измеряется количество батчей в секунду
+    (без первого батча, в который входит запуск workers) и выбирается самый быстрый.
+
+    Parameters:
+    - dataset: Датасет.
+    - batch_size (int): Размер батча, по умолчанию batch_size из config.yaml.
+    - candidates (list): Варианты количества workers, по умолчанию 0, 2, 4, ... до количества ядер.
+    - n_batches (int): Сколько батчей измерять для каждого варианта.
+    - collate_fn: collate_fn даталоадера.
+
+    Returns:
+    int: Лучшее количество workers.
+
+    """
+
+    batch_size = batch_size or get_config()['batch_size']
+    if candidates is None:
+        candidates = [0] + list(range(2, (os.cpu_count() or 1) + 1, 2))
+
+    speeds = {}
+    for num_workers in candidates:
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, collate_fn=collate_fn,
+                            num_workers=num_workers, worker_init_fn=seed_worker)
+        batches = iter(loader)
+        next(batches)
+        started_at, n_done = time.perf_counter(), 0
+        for _ in range(n_batches):
+            if next(batches, None) is None:
+                break
+            n_done += 1
+        speeds[num_workers] = n_done / (time.perf_counter() - started_at)
+        del batches, loader
+
+    best = max(speeds, key=speeds.get)
+    print('Dataloader batches/sec by num_workers:', {k: round(v, 1) for k, v in speeds.items()}, '-> using', best)
+    return best
+
+
+def loader_kwargs(dataset=None, collate_fn=None):
+
+    """
+    Параметры DataLoader из блока dataloader в config.yaml: num_workers (число или "auto"), pin_memory,
+    persistent_workers, prefetch_factor и seed (зерно перемешивания и аугментаций в workers, null - случайное).
+
+    Parameters:
+    - dataset: Датасет, нужен только для num_workers: "auto" (подбирается autotune_num_workers один раз на датасет).
+    - collate_fn: collate_fn даталоадера для подбора num_workers.
+
+    Returns:
+    dict: Именованные аргументы для DataLoader.
+
+    """
+
+    settings = get_config()['dataloader']
+
+    num_workers = settings['num_workers']
+    if num_workers == 'auto':
+        if id(dataset) not in _tuned_num_workers:
+            _tuned_num_workers[id(dataset)] = autotune_num_workers(dataset, collate_fn=collate_fn)
+        num_workers = _tuned_num_workers[id(dataset)]
+
+    kwargs = {
+        'num_workers': num_workers,
+        'pin_memory': settings['pin_memory'] and torch.cuda.is_available(),
+        'worker_init_fn': seed_worker,
+    }
+    if settings['seed'] is not None:
+        kwargs['generator'] = torch.Generator().manual_seed(settings['seed'])
+    if num_workers > 0:
+        kwargs['persistent_workers'] = settings['persistent_workers']
+        kwargs['prefetch_factor'] = settings['prefetch_factor']
+
+    return kwargs
+
+
+def _split_generator():
+    # генератор для random_split: при заданном seed разбиение на train/val одинаковое при каждом запуске
+    seed = get_config()['dataloader']['seed']
+    return torch.default_generator if seed is None else torch.Generator().manual_seed(seed)
+
+
 ### INITIALISING DATASETS ###
 
+# Датасеты и даталоадеры создаются только при первом обращении, поэтому импорт модуля не читает csv
+# и не обходит папки с изображениями. Каждая функция get_* создает объект один раз и дальше возвращает его же.
+# Старые имена (dataloaders.dataset, dataloaders.recognition_dataloader, ...) работают через __getattr__ модуля.
+
 # --Detection Dataloader--
 
-#dataset for 3000 img with faces
-Ten_Thousand_Face_dataset = TenThousandFaceDataSet(
-    csv_file=csv_file_path_for_ten_thousand_dataset, 
-    image_dir=image_dir_for_ten_thousand_dataset, 
-    transform=transform, transform_bbox=transform_faces)
+@lru_cache(maxsize=None)
+def get_y_labels():
+    # разметка датасета с 3к изображениями лиц
+    import pandas as pd
+
+    return pd.read_csv(data_path('y_labels_csv'))
+
 
-#dataset for 10000 img with faces
-Three_Thousand_Face_dataset = ThreeThousandFaceDataSet(image_path, y_labels, 
-                                                       transform, transform_bbox=transform_faces)
+def _detection_transforms():
+    # при gpu_augmentation датасеты отдают uint8 без аугментаций, аугментации делает BatchDetectionAugment на GPU
+    if get_config()['gpu_augmentation']:
+        return to_uint8_tensor, None
+    return transform, get_transform_faces()
 
-#dataset with backgrounds img
-dataset_of_backgrounds = BackgroundDataset(backg_image_path, transform)
 
-#concatinating all datasets
-dataset = ConcatDataset(
-    [Ten_Thousand_Face_dataset,Ten_Thousand_Face_dataset, dataset_of_backgrounds])
+def _cached(dataset, name):
+    # если задана папка кэша, изображения декодируются один раз, а при обучении читаются из кэша
+    config = get_config()
+    if config['detection_cache_dir']:
+        return build_detection_cache(dataset, os.path.join(_root(), config['detection_cache_dir'], name))
+    return dataset
+
+
+@lru_cache(maxsize=None)
+def get_ten_thousand_face_dataset():
+    #dataset for 10000 img with faces
+    img_transform, bbox_transform = _detection_transforms()
+    return _cached(TenThousandFaceDataSet(
+        csv_file=data_path('csv_file_path_for_ten_thousand_dataset'),
+        image_dir=data_path('image_dir_for_ten_thousand_dataset'),
+        transform=img_transform, transform_bbox=bbox_transform), 'ten_thousand')
+
+
+@lru_cache(maxsize=None)
+def get_three_thousand_face_dataset():
+    #dataset for 3000 img with faces
+    img_transform, bbox_transform = _detection_transforms()
+    return ThreeThousandFaceDataSet(data_path('image_path'), get_y_labels(), img_transform, transform_bbox=bbox_transform)
+
+
+@lru_cache(maxsize=None)
+def get_background_dataset():
+    #dataset with backgrounds img
+    img_transform, _ = _detection_transforms()
+    return _cached(BackgroundDataset(data_path('backg_image_path'), img_transform), 'backgrounds')
+
+
+@lru_cache(maxsize=None)
+def get_detection_dataset():
+    #concatinating all datasets
+    return ConcatDataset(
+        [get_ten_thousand_face_dataset(), get_ten_thousand_face_dataset(), get_background_dataset()])
+
 
 def get_train_test_dataloaders(dataset, test_size):
-    train_dataset, test_dataset = random_split(dataset, [1-test_size, test_size])
-    train_dataloader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-    test_dataloader = torch.utils.data.DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
+    train_dataset, test_dataset = random_split(dataset, [1-test_size, test_size], generator=_split_generator())
+    kwargs = loader_kwargs(dataset)
+    batch_size = get_config()['batch_size']
+    train_dataloader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=True, **kwargs)
+    test_dataloader = torch.utils.data.DataLoader(test_dataset, batch_size=batch_size, shuffle=False, **kwargs)
 
     return train_dataloader, test_dataloader
 
-train_detection_dataloader, test_detection_dataloader = get_train_test_dataloaders(dataset, 0.1)
+
+@lru_cache(maxsize=None)
+def get_detection_dataloaders():
+    return get_train_test_dataloaders(get_detection_dataset(), 0.1)
+
+
+def get_multi_face_train_test_dataloaders(test_size):
+    # датасеты и даталоадеры со всеми лицами каждого изображения для обучения InspectorGadjetDense
+    img_transform, bbox_transform = _detection_transforms()
+    multi_face_dataset = ConcatDataset([
+        TenThousandFaceDataSet(
+            csv_file=data_path('all_faces_csv_file_path_for_ten_thousand_dataset'),
+            image_dir=data_path('image_dir_for_ten_thousand_dataset'),
+            transform=img_transform, transform_bbox=bbox_transform, all_boxes=True),
+        ThreeThousandFaceDataSet(data_path('image_path'), get_y_labels(), img_transform, transform_bbox=bbox_transform,
+                                 all_boxes=True),
+        BackgroundDataset(data_path('backg_image_path'), img_transform, all_boxes=True)])
+
+    train_dataset, test_dataset = random_split(multi_face_dataset, [1-test_size, test_size],
+                                               generator=_split_generator())
+    kwargs = loader_kwargs(multi_face_dataset, detection_collate)
+    batch_size = get_config()['batch_size']
+    train_dataloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, collate_fn=detection_collate,
+                                  **kwargs)
+    test_dataloader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, collate_fn=detection_collate,
+                                 **kwargs)
+
+    return train_dataloader, test_dataloader
 
 # --FaceId Dataloader--
-# celebA dataset
-celeb_images = f"{root}data/celeba-face-recognition-triplets/CelebA FR Triplets/CelebA FR Triplets/images"
-celeb_triplets_csv = f"{root}data/celeba-face-recognition-triplets/CelebA FR Triplets/CelebA FR Triplets/triplets.csv"
 
-CelebA_dataset = CelebATriplets(celeb_images, celeb_triplets_csv)
 
-recognition_dataloader = DataLoader(
-    dataset=CelebA_dataset, batch_size=batch_size, shuffle=True)
+@lru_cache(maxsize=None)
+def get_celeba_dataset():
+    dataset = CelebATriplets(data_path('celeb_images'), data_path('celeb_triplets_csv'))
+    # если задана папка кэша, изображения декодируются один раз и читаются всеми workers через mmap
+    config = get_config()
+    if config['recognition_cache_dir']:
+        build_image_cache(dataset, os.path.join(_root(), config['recognition_cache_dir']))
+    return dataset
+
+
+@lru_cache(maxsize=None)
+def get_recognition_dataloader():
+    celeba_dataset = get_celeba_dataset()
+    return DataLoader(
+        dataset=celeba_dataset, batch_size=get_config()['batch_size'], shuffle=True, **loader_kwargs(celeba_dataset))
+
+
+def get_pk_recognition_dataloader(p=None, k=4):
+    # даталоадер (изображения, личности) с батчами из p личностей по k изображений для mining лоссов
+    identities = CelebAIdentities(get_celeba_dataset())
+    config = get_config()
+    sampler = PKSampler(identities.labels, p or max(2, config['batch_size'] // k), k,
+                        seed=config['dataloader']['seed'])
+    return DataLoader(identities, batch_sampler=sampler, **loader_kwargs(identities))
+
+
+# старые глобальные переменные модуля -> функции, которые их создают
+_lazy_globals = {
+    'y_labels': get_y_labels,
+    'Ten_Thousand_Face_dataset': get_ten_thousand_face_dataset,
+    'Three_Thousand_Face_dataset': get_three_thousand_face_dataset,
+    'dataset_of_backgrounds': get_background_dataset,
+    'dataset': get_detection_dataset,
+    'train_detection_dataloader': lambda: get_detection_dataloaders()[0],
+    'test_detection_dataloader': lambda: get_detection_dataloaders()[1],
+    'CelebA_dataset': get_celeba_dataset,
+    'recognition_dataloader': get_recognition_dataloader,
+    'transform_faces': get_transform_faces,
+    'config': get_config,
+    'root': _root,
+    'batch_size': lambda: get_config()['batch_size'],
+    'img_size': lambda: get_config()['img_size'],
+    'img_size_recog': lambda: get_config()['img_size_recog'],
+}
+
+
+def __getattr__(name):
+    if name in _lazy_globals:
+        return _lazy_globals[name]()
+    if name in _data_paths:
+        return data_path(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
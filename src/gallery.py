@@ -0,0 +1,495 @@
+import os
+import json
+import warnings
+from pathlib import Path
+
+import numpy as np
+import torch
+
+
+# имя, которое возвращается, если ближайший человек дальше порога
+UNKNOWN = 'unknown'
+
+
+def l2_normalize(embeddings, eps=1e-12):
+    """
+    Нормализация эмбеддингов по L2-норме (построчно).
+
+    Parameters:
+    - embeddings (np.ndarray): Матрица эмбеддингов формы (N, D).
+    - eps (float): Защита от деления на ноль.
+
+    Returns:
+    np.ndarray: Нормализованная матрица float32 той же формы.
+
+    """
+
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, eps)
+
+
+class EmbeddingIndex:
+
+    '''
+    Индекс эмбеддингов людей из базы данных, который загружается один раз и хранится в памяти.
+
+    embeddings - матрица эмбеддингов формы (N, D), хранится непрерывной и нормализованной в float32
+    names - имена людей, names[i] соответствует embeddings[i]
+    normalize - bool, нужно ли нормализовать эмбеддинги при создании индекса
+    ids - уникальные id людей (как в GalleryStore), нужны для удаления, по умолчанию 0 ... N-1
+
+    Поиск нормализует и эмбеддинги запросов (модель не гарантирует единичную норму) и считает квадрат
+    евклидова расстояния между нормализованными векторами, то есть 2 - 2 * cos, поэтому порог 1.2
+    из recognition_cam сохраняет свой смысл при любой норме выхода модели.
+    '''
+
+    def __init__(self, embeddings, names, normalize=True, ids=None):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2:
+            raise ValueError(f'embeddings must be a 2D matrix, got shape {embeddings.shape}')
+        if len(names) != embeddings.shape[0]:
+            raise ValueError(f'got {len(names)} names for {embeddings.shape[0]} embeddings')
+
+        self.embeddings = l2_normalize(embeddings) if normalize else embeddings
+        self.names = np.asarray(names, dtype=object)
+        self.ids = np.arange(len(names), dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+        self.dim = embeddings.shape[1]
+        self._set_base()
+
+    def _set_base(self):
+        # torch-представление той же памяти, чтобы не копировать матрицу на каждом кадре;
+        # memmap снимка открыт только на чтение, в индекс мы не пишем, поэтому предупреждение torch лишнее
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            self._base = torch.from_numpy(self.embeddings)
+
+    @classmethod
+    def from_csv(cls, database_path):
+        """
+        Загрузка индекса из базы данных в формате csv (колонки name, emb0 ... emb511).
+
+        Parameters:
+        - database_path (str): Путь к файлу Database.csv.
+
+        Returns:
+        EmbeddingIndex: Индекс со всеми людьми из базы данных.
+
+        """
+
+        import pandas as pd  # нужен только для старого формата, не замедляем импорт модуля
+
+        database = pd.read_csv(database_path, index_col=0)
+        return cls(database.values, database.index.values)
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    def add(self, embeddings, names, ids):
+        """
+        Добавление людей в индекс (матрица копируется, поэтому для больших баз лучше IVFIndex).
+
+        Parameters:
+        - embeddings (np.ndarray): Эмбеддинги формы (N, D).
+        - names (list): Имена людей.
+        - ids (list): Уникальные id людей.
+
+        """
+
+        embeddings = l2_normalize(np.asarray(embeddings).reshape(-1, self.dim))
+        self.embeddings = np.concatenate([self.embeddings, embeddings])
+        self.names = np.concatenate([self.names, np.asarray(names, dtype=object)])
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+        self._set_base()
+
+    def remove(self, ids):
+        """
+        Удаление людей из индекса по id.
+
+        Parameters:
+        - ids (list): id людей для удаления, неизвестные id пропускаются.
+
+        """
+
+        keep = ~np.isin(self.ids, np.asarray(ids, dtype=np.int64))
+        self.embeddings = np.ascontiguousarray(self.embeddings[keep])
+        self.names = self.names[keep]
+        self.ids = self.ids[keep]
+        self._set_base()
+
+    def search(self, embeddings, k=1, threshold=1.2, return_ids=False):
+        """
+        Поиск k ближайших людей для батча эмбеддингов.
+
+        Parameters:
+        - embeddings (torch.Tensor | np.ndarray): Эмбеддинги лиц формы (B, D) или (D,), нормализуются здесь же.
+        - k (int): Количество ближайших людей для каждого запроса.
+        - threshold (float): Если расстояние больше порога, вместо имени возвращается 'unknown'.
+        - return_ids (bool): Вернуть еще и id найденных людей (у одного человека может быть несколько записей
+          с одинаковым именем, поэтому сравнивать результаты поиска нужно по id).
+
+        Returns:
+        tuple: Массив имен формы (B, k) и массив расстояний float32 формы (B, k),
+        отсортированные по возрастанию расстояния, и при return_ids - массив id int64 формы (B, k).
+
+        """
+
+        if isinstance(embeddings, torch.Tensor):
+            queries = embeddings.detach().to('cpu', torch.float32).numpy()
+        else:
+            queries = np.asarray(embeddings, dtype=np.float32)
+        queries = l2_normalize(queries.reshape(-1, self.dim))
+
+        k = min(k, len(self))
+        if k == 0:
+            names = np.full((queries.shape[0], 1), UNKNOWN, dtype=object)
+            distances = np.full((queries.shape[0], 1), np.inf, dtype=np.float32)
+            if return_ids:
+                return names, distances, np.full((queries.shape[0], 1), -1, dtype=np.int64)
+            return names, distances
+
+        with torch.no_grad():
+            similarity = torch.from_numpy(queries) @ self._base.T
+            distances = (2 - 2 * similarity).clamp_(min=0)
+            distances, ids = torch.topk(distances, k, dim=1, largest=False)
+
+        distances, ids = distances.numpy(), ids.numpy()
+        names = self.names[ids]
+        names[distances > threshold] = UNKNOWN
+
+        if return_ids:
+            return names, distances, self.ids[ids]
+        return names, distances
+
+
+class GalleryStore:
+
+    '''
+    Бинарное хранилище базы данных людей, которое заменяет Database.csv.
+
+    Хранилище - это папка со снимком и журналом изменений:
+    meta.json - номер поколения, размер эмбеддинга и следующий свободный id
+    embeddings-<gen>.npy - снимок: матрица нормализованных эмбеддингов float32, открывается через memmap
+    ids-<gen>.npy, names-<gen>.npy - id (int64) и имена людей из снимка в том же порядке, что и строки эмбеддингов
+    pending-<gen>.f32 - эмбеддинги, добавленные после снимка (сырые строки float32 подряд)
+    log-<gen>.jsonl - журнал изменений после снимка, по одной записи {"op": "add" | "drop", ...} на строку
+
+    Добавление и удаление человека дописывают в конец журнала, поэтому стоят O(1) операций ввода-вывода.
+    Время от времени журнал сливается в новый снимок (compact), старое поколение удаляется.
+
+    path - путь к папке хранилища, создается при необходимости
+    dim - размер эмбеддинга
+    compact_every - после скольких записей в журнале делать compact автоматически (None - не делать)
+    '''
+
+    def __init__(self, path, dim=512, compact_every=4096):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.compact_every = compact_every
+
+        meta_path = self.path / 'meta.json'
+        if meta_path.exists():
+            with open(meta_path, 'r') as meta_file:
+                meta = json.load(meta_file)
+        else:
+            meta = {'generation': 0, 'dim': dim, 'next_id': 0}
+
+        self.generation = meta['generation']
+        self.dim = meta['dim']
+        self.next_id = meta['next_id']
+
+        snapshot_path = self._file('embeddings', 'npy')
+        if snapshot_path.exists():
+            self._snapshot = np.load(snapshot_path, mmap_mode='r')
+        else:
+            self._snapshot = np.empty((0, self.dim), dtype=np.float32)
+
+        if 'ids' in meta:
+            # хранилища старого формата: id и имена снимка в самом meta.json, до первого compact
+            snapshot_ids, snapshot_names = meta['ids'], meta['names']
+        elif self._file('ids', 'npy').exists():
+            snapshot_ids = np.load(self._file('ids', 'npy')).tolist()
+            snapshot_names = np.load(self._file('names', 'npy')).tolist()
+        else:
+            snapshot_ids, snapshot_names = [], []
+
+        # id -> (имя, источник, номер строки); источник 0 - снимок, 1 - pending
+        self._entries = {person_id: (name, 0, row)
+                         for row, (person_id, name) in enumerate(zip(snapshot_ids, snapshot_names))}
+
+        self._log_size = 0
+        n_pending = 0
+        log_path = self._file('log', 'jsonl')
+        if log_path.exists():
+            # смещение конца последней целой записи: недописанный хвост после падения процесса отрезается,
+            # иначе следующая запись допишется к нему и тоже станет нечитаемой
+            good_bytes = 0
+            with open(log_path, 'rb') as log_file:
+                for line in log_file:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    if record['op'] == 'add':
+                        self._entries[record['id']] = (record['name'], 1, n_pending)
+                        self.next_id = max(self.next_id, record['id'] + 1)
+                        n_pending += 1
+                    elif record['op'] == 'drop':
+                        self._entries.pop(record['id'], None)
+                    self._log_size += 1
+                    good_bytes += len(line)
+            if log_path.stat().st_size != good_bytes:
+                with open(log_path, 'r+b') as log_file:
+                    log_file.truncate(good_bytes)
+
+        # строки без записи в журнале (упали между двумя записями) отрезаем
+        pending_path = self._file('pending', 'f32')
+        row_bytes = self.dim * 4
+        if pending_path.exists() and pending_path.stat().st_size != n_pending * row_bytes:
+            with open(pending_path, 'r+b') as pending_file:
+                pending_file.truncate(n_pending * row_bytes)
+        self._n_pending = n_pending
+
+        # имя -> id людей с этим именем, для проверки "имя уже есть" и удаления без прохода по всей базе
+        self._by_name = {}
+        for person_id, entry in self._entries.items():
+            self._by_name.setdefault(entry[0], []).append(person_id)
+
+    def _file(self, name, ext, generation=None):
+        generation = self.generation if generation is None else generation
+        return self.path / f'{name}-{generation}.{ext}'
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    @property
+    def ids(self):
+        return list(self._entries.keys())
+
+    @property
+    def names(self):
+        return [entry[0] for entry in self._entries.values()]
+
+    def _pending(self):
+        if self._n_pending == 0:
+            return np.empty((0, self.dim), dtype=np.float32)
+        return np.memmap(self._file('pending', 'f32'), dtype=np.float32, mode='r',
+                         shape=(self._n_pending, self.dim))
+
+    def embeddings(self):
+        """
+        Матрица эмбеддингов всех людей в хранилище, строки в порядке self.ids.
+
+        Если журнал пуст, возвращается сам memmap снимка без копирования.
+
+        Returns:
+        np.ndarray: Нормализованная матрица float32 формы (N, D).
+
+        """
+
+        if self._n_pending == 0 and len(self._entries) == self._snapshot.shape[0]:
+            return self._snapshot
+
+        entries = list(self._entries.values())
+        sources = np.fromiter((entry[1] for entry in entries), dtype=np.int8, count=len(entries))
+        rows = np.fromiter((entry[2] for entry in entries), dtype=np.int64, count=len(entries))
+
+        result = np.empty((len(entries), self.dim), dtype=np.float32)
+        from_snapshot = sources == 0
+        result[from_snapshot] = self._snapshot[rows[from_snapshot]]
+        result[~from_snapshot] = self._pending()[rows[~from_snapshot]]
+        return result
+
+    def add_many(self, names, embeddings):
+        """
+        Добавление нескольких людей одной записью в конец журнала.
+
+        Parameters:
+        - names (list): Имена людей.
+        - embeddings (np.ndarray): Эмбеддинги формы (N, D), нормализуются перед записью.
+
+        Returns:
+        list: id добавленных людей.
+
+        """
+
+        embeddings = l2_normalize(np.asarray(embeddings).reshape(-1, self.dim))
+        if len(names) != embeddings.shape[0]:
+            raise ValueError(f'got {len(names)} names for {embeddings.shape[0]} embeddings')
+
+        ids = list(range(self.next_id, self.next_id + len(names)))
+
+        # сначала эмбеддинги, потом журнал: запись в журнале означает, что строка уже на диске
+        with open(self._file('pending', 'f32'), 'ab') as pending_file:
+            pending_file.write(embeddings.tobytes())
+        with open(self._file('log', 'jsonl'), 'a') as log_file:
+            for person_id, name in zip(ids, names):
+                log_file.write(json.dumps({'op': 'add', 'id': person_id, 'name': name}) + '\n')
+
+        for person_id, name in zip(ids, names):
+            self._entries[person_id] = (name, 1, self._n_pending)
+            self._by_name.setdefault(name, []).append(person_id)
+            self._n_pending += 1
+        self.next_id += len(names)
+        self._log_size += len(names)
+
+        self._maybe_compact()
+        return ids
+
+    def add(self, name, embedding):
+        """
+        Добавление одного человека в хранилище.
+
+        Returns:
+        int: id добавленного человека.
+
+        """
+
+        return self.add_many([name], embedding)[0]
+
+    def drop(self, name):
+        """
+        Удаление всех записей с указанным именем.
+
+        Returns:
+        list: id удаленных людей.
+
+        """
+
+        ids = self._by_name.pop(name, [])
+        if not ids:
+            return ids
+
+        with open(self._file('log', 'jsonl'), 'a') as log_file:
+            for person_id in ids:
+                log_file.write(json.dumps({'op': 'drop', 'id': person_id}) + '\n')
+
+        for person_id in ids:
+            del self._entries[person_id]
+        self._log_size += len(ids)
+
+        self._maybe_compact()
+        return ids
+
+    def _maybe_compact(self):
+        if self.compact_every is not None and self._log_size >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        """
+        Слияние снимка и журнала в новое поколение хранилища.
+
+        Новый снимок, id, имена и meta.json пишутся рядом со старыми, переключение происходит
+        атомарной заменой meta.json, после чего файлы старого поколения удаляются.
+
+        """
+
+        old_generation = self.generation
+        new_generation = old_generation + 1
+
+        snapshot_path = self._file('embeddings', 'npy', new_generation)
+        np.save(snapshot_path, self.embeddings())
+        np.save(self._file('ids', 'npy', new_generation), np.asarray(self.ids, dtype=np.int64))
+        np.save(self._file('names', 'npy', new_generation), np.asarray(self.names, dtype=str))
+
+        meta = {'generation': new_generation, 'dim': self.dim, 'next_id': self.next_id}
+        tmp_meta_path = self.path / 'meta.json.tmp'
+        with open(tmp_meta_path, 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(tmp_meta_path, self.path / 'meta.json')
+
+        self.generation = new_generation
+        self._snapshot = np.load(snapshot_path, mmap_mode='r')
+        self._entries = {person_id: (entry[0], 0, row)
+                         for row, (person_id, entry) in enumerate(self._entries.items())}
+        self._n_pending = 0
+        self._log_size = 0
+
+        for name, ext in [('embeddings', 'npy'), ('ids', 'npy'), ('names', 'npy'), ('pending', 'f32'),
+                          ('log', 'jsonl')]:
+            old_path = self._file(name, ext, old_generation)
+            if old_path.exists():
+                old_path.unlink()
+
+    def to_index(self):
+        """
+        Создание EmbeddingIndex из хранилища без повторной нормализации.
+
+        Returns:
+        EmbeddingIndex: Индекс всех людей из хранилища.
+
+        """
+
+        return EmbeddingIndex(self.embeddings(), self.names, normalize=False, ids=self.ids)
+
+
+# открытые хранилища по пути к папке: повторное открытие не перечитывает снимок и не проигрывает журнал
+_open_stores = {}
+
+
+def open_store(gallery_path):
+    """
+    Хранилище GalleryStore для папки, открытое один раз на процесс.
+
+    Следующие вызовы с тем же путем возвращают тот же объект, поэтому добавление и удаление людей стоят
+    только записи в журнал. Если папку меняет другой процесс, хранилище нужно открыть заново через GalleryStore.
+
+    Parameters:
+    - gallery_path (str): Путь к папке хранилища.
+
+    Returns:
+    GalleryStore: Хранилище.
+
+    """
+
+    key = os.path.realpath(gallery_path)
+    store = _open_stores.get(key)
+    if store is None:
+        store = _open_stores[key] = GalleryStore(gallery_path)
+    return store
+
+
+def csv_to_gallery(csv_path, gallery_path, dim=512):
+    """
+    Однократная конвертация базы данных Database.csv в бинарное хранилище GalleryStore.
+
+    Parameters:
+    - csv_path (str): Путь к файлу Database.csv (колонки name, emb0 ... emb511).
+    - gallery_path (str): Путь к папке, в которую будет записано хранилище.
+    - dim (int): Размер эмбеддинга.
+
+    Returns:
+    GalleryStore: Хранилище со всеми людьми из csv.
+
+    """
+
+    import pandas as pd  # нужен только для старого формата, не замедляем импорт модуля
+
+    database = pd.read_csv(csv_path, index_col=0)
+
+    store = GalleryStore(gallery_path, dim=dim, compact_every=None)
+    store.add_many(database.index.tolist(), database.values)
+    store.compact()
+    return store
+
+
+def load_index(database_path):
+    """
+    Загрузка EmbeddingIndex из папки GalleryStore или из файла csv.
+
+    Parameters:
+    - database_path (str): Путь к папке хранилища или к файлу Database.csv.
+
+    Returns:
+    EmbeddingIndex: Индекс всех людей из базы данных.
+
+    """
+
+    if os.path.isdir(database_path):
+        return open_store(database_path).to_index()
+    return EmbeddingIndex.from_csv(database_path)
@@ -0,0 +1,251 @@
+import json
+import os
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from src.config import get_options
+
+
+def fuse_conv_bn(module):
+    """
+    Слияние пар Conv2d -> BatchNorm2d внутри nn.Sequential в одну свертку (модель должна быть в eval).
+
+    BatchNorm заменяется на nn.Identity, поэтому индексы слоев и state_dict остальных слоев не меняются.
+
+    Parameters:
+    - module (nn.Module): Модель, меняется на месте.
+
+    Returns:
+    nn.Module: Та же модель.
+
+    """
+
+    for child in module.children():
+        fuse_conv_bn(child)
+
+    if isinstance(module, nn.Sequential):
+        for i in range(len(module) - 1):
+            conv, bn = module[i], module[i + 1]
+            # timm BatchNormAct2d содержит еще и активацию, такие пары оставляем для torch.jit.freeze
+            if isinstance(conv, nn.Conv2d) and type(bn) is nn.BatchNorm2d:
+                module[i] = fuse_conv_bn_eval(conv, bn)
+                module[i + 1] = nn.Identity()
+
+    return module
+
+
+class InferenceModel(nn.Module):
+
+    '''
+    Обертка над моделью для инференса: вход переводится в channels_last,
+    вызов выполняется в torch.inference_mode.
+
+    Атрибуты anchors и stride (у InspectorGadjetDense) копируются с исходной модели,
+    чтобы detect_faces мог декодировать выход и после экспорта в TorchScript.
+    '''
+
+    def __init__(self, model, channels_last=True, anchors=None, stride=None):
+        super().__init__()
+        self.model = model
+        self.channels_last = channels_last
+        if anchors is not None:
+            self.anchors = anchors
+            self.stride = stride
+
+    def forward(self, x):
+        with torch.inference_mode():
+            if self.channels_last:
+                x = x.contiguous(memory_format=torch.channels_last)
+            return self.model(x)
+
+
+class OnnxModel:
+
+    '''
+    Модель, экспортированная в ONNX, с тем же интерфейсом вызова, что у torch модели (тензор -> тензор).
+    Требует пакет onnxruntime. anchors и stride - как у InferenceModel.
+    '''
+
+    def __init__(self, path, anchors=None, stride=None):
+        try:
+            import onnxruntime
+        except ImportError as error:
+            raise ImportError('ONNX export needs onnxruntime: pip install onnxruntime') from error
+
+        self.session = onnxruntime.InferenceSession(str(path), providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        if anchors is not None:
+            self.anchors = anchors
+            self.stride = stride
+
+    def __call__(self, x):
+        output = self.session.run(None, {self.input_name: x.detach().cpu().numpy()})[0]
+        return torch.from_numpy(output)
+
+    def eval(self):
+        return self
+
+
+def _artifact_path(weights_path, export, channels_last=True):
+    # оптимизированная модель лежит рядом с весами: weights.pth -> weights.torchscript.cl.pt / weights.onnx /
+    # weights.int8.torchscript.pt; формат памяти входит в имя TorchScript, граф трассируется под него
+    root, _ = os.path.splitext(weights_path)
+    layout = 'cl' if channels_last else 'nchw'
+    return {'torchscript': f'{root}.torchscript.{layout}.pt',
+            'onnx': f'{root}.onnx',
+            'int8': f'{root}.int8.torchscript.pt'}[export]
+
+
+def _save_head(artifact_path, anchors, stride):
+    # якоря и шаг сетки плотного детектора в файле рядом с артефактом, у остальных моделей - null
+    with open(artifact_path + '.json', 'w') as head_file:
+        json.dump({'anchors': None if anchors is None else [list(anchor) for anchor in anchors],
+                   'stride': stride}, head_file)
+
+
+def _load_head(artifact_path):
+    with open(artifact_path + '.json') as head_file:
+        head = json.load(head_file)
+    anchors = None if head['anchors'] is None else tuple(tuple(anchor) for anchor in head['anchors'])
+    return anchors, head['stride']
+
+
+def _is_fresh(artifact_path, weights_path):
+    # артефакт используется, только если он новее весов и рядом сохранены anchors и stride
+    return (os.path.exists(artifact_path) and os.path.exists(artifact_path + '.json') and
+            (not os.path.exists(weights_path) or os.path.getmtime(artifact_path) >= os.path.getmtime(weights_path)))
+
+
+def optimize_model(model, example, export=None, artifact_path=None, channels_last=True):
+    """
+    Подготовка модели к инференсу: eval, слияние Conv+BN, channels_last и при необходимости экспорт.
+
+    Parameters:
+    - model (nn.Module): Модель с загруженными весами.
+    - example (torch.Tensor): Пример входа, нужен для трассировки и экспорта.
+    - export (str): None - оставить eager модель, 'torchscript' - torch.jit.trace + torch.jit.freeze,
+      'onnx' - экспорт в ONNX и запуск через onnxruntime.
+    - artifact_path (str): Куда сохранить экспортированную модель.
+    - channels_last (bool): Использовать формат памяти channels_last.
+
+    Returns:
+    Модель, готовая к инференсу.
+
+    """
+
+    anchors, stride = getattr(model, 'anchors', None), getattr(model, 'stride', None)
+
+    model = fuse_conv_bn(model.eval())
+    if channels_last and export != 'onnx':
+        model = model.to(memory_format=torch.channels_last)
+        example = example.contiguous(memory_format=torch.channels_last)
+
+    if export == 'torchscript':
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example)
+            # freeze встраивает веса в граф и сворачивает оставшиеся Conv+BN
+            model = torch.jit.freeze(traced)
+        # torch.jit.optimize_for_inference не используем: его mkldnn граф не сохраняется,
+        # а на CPU с channels_last он оказался медленнее простого freeze
+        if artifact_path:
+            torch.jit.save(model, artifact_path)
+            _save_head(artifact_path, anchors, stride)
+    elif export == 'onnx':
+        torch.onnx.export(model, example, artifact_path, input_names=['input'], output_names=['output'],
+                          dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}})
+        _save_head(artifact_path, anchors, stride)
+        return OnnxModel(artifact_path, anchors, stride)
+    elif export is not None:
+        raise ValueError(f"export must be None, 'torchscript' or 'onnx', got {export!r}")
+
+    return InferenceModel(model, channels_last, anchors, stride)
+
+
+def _load_artifact(artifact_path, export, channels_last):
+    anchors, stride = _load_head(artifact_path)
+    if export == 'onnx':
+        return OnnxModel(artifact_path, anchors, stride)
+    return InferenceModel(torch.jit.load(artifact_path, map_location='cpu'), channels_last, anchors, stride)
+
+
+def _get_models_with_weights():
+    # src.utils (timm, matplotlib, ...) импортируется только если артефактов нет и модели нужно собрать
+    import src.utils as utils
+    return utils.get_models_with_weights()
+
+
+def _build_quantized(model, calibration_batches, artifact_path):
+    # INT8 модель трассируется и сохраняется в TorchScript, channels_last для нее не нужен
+    from src.quantization import quantize_model
+
+    anchors, stride = getattr(model, 'anchors', None), getattr(model, 'stride', None)
+
+    quantized = quantize_model(model.eval(), calibration_batches)
+    with torch.no_grad():
+        quantized = torch.jit.freeze(torch.jit.trace(quantized, calibration_batches[0][:1]))
+    torch.jit.save(quantized, artifact_path)
+    _save_head(artifact_path, anchors, stride)
+    return InferenceModel(quantized, False, anchors, stride)
+
+
+def get_inference_models(export=None, channels_last=True, rebuild=False, quantized=False, calibration=None):
+    """
+    Загрузка моделей детекции и распознавания, готовых к инференсу на CPU.
+
+    Если export задан и рядом с весами уже лежит свежий экспортированный артефакт, он загружается напрямую,
+    без создания InspectorGadjet и timm efficientnet_b1 и без загрузки .pth, поэтому повторный старт быстрый.
+    Иначе модели строятся через get_models_with_weights, оптимизируются и артефакт сохраняется.
+
+    Parameters:
+    - export (str): None, 'torchscript' или 'onnx'.
+    - channels_last (bool): Использовать формат памяти channels_last.
+    - rebuild (bool): Пересоздать артефакты, даже если они свежие.
+    - quantized (bool): Загрузить INT8 модели (статическая квантизация, см. src/quantization.py),
+      они сохраняются рядом с весами как .int8.torchscript.pt, параметр export при этом не используется.
+    - calibration (tuple): Калибровочные батчи (для детектора, для модели эмбеддингов), нужны только при
+      создании INT8 моделей, по умолчанию берутся из датасета с 10к изображениями лиц.
+
+    Returns:
+    tuple: Модель детекции и модель эмбеддингов.
+
+    """
+
+    config = get_options()
+    det_weights, rec_weights = config['path_to_detection_weights'], config['path_to_recognition_weights']
+
+    if quantized:
+        det_artifact, rec_artifact = _artifact_path(det_weights, 'int8'), _artifact_path(rec_weights, 'int8')
+        if not rebuild and _is_fresh(det_artifact, det_weights) and _is_fresh(rec_artifact, rec_weights):
+            print('Loading quantized models from cache')
+            return (_load_artifact(det_artifact, 'torchscript', False),
+                    _load_artifact(rec_artifact, 'torchscript', False))
+
+        if calibration is None:
+            from src.quantization import default_calibration_batches
+            calibration = default_calibration_batches()
+
+        det_model, rec_model = _get_models_with_weights()
+        return (_build_quantized(det_model, calibration[0], det_artifact),
+                _build_quantized(rec_model, calibration[1], rec_artifact))
+
+    if export is not None:
+        det_artifact = _artifact_path(det_weights, export, channels_last)
+        rec_artifact = _artifact_path(rec_weights, export, channels_last)
+        if not rebuild and _is_fresh(det_artifact, det_weights) and _is_fresh(rec_artifact, rec_weights):
+            print('Loading optimized models from cache')
+            return (_load_artifact(det_artifact, export, channels_last),
+                    _load_artifact(rec_artifact, export, channels_last))
+    else:
+        det_artifact = rec_artifact = None
+
+    det_model, rec_model = _get_models_with_weights()
+
+    det_example = torch.rand(1, 3, config['img_size'], config['img_size'])
+    rec_example = torch.rand(1, 3, 160, 160)
+
+    det_model = optimize_model(det_model, det_example, export, det_artifact, channels_last)
+    rec_model = optimize_model(rec_model, rec_example, export, rec_artifact, channels_last)
+
+    return det_model, rec_model
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torchvision.models
 import torch.nn.functional as F
+import torchvision.ops
 
 
 
@@ -203,12 +204,217 @@ class InspectorGadjet(nn.Module):
 
     def forward(self, x):
         x = self.conv_layers(x)
-        x = x.view(x.shape[0], -1)  # Преобразуем в 1D тензор
+        x = torch.flatten(x, 1)  # Преобразуем в 1D тензор (в отличие от view работает и с channels_last)
         # classification_output = self.classifier(x)
         regression_output = self.regressor(x)
         return regression_output
 
 
+# якоря (ширина, высота) в пикселях входа 128x128 и шаг сетки для InspectorGadjetDense
+DENSE_ANCHORS = ((12, 14), (28, 32), (64, 72))
+DENSE_STRIDE = 16
+
+
+class InspectorGadjetDense(nn.Module):
+
+    '''
+    Детектор нескольких лиц на том же сверточном backbone, что и InspectorGadjet.
+
+    Вместо одного вектора [p, x1, y1, x2, y2] на изображение голова выдает предсказания для каждой
+    клетки сетки 8x8 (шаг 16 пикселей для входа 128) и каждого якоря: объектность и смещения рамки.
+    Выход сети "сырой", рамки из него получаются функциями decode_dense_boxes и nms_detections.
+
+    anchors - размеры якорей (ширина, высота) в пикселях входного изображения
+    '''
+
+    def __init__(self, anchors=DENSE_ANCHORS):
+        super(InspectorGadjetDense, self).__init__()
+
+        self.anchors = anchors
+        self.stride = DENSE_STRIDE
+
+        # Основные сверточные слои (как в InspectorGadjet, веса можно перенести через from_detector)
+        self.conv_layers = nn.Sequential(
+            nn.Conv2d(3, 32, kernel_size=3, padding=1),
+            nn.BatchNorm2d(32),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(2, 2),
+
+            nn.Conv2d(32, 64, kernel_size=3, padding=1),
+            nn.BatchNorm2d(64),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(2, 2),
+
+            nn.Conv2d(64, 128, kernel_size=3, padding=1),
+            nn.BatchNorm2d(128),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(2, 2),
+
+            nn.Conv2d(128, 256, kernel_size=3, padding=1),
+            nn.BatchNorm2d(256),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(2, 2),
+
+            nn.Conv2d(256, 512, kernel_size=3, padding=1),
+            nn.BatchNorm2d(512),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(2, 2)
+        )
+
+        # Плотная голова: 5 чисел (p, tx, ty, tw, th) на каждый якорь в каждой клетке
+        self.head = nn.Sequential(
+            nn.Conv2d(512, 256, kernel_size=3, padding=1),
+            nn.BatchNorm2d(256),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(256, len(anchors) * 5, kernel_size=1)
+        )
+
+    @classmethod
+    def from_detector(cls, detector, anchors=DENSE_ANCHORS):
+        # перенос весов backbone из обученного InspectorGadjet
+        model = cls(anchors)
+        model.conv_layers.load_state_dict(detector.conv_layers.state_dict())
+        return model
+
+    def forward(self, x):
+        # последний MaxPool не используем, чтобы сетка была 8x8, а не 4x4
+        # (цикл по слоям, а не срез Sequential, чтобы модель трассировалась torch.fx для квантизации)
+        for layer in list(self.conv_layers)[:-1]:
+            x = layer(x)
+        return self.head(x)  # (B, len(anchors) * 5, S, S)
+
+
+def decode_dense_boxes(raw, anchors=DENSE_ANCHORS, stride=DENSE_STRIDE):
+    """
+    Векторизованное декодирование выхода InspectorGadjetDense в рамки.
+
+    Parameters:
+    - raw (torch.Tensor): Выход сети формы (B, A * 5, S, S).
+    - anchors (tuple): Размеры якорей, те же, что у модели.
+    - stride (int): Шаг сетки в пикселях.
+
+    Returns:
+    tuple: Уверенности формы (B, A * S * S) и рамки [x1, y1, x2, y2] формы (B, A * S * S, 4)
+    в пикселях входного изображения.
+
+    """
+
+    batch_size, _, height, width = raw.shape
+    raw = raw.view(batch_size, len(anchors), 5, height, width)
+
+    grid_y, grid_x = torch.meshgrid(torch.arange(height, device=raw.device, dtype=raw.dtype),
+                                    torch.arange(width, device=raw.device, dtype=raw.dtype), indexing='ij')
+    anchors = torch.tensor(anchors, device=raw.device, dtype=raw.dtype).view(1, -1, 2, 1, 1)
+
+    scores = torch.sigmoid(raw[:, :, 0])
+    center_x = (grid_x + torch.sigmoid(raw[:, :, 1])) * stride
+    center_y = (grid_y + torch.sigmoid(raw[:, :, 2])) * stride
+    # ограничиваем экспоненту, чтобы необученная сеть не давала бесконечных рамок
+    box_width = anchors[:, :, 0] * torch.exp(raw[:, :, 3].clamp(max=4))
+    box_height = anchors[:, :, 1] * torch.exp(raw[:, :, 4].clamp(max=4))
+
+    boxes = torch.stack([center_x - box_width / 2, center_y - box_height / 2,
+                         center_x + box_width / 2, center_y + box_height / 2], dim=-1)
+
+    return scores.reshape(batch_size, -1), boxes.reshape(batch_size, -1, 4)
+
+
+def nms_detections(scores, boxes, score_threshold=0.5, iou_threshold=0.4, max_detections=100):
+    """
+    Батчевый NMS: одна операция torchvision.ops.batched_nms на все изображения батча.
+
+    Parameters:
+    - scores (torch.Tensor): Уверенности формы (B, K).
+    - boxes (torch.Tensor): Рамки формы (B, K, 4).
+    - score_threshold (float): Рамки с меньшей уверенностью отбрасываются до NMS.
+    - iou_threshold (float): Порог IoU для подавления пересекающихся рамок.
+    - max_detections (int): Максимальное количество рамок на изображение.
+
+    Returns:
+    list: Для каждого изображения пара (рамки (N, 4), уверенности (N,)), по убыванию уверенности.
+
+    """
+
+    batch_size = scores.shape[0]
+    image_ids = torch.arange(batch_size, device=scores.device)[:, None].expand_as(scores)
+
+    keep = scores > score_threshold
+    scores, boxes, image_ids = scores[keep], boxes[keep], image_ids[keep]
+
+    kept = torchvision.ops.batched_nms(boxes, scores, image_ids, iou_threshold)
+    scores, boxes, image_ids = scores[kept], boxes[kept], image_ids[kept]
+
+    detections = []
+    for image_id in range(batch_size):
+        mine = image_ids == image_id
+        detections.append((boxes[mine][:max_detections], scores[mine][:max_detections]))
+    return detections
+
+
+def dense_detection_loss(raw, targets, anchors=DENSE_ANCHORS, stride=DENSE_STRIDE, box_weight=5.0):
+    """
+    Функция потерь для InspectorGadjetDense.
+
+    Каждое лицо назначается клетке, в которую попадает его центр, и якорю с наибольшим IoU по размеру.
+    Объектность учится бинарной кросс-энтропией (отдельно по клеткам с лицами и без), рамка - только в назначенных клетках.
+
+    Parameters:
+    - raw (torch.Tensor): Выход сети формы (B, A * 5, S, S).
+    - targets (torch.Tensor): Рамки формы (B, N, 5) в формате [p, x1, y1, x2, y2], строки с p = 0 - пустые
+      (так их дополняет detection_collate из src/dataloaders.py).
+    - anchors (tuple): Размеры якорей, те же, что у модели.
+    - stride (int): Шаг сетки в пикселях.
+    - box_weight (float): Вес потерь по рамкам относительно потерь по объектности.
+
+    Returns:
+    torch.Tensor: Значение функции потерь.
+
+    """
+
+    batch_size, _, height, width = raw.shape
+    raw = raw.view(batch_size, len(anchors), 5, height, width)
+    anchors = torch.tensor(anchors, device=raw.device, dtype=raw.dtype)
+
+    batch_idx, box_idx = (targets[..., 0] > 0).nonzero(as_tuple=True)
+    boxes = targets[batch_idx, box_idx, 1:].to(raw.dtype)
+
+    center_x = (boxes[:, 0] + boxes[:, 2]) / 2
+    center_y = (boxes[:, 1] + boxes[:, 3]) / 2
+    box_width = (boxes[:, 2] - boxes[:, 0]).clamp(min=1)
+    box_height = (boxes[:, 3] - boxes[:, 1]).clamp(min=1)
+
+    cell_x = (center_x / stride).long().clamp(0, width - 1)
+    cell_y = (center_y / stride).long().clamp(0, height - 1)
+
+    # IoU рамки и якоря с общим центром, чтобы выбрать якорь по размеру
+    intersection = (torch.min(box_width[:, None], anchors[None, :, 0]) *
+                    torch.min(box_height[:, None], anchors[None, :, 1]))
+    union = box_width[:, None] * box_height[:, None] + anchors[None, :, 0] * anchors[None, :, 1] - intersection
+    anchor_idx = (intersection / union).argmax(dim=1)
+
+    objectness = torch.zeros_like(raw[:, :, 0])
+    objectness[batch_idx, anchor_idx, cell_y, cell_x] = 1
+    positive = objectness > 0
+
+    # клеток с лицами намного меньше, чем пустых, поэтому усредняем их потери отдельно
+    object_loss = F.binary_cross_entropy_with_logits(raw[:, :, 0], objectness, reduction='none')
+    loss = object_loss[~positive].mean()
+
+    if batch_idx.numel() > 0:
+        loss = loss + object_loss[positive].mean()
+
+        pred = raw[batch_idx, anchor_idx, :, cell_y, cell_x]  # (M, 5)
+        target_xy = torch.stack([center_x / stride - cell_x, center_y / stride - cell_y], dim=1)
+        target_wh = torch.stack([torch.log(box_width / anchors[anchor_idx, 0]),
+                                 torch.log(box_height / anchors[anchor_idx, 1])], dim=1)
+
+        box_loss = (F.mse_loss(torch.sigmoid(pred[:, 1:3]), target_xy) +
+                    F.smooth_l1_loss(pred[:, 3:5], target_wh))
+        loss = loss + box_weight * box_loss
+
+    return loss
+
+
 class ConvEmbedding(nn.Module):
     def __init__(self, pic_size=160, emb_size=512):
         super().__init__()
@@ -254,13 +460,27 @@ class ConvEmbedding(nn.Module):
         return x
 
 class Triplet(nn.Module):
+
+    '''
+    encoder - модель эмбеддингов
+    fused - если True, anchor, pos и neg склеиваются в один батч 3B и энкодер вызывается один раз
+            (батчи крупнее и быстрее, но статистики BatchNorm в режиме обучения считаются по всем трем сразу)
+
+    forward возвращает эмбеддинги anchor, pos и neg, эмбеддинги anchor можно использовать для дистилляции
+    без еще одного прохода энкодера
+    '''
     
-    def __init__(self, encoder):
+    def __init__(self, encoder, fused=False):
         super(Triplet, self).__init__()
         
         self.encoder = encoder
+        self.fused = fused
         
     def forward(self, anchor, pos, neg):
+        if self.fused:
+            embeddings = self.encoder(torch.cat([anchor, pos, neg]))
+            return embeddings.split([len(anchor), len(pos), len(neg)])
+
         anchor_embedding = self.encoder(anchor)
         pos_embedding = self.encoder(pos)
         neg_embedding = self.encoder(neg)
@@ -0,0 +1,312 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+import cv2
+
+from src.config import get_config
+from src.profiling import get_timer
+from src.recognition import prepare_frame, recognize_batch
+
+
+# Офлайн обработка видеофайлов и папок с изображениями без окна и камеры: кадры декодируются заранее
+# в фоновом потоке и проходят через детектор и модель эмбеддингов батчами, результаты пишутся в JSONL или Parquet.
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+
+# маркер конца потока кадров
+_STOP = object()
+
+
+def iter_frames(source, frame_step=1):
+
+    """
+    Кадры видеофайла или изображения папки по порядку.
+
+    Parameters:
+    - source (str): Путь к видеофайлу или к папке с изображениями (сортируются по имени).
+    - frame_step (int): Брать каждый frame_step-й кадр, пропущенные кадры видео не декодируются.
+
+    Returns:
+    generator: Тройки (номер кадра, словарь с 'time' в секундах для видео или 'file' для папки, кадр BGR).
+
+    """
+
+    if os.path.isdir(source):
+        paths = sorted(path for path in Path(source).iterdir() if path.suffix.lower() in IMAGE_EXTENSIONS)
+        for frame_index in range(0, len(paths), frame_step):
+            image = cv2.imread(str(paths[frame_index]))
+            if image is None:
+                print(f"Can't read image {paths[frame_index]}, skipping")
+                continue
+            yield frame_index, {'file': paths[frame_index].name}, image
+        return
+
+    cap = cv2.VideoCapture(str(source))
+    if not cap.isOpened():
+        raise ValueError(f"Can't open video {source}")
+    fps = cap.get(cv2.CAP_PROP_FPS)
+
+    frame_index = 0
+    try:
+        while True:
+            if frame_index % frame_step:
+                # grab без retrieve: кадр читается из файла, но не декодируется
+                if not cap.grab():
+                    break
+            else:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                yield frame_index, ({'time': round(frame_index / fps, 3)} if fps else {}), frame
+            frame_index += 1
+    finally:
+        cap.release()
+
+
+def _decode_ahead(source, batch_size, frame_step, prefetch, timer):
+    # фоновый поток декодирует кадры и готовит вход детектора, пока основной поток считает модели;
+    # в очереди не больше prefetch готовых батчей
+    batches = queue.Queue(maxsize=prefetch)
+    stop_event = threading.Event()
+
+    def put(item):
+        while not stop_event.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker():
+        frames = iter_frames(source, frame_step)
+        try:
+            batch = []
+            while True:
+                with timer.stage('capture'):
+                    item = next(frames, None)
+                if item is None:
+                    break
+                frame_index, meta, frame = item
+
+                with timer.stage('preprocess'):
+                    batch.append((frame_index, meta, prepare_frame(frame)))
+
+                if len(batch) == batch_size:
+                    if not put(batch):
+                        return
+                    batch = []
+            if batch:
+                put(batch)
+            put(_STOP)
+        except Exception as error:
+            put(error)
+        finally:
+            frames.close()
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is _STOP:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # генератор могли не дочитать: останавливаем поток, чтобы он не ждал места в очереди
+        stop_event.set()
+        thread.join(timeout=1)
+
+
+def iter_batch_records(source, model, embedding_model, index, batch_size=16, embed_batch_size=64, threshold=1.2,
+                       det_threshold=0.9, frame_step=1, prefetch=2, timer=None):
+
+    """
+    Распознавание лиц на всех кадрах видео или папки батчами.
+
+    Детектор получает batch_size кадров за вызов, найденные лица всех кадров батча вырезаются
+    и проходят через модель эмбеддингов батчами до embed_batch_size, поиск в базе - одним вызовом на батч
+    (см. recognize_batch в src/recognition.py).
+
+    Parameters:
+    - source (str): Путь к видеофайлу или папке с изображениями.
+    - model: Модель детекции.
+    - embedding_model: Модель для эмбеддингов.
+    - index: EmbeddingIndex или IVFIndex с базой данных людей.
+    - batch_size (int): Количество кадров в батче детектора.
+    - embed_batch_size (int): Максимальный батч модели эмбеддингов.
+    - threshold (float): Порог расстояния, выше которого человек считается неизвестным.
+    - det_threshold (float): Порог уверенности детектора.
+    - frame_step (int): Обрабатывать каждый frame_step-й кадр.
+    - prefetch (int): Сколько батчей кадров декодировать заранее.
+    - timer (StageTimer): Замер стадий (см. src/profiling.py), None - без замеров.
+
+    Returns:
+    generator: Для каждого батча пара (количество кадров, список записей); запись - словарь
+    'frame', 'box' [x1, y1, x2, y2] в пикселях кадра, 'score', 'name', 'distance' и 'time' или 'file'.
+
+    """
+
+    timer = get_timer(timer)
+
+    for batch in _decode_ahead(source, batch_size, frame_step, prefetch, timer):
+        results, scores = recognize_batch([prepared for *_, prepared in batch], model, embedding_model, index,
+                                          threshold, det_threshold, embed_batch_size, timer)
+
+        records = []
+        for (frame_index, meta, _), frame_results, frame_scores in zip(batch, results, scores):
+            for (coord, name, distance), score in zip(frame_results, frame_scores):
+                records.append({'frame': frame_index, **meta, 'box': coord, 'score': round(score, 4),
+                                'name': str(name), 'distance': round(distance, 4)})
+
+        for _ in batch:
+            timer.frame_done()
+        yield len(batch), records
+
+
+def iter_records(source, model, embedding_model, index, **kwargs):
+
+    """
+    Записи (frame, box, score, name, distance, ...) для всех лиц видео или папки по одной,
+    параметры - как у iter_batch_records.
+
+    """
+
+    for _, records in iter_batch_records(source, model, embedding_model, index, **kwargs):
+        yield from records
+
+
+class JsonlWriter:
+    # одна запись json на строку, файл можно читать, пока обработка еще идет
+    def __init__(self, path):
+        self.file = open(path, 'w')
+
+    def write(self, records):
+        for record in records:
+            self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    # записи копятся в row group по row_group_size строк, нужен pyarrow
+    def __init__(self, path, row_group_size=65536):
+        import pyarrow as pa  # необязательная зависимость, нужна только для Parquet
+        import pyarrow.parquet as pq
+
+        self.pa, self.pq = pa, pq
+        self.path = path
+        self.row_group_size = row_group_size
+        self.rows = []
+        self.writer = None
+
+    def write(self, records):
+        self.rows += records
+        if len(self.rows) >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if not self.rows:
+            return
+        table = self.pa.Table.from_pylist(self.rows)
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+        self.rows = []
+
+    def close(self):
+        self._flush()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def open_writer(path):
+    """
+    Запись результатов по расширению файла: .jsonl или .parquet.
+
+    """
+
+    extension = Path(path).suffix.lower()
+    if extension == '.jsonl':
+        return JsonlWriter(path)
+    if extension == '.parquet':
+        return ParquetWriter(path)
+    raise ValueError(f'output must be .jsonl or .parquet, got {path}')
+
+
+def process_source(source, model, embedding_model, index, output, profile=None, **kwargs):
+
+    """
+    Обработка видеофайла или папки с изображениями целиком с записью результатов в файл.
+
+    Parameters:
+    - source (str): Путь к видеофайлу или папке с изображениями.
+    - model: Модель детекции.
+    - embedding_model: Модель для эмбеддингов.
+    - index: EmbeddingIndex или IVFIndex с базой данных людей.
+    - output (str): Файл .jsonl или .parquet.
+    - profile: Замер стадий: None, True или StageTimer (см. src/profiling.py).
+    - kwargs: Остальные параметры iter_batch_records (batch_size, embed_batch_size, threshold, ...).
+
+    Returns:
+    dict: Количество кадров 'frames', лиц 'faces', время 'seconds' и скорость 'fps'.
+
+    """
+
+    timer = get_timer(profile)
+    writer = open_writer(output)
+
+    n_frames, n_faces = 0, 0
+    started_at = time.perf_counter()
+    try:
+        for batch_frames, records in iter_batch_records(source, model, embedding_model, index, timer=timer,
+                                                        **kwargs):
+            writer.write(records)
+            n_frames += batch_frames
+            n_faces += len(records)
+    finally:
+        writer.close()
+    timer.report()
+
+    seconds = time.perf_counter() - started_at
+    return {'frames': n_frames, 'faces': n_faces, 'seconds': seconds, 'fps': n_frames / seconds if seconds else 0.0}
+
+
+def main():
+    from src.gallery import load_index
+    from src.inference import get_inference_models
+
+    parser = argparse.ArgumentParser(description='Offline face recognition for video files and image folders')
+    parser.add_argument('source', help='Видеофайл или папка с изображениями')
+    parser.add_argument('--output', required=True, help='Файл результатов .jsonl или .parquet')
+    parser.add_argument('--gallery', default=None, help='База данных людей, по умолчанию path_to_gallery из config.yaml')
+    parser.add_argument('--batch-size', type=int, default=16, help='Кадров в батче детектора')
+    parser.add_argument('--embed-batch-size', type=int, default=64, help='Лиц в батче модели эмбеддингов')
+    parser.add_argument('--frame-step', type=int, default=1, help='Обрабатывать каждый N-й кадр')
+    parser.add_argument('--threshold', type=float, default=1.2, help='Порог расстояния для unknown')
+    parser.add_argument('--det-threshold', type=float, default=0.9, help='Порог уверенности детектора')
+    parser.add_argument('--export', default=None, choices=['torchscript', 'onnx'], help='Формат моделей')
+    parser.add_argument('--quantized', action='store_true', help='INT8 модели (src/quantization.py)')
+    parser.add_argument('--profile', action='store_true', help='Печатать p50/p95/p99 стадий')
+    args = parser.parse_args()
+
+    model, embedding_model = get_inference_models(export=args.export, quantized=args.quantized)
+    index = load_index(args.gallery or get_config()['path_to_gallery'])
+
+    stats = process_source(args.source, model, embedding_model, index, args.output, profile=args.profile or None,
+                           batch_size=args.batch_size, embed_batch_size=args.embed_batch_size,
+                           threshold=args.threshold, det_threshold=args.det_threshold, frame_step=args.frame_step)
+    print(f"{stats['frames']} frames, {stats['faces']} faces in {stats['seconds']:.1f} s ({stats['fps']:.1f} fps)"
+          f" -> {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+import queue
+import threading
+import time
+
+import cv2
+from numpy import inf
+
+from src.profiling import NULL_TIMER
+
+
+class LatestQueue:
+
+    '''
+    Ограниченная очередь между стадиями конвейера, которая при переполнении выбрасывает самый старый элемент.
+
+    Так медленная стадия всегда получает самый свежий кадр, а быстрая никогда не блокируется на медленной.
+
+    maxsize - сколько элементов хранить, 1 - только последний
+    '''
+
+    def __init__(self, maxsize=1):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def put(self, item):
+        with self._lock:
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    return
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+
+    def get(self, timeout=None):
+        return self._queue.get(timeout=timeout)
+
+    def get_nowait(self):
+        return self._queue.get_nowait()
+
+
+# маркер конца потока, который стадии передают друг другу
+STOP = object()
+
+
+def _capture_loop(cap, output, stop_event, limit, timer):
+    # стадия захвата: читает кадры с камеры с ее собственной скоростью;
+    # камера освобождается в этом же потоке, чтобы release не пересекся с cap.read()
+    frame_id = 0
+    try:
+        while not stop_event.is_set() and frame_id <= limit:
+            with timer.stage('capture'):
+                ret, frame = cap.read()
+            if not ret:
+                print("Failed to grab frame")
+                break
+            output.put((frame_id, time.perf_counter(), frame))
+            frame_id += 1
+    finally:
+        cap.release()
+        output.put(STOP)
+
+
+def _inference_loop(process_fn, input_queue, output, stop_event, max_latency, counters):
+    # стадия инференса: всегда берет самый свежий кадр, кадры старше max_latency пропускает
+    # и считает в counters['dropped_deadline']; ошибка process_fn сохраняется в counters['error']
+    # и останавливает конвейер, run_pipeline пробрасывает ее дальше
+    try:
+        while not stop_event.is_set():
+            try:
+                item = input_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is STOP:
+                break
+
+            frame_id, captured_at, frame = item
+            if max_latency is not None and time.perf_counter() - captured_at > max_latency:
+                counters['dropped_deadline'] += 1
+                continue
+
+            results = process_fn(frame)
+            output.put((frame_id, captured_at, frame, results))
+    except Exception as error:
+        counters['error'] = error
+        stop_event.set()
+    finally:
+        output.put(STOP)
+
+
+def run_pipeline(source, process_fn, sink_fn, limit=inf, queue_size=1, max_latency=None, timer=NULL_TIMER):
+
+    """
+    Запуск конвейера из трех стадий: захват кадров (поток), инференс (поток) и вывод (текущий поток).
+
+    Стадии соединены ограниченными очередями LatestQueue: при нагрузке старые кадры выбрасываются,
+    поэтому задержка от захвата до вывода ограничена, а камера никогда не ждет модель.
+    Вывод выполняется в вызывающем потоке, потому что cv2.imshow работает только из главного потока.
+    Если process_fn падает, конвейер останавливается и ошибка пробрасывается из run_pipeline.
+
+    Parameters:
+    - source: Источник видео для cv2.VideoCapture, 0 - камера ноутбука.
+    - process_fn (callable): Функция кадр -> результаты (например, recognize_frame с моделями).
+    - sink_fn (callable): Функция (кадр, результаты, задержка в секундах) -> bool, False останавливает конвейер.
+    - limit (int): Максимальное количество захваченных кадров.
+    - queue_size (int): Размер очередей между стадиями.
+    - max_latency (float): Кадры, пролежавшие в очереди дольше, пропускаются без инференса (секунды).
+    - timer (StageTimer): Замер стадий capture и display (стадии инференса замеряет process_fn),
+      FPS считается по показанным кадрам (см. src/profiling.py).
+
+    Returns:
+    dict: Статистика: количество показанных кадров, fps, средняя и максимальная задержка,
+    количество выброшенных кадров (устаревших в очередях и пропущенных по max_latency).
+
+    """
+
+    cap = cv2.VideoCapture(source)
+    captured, processed = LatestQueue(queue_size), LatestQueue(queue_size)
+    stop_event = threading.Event()
+    counters = {'dropped_deadline': 0, 'error': None}
+
+    threads = [
+        threading.Thread(target=_capture_loop, args=(cap, captured, stop_event, limit, timer), daemon=True),
+        threading.Thread(target=_inference_loop,
+                         args=(process_fn, captured, processed, stop_event, max_latency, counters), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    shown, latencies = 0, []
+    started_at = time.perf_counter()
+    try:
+        while True:
+            try:
+                item = processed.get(timeout=0.1)
+            except queue.Empty:
+                if not any(thread.is_alive() for thread in threads):
+                    break
+                continue
+            if item is STOP:
+                break
+
+            _, captured_at, frame, results = item
+            latency = time.perf_counter() - captured_at
+            latencies.append(latency)
+            shown += 1
+
+            with timer.stage('display'):
+                keep_running = sink_fn(frame, results, latency)
+            timer.frame_done()
+
+            if keep_running is False:
+                break
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join(timeout=1)
+
+    if counters['error'] is not None:
+        raise counters['error']
+
+    elapsed = time.perf_counter() - started_at
+    return {
+        'frames': shown,
+        'fps': shown / elapsed if elapsed > 0 else 0.0,
+        'mean_latency': sum(latencies) / len(latencies) if latencies else 0.0,
+        'max_latency': max(latencies) if latencies else 0.0,
+        'dropped_captured': captured.dropped,
+        'dropped_processed': processed.dropped,
+        'dropped_deadline': counters['dropped_deadline'],
+    }
@@ -0,0 +1,207 @@
+import threading
+import time
+from contextlib import nullcontext
+
+import numpy as np
+
+
+# стадии обработки кадра камеры в порядке выполнения
+STAGES = ['capture', 'preprocess', 'detector', 'postprocess', 'crop', 'embedder', 'search', 'display']
+
+
+class RingBuffer:
+
+    '''
+    Кольцевой буфер фиксированного размера для последних значений (память не растет со временем работы камеры).
+
+    size - сколько последних значений хранить
+    '''
+
+    def __init__(self, size=1024):
+        self.data = np.zeros(size, dtype=np.float64)
+        self.size = size
+        self.count = 0
+
+    def append(self, value):
+        self.data[self.count % self.size] = value
+        self.count += 1
+
+    def values(self):
+        # значения в порядке записи
+        if self.count <= self.size:
+            return self.data[:self.count].copy()
+        start = self.count % self.size
+        return np.concatenate([self.data[start:], self.data[:start]])
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+
+class _Stage:
+    # контекстный менеджер замера одной стадии, отдельный класс дешевле, чем @contextmanager
+    __slots__ = ('timer', 'name', 'started_at')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.record(self.name, time.perf_counter() - self.started_at)
+        return False
+
+
+class StageTimer:
+
+    '''
+    Замер длительности стадий обработки кадров (захват, подготовка кадра, детектор, декодирование рамок,
+    вырезание лиц, эмбеддинги, поиск, вывод) в кольцевые буферы последних size кадров.
+
+    Скользящие p50/p95/p99 каждой стадии и FPS (по моментам окончания кадров) возвращает summary. Если задан
+    log_interval, то раз в log_interval секунд сводка передается в callback или, если его нет, печатается строкой.
+
+    size - сколько последних замеров хранить для каждой стадии
+    log_interval - период сводки в секундах, None - только по вызову summary
+    callback - функция (summary) -> None вместо печати, например для отправки метрик
+    '''
+
+    enabled = True
+
+    def __init__(self, size=1024, log_interval=5.0, callback=None):
+        self.size = size
+        self.log_interval = log_interval
+        self.callback = callback
+
+        self.buffers = {}
+        self.frame_ends = RingBuffer(size)
+        # стадии пишутся из потоков конвейера (src/pipeline.py), а сводка читается из потока вывода
+        self._lock = threading.Lock()
+        self._last_report = time.perf_counter()
+
+    def stage(self, name):
+        """
+        Контекстный менеджер, который записывает длительность блока в стадию name.
+
+        """
+
+        return _Stage(self, name)
+
+    def record(self, name, seconds):
+        with self._lock:
+            buffer = self.buffers.get(name)
+            if buffer is None:
+                buffer = self.buffers[name] = RingBuffer(self.size)
+            buffer.append(seconds)
+
+    def frame_done(self):
+        """
+        Отметка окончания обработки кадра (для FPS), при необходимости - периодическая сводка.
+
+        """
+
+        now = time.perf_counter()
+        with self._lock:
+            self.frame_ends.append(now)
+
+        if self.log_interval is not None and now - self._last_report >= self.log_interval:
+            self._last_report = now
+            self.report()
+
+    def summary(self):
+        """
+        Скользящая статистика по последним size кадрам.
+
+        Returns:
+        dict: 'fps', 'frames' (всего кадров) и 'stages': стадия -> {'p50', 'p95', 'p99', 'mean'} в миллисекундах
+        и 'count' (всего замеров).
+
+        """
+
+        with self._lock:
+            values = {name: (buffer.values(), buffer.count) for name, buffer in self.buffers.items()}
+            frame_ends, frames = self.frame_ends.values(), self.frame_ends.count
+
+        stages = {}
+        # сначала известные стадии в порядке выполнения, потом остальные
+        for name in sorted(values, key=lambda name: (STAGES.index(name) if name in STAGES else len(STAGES), name)):
+            durations, count = values[name]
+            p50, p95, p99 = np.percentile(durations * 1000, [50, 95, 99])
+            stages[name] = {'p50': p50, 'p95': p95, 'p99': p99, 'mean': durations.mean() * 1000, 'count': count}
+
+        elapsed = frame_ends[-1] - frame_ends[0] if len(frame_ends) > 1 else 0.0
+        fps = (len(frame_ends) - 1) / elapsed if elapsed > 0 else 0.0
+
+        return {'fps': fps, 'frames': frames, 'stages': stages}
+
+    def report(self):
+        summary = self.summary()
+        if self.callback is not None:
+            self.callback(summary)
+        else:
+            print(format_summary(summary))
+
+    def reset(self):
+        with self._lock:
+            self.buffers = {}
+            self.frame_ends = RingBuffer(self.size)
+
+
+class NullTimer:
+
+    '''
+    Выключенный StageTimer: stage возвращает один и тот же пустой контекстный менеджер, остальное ничего не делает,
+    поэтому без профилирования на кадр тратится только несколько вызовов пустых методов.
+    '''
+
+    enabled = False
+    _context = nullcontext()
+
+    def stage(self, name):
+        return self._context
+
+    def record(self, name, seconds):
+        pass
+
+    def frame_done(self):
+        pass
+
+    def report(self):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def get_timer(profile):
+    """
+    Таймер для параметра profile функций камеры.
+
+    Parameters:
+    - profile: None или False - без замеров, True - StageTimer с параметрами по умолчанию, или готовый StageTimer.
+
+    Returns:
+    StageTimer | NullTimer: Таймер.
+
+    """
+
+    if profile is None or profile is False:
+        return NULL_TIMER
+    if profile is True:
+        return StageTimer()
+    return profile
+
+
+def format_summary(summary):
+    """
+    Сводка StageTimer.summary одной строкой, например:
+    fps 14.2 | detector p50 20.1 p95 25.3 p99 31.0 ms | embedder p50 35.2 ...
+
+    """
+
+    parts = [f"fps {summary['fps']:.1f}"]
+    for name, stats in summary['stages'].items():
+        parts.append(f"{name} p50 {stats['p50']:.1f} p95 {stats['p95']:.1f} p99 {stats['p99']:.1f} ms")
+    return ' | '.join(parts)
@@ -0,0 +1,153 @@
+import copy
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from src.recognition import crop_batch
+
+
+def quantize_model(model, calibration_batches, example=None, backend=None):
+    """
+    Статическая пост-тренировочная квантизация модели в INT8 (FX graph mode).
+
+    В модель вставляются наблюдатели, через нее прогоняются калибровочные батчи, чтобы собрать
+    диапазоны активаций, после чего свертки и линейные слои заменяются на квантизованные.
+
+    Parameters:
+    - model (nn.Module): Модель с загруженными весами (не меняется, квантизуется копия).
+    - calibration_batches (list): Батчи входов (тензоры float32) для калибровки.
+    - example (torch.Tensor): Пример входа для трассировки, по умолчанию первый калибровочный батч.
+    - backend (str): Квантизованный backend ('x86', 'fbgemm', 'qnnpack'), по умолчанию текущий в torch.
+
+    Returns:
+    nn.Module: Квантизованная модель для CPU.
+
+    """
+
+    backend = backend or torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+
+    example = calibration_batches[0][:1] if example is None else example
+    prepared = prepare_fx(copy.deepcopy(model).eval(), get_default_qconfig_mapping(backend), (example,))
+
+    with torch.no_grad():
+        for batch in calibration_batches:
+            prepared(batch)
+
+    return convert_fx(prepared)
+
+
+def detection_calibration_batches(dataset, n_images=256, batch_size=32, seed=0):
+    """
+    Калибровочные батчи для детектора из датасета детекции (с теми же преобразованиями, что при обучении).
+
+    Parameters:
+    - dataset: Датасет детекции, __getitem__ возвращает (изображение, рамки).
+    - n_images (int): Сколько изображений взять.
+    - batch_size (int): Размер батча.
+    - seed (int): Зерно генератора для выбора изображений.
+
+    Returns:
+    list: Батчи изображений (B, 3, img_size, img_size).
+
+    """
+
+    rows = np.random.default_rng(seed).permutation(len(dataset))[:n_images]
+    images = torch.stack([dataset[int(row)][0] for row in rows]).float()
+    return list(images.split(batch_size))
+
+
+def recognition_calibration_batches(dataset, n_images=256, batch_size=32, size=160, scale=1.5, seed=0):
+    """
+    Калибровочные батчи для модели эмбеддингов: лица, вырезанные из изображений датасета детекции
+    в исходном разрешении так же, как recognize_frame вырезает их из полного кадра камеры.
+
+    Parameters:
+    - dataset: Датасет детекции с методом load_original (изображение RGB uint8 в исходном разрешении и рамки
+      в его пикселях), например TenThousandFaceDataSet.
+    - n_images (int): Сколько лиц взять.
+    - batch_size (int): Размер батча.
+    - size (int): Размер вырезанного лица.
+    - scale (float): Во сколько раз область вырезания больше рамки.
+    - seed (int): Зерно генератора для выбора изображений.
+
+    Returns:
+    list: Батчи лиц (B, 3, size, size).
+
+    """
+
+    faces = []
+    for row in np.random.default_rng(seed).permutation(len(dataset)):
+        img, boxes = dataset.load_original(int(row))
+        if len(boxes) == 0:
+            continue
+        pic = torch.from_numpy(img).permute(2, 0, 1).float() / 255  # как tf.ToTensor()
+        faces.append(crop_batch(pic, torch.from_numpy(boxes), scale=scale, size=size))
+        if sum(len(face) for face in faces) >= n_images:
+            break
+
+    return list(torch.cat(faces)[:n_images].split(batch_size))
+
+
+def default_calibration_batches(n_images=256, batch_size=32):
+    """
+    Калибровочные батчи для детектора и модели эмбеддингов из датасета с 10к изображениями лиц
+    (без аугментаций albumentations).
+
+    Returns:
+    tuple: Батчи для детектора и батчи для модели эмбеддингов.
+
+    """
+
+    import src.dataloaders as dataloaders
+
+    dataset = dataloaders.TenThousandFaceDataSet(
+        csv_file=dataloaders.csv_file_path_for_ten_thousand_dataset,
+        image_dir=dataloaders.image_dir_for_ten_thousand_dataset,
+        transform=dataloaders.transform)
+
+    return (detection_calibration_batches(dataset, n_images, batch_size),
+            recognition_calibration_batches(dataset, n_images, batch_size))
+
+
+def compare_embeddings(float_model, quantized_model, batches, index=None, threshold=1.2):
+    """
+    Проверка точности квантизованной модели эмбеддингов относительно исходной.
+
+    Parameters:
+    - float_model (nn.Module): Исходная модель.
+    - quantized_model (nn.Module): Квантизованная модель.
+    - batches (list): Батчи лиц для проверки (лучше не те, что использовались для калибровки).
+    - index: EmbeddingIndex или IVFIndex с базой данных людей, если задан, то считается,
+      у какой доли лиц изменился результат распознавания.
+    - threshold (float): Порог расстояния для распознавания.
+
+    Returns:
+    dict: Средний, минимальный и 1%-квантиль косинуса между эмбеддингами и доля изменившихся ответов.
+
+    """
+
+    float_embeddings, quantized_embeddings = [], []
+    with torch.no_grad():
+        for batch in batches:
+            float_embeddings.append(float_model(batch).float())
+            quantized_embeddings.append(quantized_model(batch).float())
+    float_embeddings = torch.cat(float_embeddings)
+    quantized_embeddings = torch.cat(quantized_embeddings)
+
+    cosine = F.cosine_similarity(float_embeddings, quantized_embeddings, dim=1)
+    report = {
+        'mean_cosine': cosine.mean().item(),
+        'min_cosine': cosine.min().item(),
+        'p01_cosine': torch.quantile(cosine, 0.01).item(),
+    }
+
+    if index is not None:
+        float_names, _ = index.search(float_embeddings, k=1, threshold=threshold)
+        quantized_names, _ = index.search(quantized_embeddings, k=1, threshold=threshold)
+        report['match_changed'] = float(np.mean(float_names[:, 0] != quantized_names[:, 0]))
+
+    return report
@@ -0,0 +1,700 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import torch
+from numpy import inf
+import torchvision.ops
+import torchvision.transforms as tf
+from torchvision import transforms
+
+import src.models as models
+from src.config import get_config
+from src.gallery import load_index, open_store
+from src.pipeline import run_pipeline
+from src.profiling import NULL_TIMER, get_timer
+
+
+# Модуль для процессов, которые только распознают лица (камера, сервисы): здесь нет импортов для обучения
+# и графиков (timm, matplotlib, pandas), а config.yaml читается при первом обращении, а не при импорте.
+# Те же функции доступны и из src.utils.
+
+
+def normalize(x):
+    return x / 255.0
+
+
+transform = transforms.Compose([
+    transforms.ToTensor(),
+    transforms.Lambda(normalize), # normalization
+])
+
+
+# функция изменения размеров bbox под размер изображения с камеры 
+def rescale_coordinates(bbox, size):
+    # Извлекаем координаты из тензора
+    height, width = size[:2]
+    # height, width = height *1.25, width *1.7
+    x1, y1, x2, y2 = bbox
+    
+    # Масштабирование координат
+    x1 = int((x1 / get_config()['img_size']) * width)
+    y1 = int((y1 / get_config()['img_size']) * height)
+    x2 = int((x2 / get_config()['img_size']) * width)
+    y2 = int((y2 / get_config()['img_size']) * height)
+    
+
+    return [x1, y1, x2, y2]
+
+
+def detect_frame(frame, model, timer=NULL_TIMER):
+
+    """
+    Детекция лица на кадре с камеры.
+
+    Parameters:
+    - frame (np.ndarray): Кадр в формате BGR (как его отдает cv2).
+    - model: Модель, выдающая [p, x1, y1, x2, y2] для изображения get_config()['img_size'].
+    - timer (StageTimer): Замер стадий preprocess и detector (см. src/profiling.py).
+
+    Returns:
+    tuple: Предсказание модели для кадра (тензор из 5 чисел) и кадр в RGB.
+
+    """
+
+    with timer.stage('preprocess'):
+        # Преобразуем изображение из BGR в RGB
+        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+        # Изменяем размер изображения до 128x128
+        resized_frame = cv2.resize(rgb_frame, (get_config()['img_size'], get_config()['img_size']))
+
+        pic_tens = transform(resized_frame)
+
+    with timer.stage('detector'), torch.no_grad():
+        res = model(pic_tens.unsqueeze(0))
+
+    return res[0], rgb_frame
+
+
+def detections_from_output(res, model, det_threshold=0.9):
+
+    """
+    Рамки лиц из выхода детектора для батча кадров.
+
+    Parameters:
+    - res (torch.Tensor): Выход детектора: (B, 5) у InspectorGadjet или (B, A * 5, S, S) у InspectorGadjetDense.
+    - model: Модель детекции (из нее берутся anchors и stride плотного выхода).
+    - det_threshold (float): Порог уверенности детектора.
+
+    Returns:
+    list: Для каждого кадра пара (рамки (N, 4) в пикселях входа детектора, уверенности (N,)).
+
+    """
+
+    if res.dim() == 4:
+        # плотный выход (B, A * 5, S, S)
+        anchors = getattr(model, 'anchors', models.DENSE_ANCHORS)
+        stride = getattr(model, 'stride', models.DENSE_STRIDE)
+        scores, boxes = models.decode_dense_boxes(res, anchors, stride)
+        return models.nms_detections(scores, boxes, score_threshold=det_threshold)
+
+    # InspectorGadjet находит не больше одного лица на кадр
+    found = res[:, 0] > det_threshold
+    return [(res[i, None, 1:], res[i, :1]) if found[i] else (res.new_empty((0, 4)), res.new_empty(0))
+            for i in range(len(res))]
+
+
+def detect_faces(frame, model, det_threshold=0.9, timer=NULL_TIMER):
+
+    """
+    Поиск всех лиц на кадре за один проход детектора.
+
+    Для InspectorGadjet (выход [p, x1, y1, x2, y2]) находится не больше одного лица,
+    для InspectorGadjetDense выход декодируется в рамки и фильтруется NMS.
+
+    Parameters:
+    - frame (np.ndarray): Кадр в формате BGR.
+    - model: Модель детекции.
+    - det_threshold (float): Порог уверенности детектора.
+    - timer (StageTimer): Замер стадий preprocess, detector и postprocess (декодирование рамок и NMS).
+
+    Returns:
+    tuple: Список рамок [x1, y1, x2, y2] в координатах кадра и кадр в RGB.
+
+    """
+
+    res, rgb_frame = detect_frame(frame, model, timer)
+
+    with timer.stage('postprocess'):
+        boxes, _ = detections_from_output(res.unsqueeze(0), model, det_threshold)[0]
+        coords = [rescale_coordinates(box, frame.shape) for box in boxes]
+
+    return coords, rgb_frame
+
+
+def draw_detections(frame, results):
+    # рисует рамки и имена на кадре, results - список (coord, name, distance)
+    for coord, name, _ in results:
+        cv2.rectangle(frame, (coord[0], coord[1]), (coord[2], coord[3]), (0, 0, 255), 2)
+        if name is not None:
+            cv2.putText(frame , f'{name}', (coord[0], coord[1]), cv2.FONT_HERSHEY_SIMPLEX, fontScale=1, thickness = 2, color = (0, 0, 255))
+    return frame
+
+
+def _show_frame(frame, results, latency=None):
+    # стадия вывода для камеры: False, если нажата q
+    cv2.imshow("Camera Feed with BBox", draw_detections(frame, results))
+    return not (cv2.waitKey(1) & 0xFF == ord('q'))
+
+
+def cam_capture(source=0, model=None, bbox_func=None, limit=inf, pipelined=False, det_threshold=-inf, profile=None):
+
+    """""
+
+
+    source - источник видео, если 0,то это камера ноутбука
+    model - модель, выдающая координаты
+    bbox_func - функция, котороая строит изображение с bounding box'ом на основе предиктов модели
+    limit - количество милисекунд, в течение которых работает камера
+    pipelined - если True, то захват, детекция и вывод работают параллельно (см. src/pipeline.py)
+    det_threshold - порог уверенности детектора, по умолчанию рамка InspectorGadjet рисуется всегда
+                    (для InspectorGadjetDense нужно задать порог, например 0.5)
+    profile - замер длительности стадий (см. src/profiling.py): True - сводка p50/p95/p99 и FPS печатается
+              раз в 5 секунд и в конце, или готовый StageTimer со своим периодом и callback.
+              С профилированием рамки каждого кадра не печатаются
+
+    """""
+
+    timer = get_timer(profile)
+
+    if pipelined:
+        def process(frame):
+            coords, _ = detect_faces(frame, model, det_threshold, timer)
+            return [(coord, None, None) for coord in coords]
+
+        stats = run_pipeline(source, process, _show_frame, limit=limit, timer=timer)
+        cv2.destroyAllWindows()
+        timer.report()
+        return stats
+
+    cap = cv2.VideoCapture(source)
+    i = 0 
+
+    while i<=limit:
+
+        with timer.stage('capture'):
+            ret, frame = cap.read()
+
+        if not ret:
+            print("Failed to grab frame")
+            break
+
+        coords, _ = detect_faces(frame, model, det_threshold, timer)
+        if not timer.enabled:
+            print(coords)
+
+        with timer.stage('display'):
+            keep_running = _show_frame(frame, [(coord, None, None) for coord in coords])
+        timer.frame_done()
+
+        if not keep_running:
+            break
+        i += 1
+       
+
+    cap.release()
+    cv2.destroyAllWindows()
+    timer.report()
+
+
+def crop(pic, coords, scale=2, size=256):
+    
+    '''
+    Обрезает изображение вокруг заданных координат и берет площадь не только по рамкам, а вокруг или внутри. 
+
+    Параметры:
+    pic (tensor): Входное изображение.
+    coords (list): Список координат [x_min, y_min, x_max, y_max] рамки.
+    scale (float): Фактор скалирования рамки (во сколько раз обрезанное изображение больше рамки). По умолчанию 2.
+    size (int): Размер выходного изображения. По умолчанию 256.
+
+    Возвращает:
+    tensor: Обрезанное и измененное по размеру изображение.
+    '''
+    
+    pic_width = pic.shape[2]
+    pic_height = pic.shape[1]
+        
+    
+    center = (0.5*(coords[2]+coords[0]), 
+              0.5*(coords[3]+coords[1]))
+    
+    width = scale*(coords[2]-coords[0])
+    height = scale*(coords[3]-coords[1])
+    
+    side = min(max(width, height), min(pic_width, pic_height))
+    
+    bot_right = [min(center[0]+side/2, pic_width), 
+                 min(center[1]+side/2, pic_height)]
+    
+    x0 = max(0, bot_right[0] - side)
+    y0 = max(0, bot_right[1] - side)
+    
+    res = tf.functional.resized_crop(pic, 
+                                     int(y0), 
+                                     int(x0), 
+                                     int(min(side, pic_height)), 
+                                     int(min(side, pic_width)), 
+                                     size=size,
+                                     antialias=True)
+    
+    return res
+
+
+def crop_batch(pic, boxes, scale=2, size=256):
+
+    '''
+    Векторизованная версия crop для всех лиц кадра сразу: те же квадратные области, что и в crop,
+    вырезаются и приводятся к размеру size одной операцией torchvision.ops.roi_align.
+
+    Параметры:
+    pic (tensor): Входное изображение (3, H, W).
+    boxes (tensor): Рамки (N, 4) в формате [x_min, y_min, x_max, y_max] в пикселях pic.
+    scale (float): Фактор скалирования рамки (во сколько раз обрезанное изображение больше рамки). По умолчанию 2.
+    size (int): Размер выходного изображения. По умолчанию 256.
+
+    Возвращает:
+    tensor: Батч обрезанных изображений (N, 3, size, size).
+    '''
+
+    pic_height, pic_width = pic.shape[1], pic.shape[2]
+    boxes = torch.as_tensor(boxes, dtype=pic.dtype, device=pic.device).reshape(-1, 4)
+
+    center_x = 0.5*(boxes[:, 2]+boxes[:, 0])
+    center_y = 0.5*(boxes[:, 3]+boxes[:, 1])
+
+    width = scale*(boxes[:, 2]-boxes[:, 0])
+    height = scale*(boxes[:, 3]-boxes[:, 1])
+
+    side = torch.max(width, height).clamp(max=min(pic_width, pic_height))
+
+    x0 = ((center_x+side/2).clamp(max=pic_width) - side).clamp(min=0)
+    y0 = ((center_y+side/2).clamp(max=pic_height) - side).clamp(min=0)
+
+    # первый столбец - номер изображения в батче, у нас изображение одно
+    rois = torch.stack([torch.zeros_like(x0), x0, y0, x0+side, y0+side], dim=1)
+
+    # sampling_ratio=-1: количество точек на ячейку подбирается по размеру области, это работает как сглаживание
+    return torchvision.ops.roi_align(pic.unsqueeze(0), rois, output_size=size,
+                                     spatial_scale=1.0, sampling_ratio=-1, aligned=True)
+
+
+def recognize_frame(frame, model, embedding_model, index, threshold=1.2, det_threshold=0.9, timer=NULL_TIMER):
+
+    """
+    Детекция и распознавание всех лиц на одном кадре.
+
+    Parameters:
+    - frame (np.ndarray): Кадр в формате BGR.
+    - model: Модель, выдающая координаты.
+    - embedding_model: Модель для эмбеддингов.
+    - index: EmbeddingIndex или IVFIndex с базой данных людей.
+    - threshold (float): Порог расстояния, выше которого человек считается неизвестным.
+    - det_threshold (float): Порог уверенности детектора.
+    - timer (StageTimer): Замер стадий (см. src/profiling.py).
+
+    Returns:
+    list: Список (coord, name, distance) для найденных лиц, coord в координатах кадра.
+
+    """
+
+    coords, rgb_frame = detect_faces(frame, model, det_threshold, timer)
+    if not coords:
+        return []
+
+    # все лица кадра вырезаются и проходят через модель эмбеддингов одним батчем
+    with timer.stage('crop'):
+        cropped = crop_batch(tf.ToTensor()(rgb_frame), torch.tensor(coords, dtype=torch.float32), size=160, scale=1.5)
+
+    with timer.stage('embedder'), torch.no_grad():
+        embeddings = embedding_model(cropped)
+
+    with timer.stage('search'):
+        names, distances = index.search(embeddings, k=1, threshold=threshold)
+    return [(coord, names[i, 0], float(distances[i, 0])) for i, coord in enumerate(coords)]
+
+
+def prepare_frame(frame):
+
+    """
+    Подготовка кадра к recognize_batch: кадр в RGB и вход детектора (как в detect_frame).
+    Можно вызывать в потоках захвата, cv2 отпускает GIL.
+
+    Parameters:
+    - frame (np.ndarray): Кадр в формате BGR.
+
+    Returns:
+    tuple: Кадр в RGB и тензор (3, img_size, img_size) для детектора.
+
+    """
+
+    rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    img_size = get_config()['img_size']
+    return rgb_frame, transform(cv2.resize(rgb_frame, (img_size, img_size)))
+
+
+def recognize_batch(prepared, model, embedding_model, index, threshold=1.2, det_threshold=0.9, embed_batch_size=64,
+                    timer=NULL_TIMER):
+
+    """
+    Детекция и распознавание лиц на батче кадров: один вызов детектора на все кадры, лица всех кадров
+    проходят через модель эмбеддингов батчами до embed_batch_size, поиск в базе - один на батч.
+    Кадры могут быть разного размера.
+
+    Parameters:
+    - prepared (list): Пары (кадр RGB, вход детектора) из prepare_frame.
+    - model: Модель детекции.
+    - embedding_model: Модель для эмбеддингов.
+    - index: EmbeddingIndex или IVFIndex с базой данных людей.
+    - threshold (float): Порог расстояния, выше которого человек считается неизвестным.
+    - det_threshold (float): Порог уверенности детектора.
+    - embed_batch_size (int): Максимальный батч модели эмбеддингов.
+    - timer (StageTimer): Замер стадий (см. src/profiling.py).
+
+    Returns:
+    tuple: Для каждого кадра список (coord, name, distance), как у recognize_frame,
+    и для каждого кадра список уверенностей детектора для тех же лиц.
+
+    """
+
+    with timer.stage('detector'), torch.no_grad():
+        res = model(torch.stack([det_input for _, det_input in prepared]))
+
+    with timer.stage('postprocess'):
+        detections = detections_from_output(res, model, det_threshold)
+
+    frame_coords, frame_scores, crops = [], [], []
+    with timer.stage('crop'):
+        for (rgb_frame, _), (boxes, scores) in zip(prepared, detections):
+            coords = [rescale_coordinates(box, rgb_frame.shape) for box in boxes]
+            frame_coords.append(coords)
+            frame_scores.append([float(score) for score in scores])
+            if coords:
+                pic = torch.from_numpy(rgb_frame).permute(2, 0, 1).float().div_(255)  # как tf.ToTensor()
+                crops.append(crop_batch(pic, torch.tensor(coords, dtype=torch.float32), size=160, scale=1.5))
+
+    if not crops:
+        return [[] for _ in prepared], frame_scores
+
+    crops = torch.cat(crops)
+    with timer.stage('embedder'), torch.no_grad():
+        embeddings = torch.cat([embedding_model(crops[start:start + embed_batch_size])
+                                for start in range(0, len(crops), embed_batch_size)])
+
+    with timer.stage('search'):
+        names, distances = index.search(embeddings, k=1, threshold=threshold)
+
+    results, i = [], 0
+    for coords in frame_coords:
+        results.append([(coord, names[i + j, 0], float(distances[i + j, 0])) for j, coord in enumerate(coords)])
+        i += len(coords)
+    return results, frame_scores
+
+
+def recognition_cam(source=0, 
+                model=None,
+                embedding_model=None, 
+                database_path = None,
+                limit=inf,
+                index=None,
+                threshold=1.2,
+                pipelined=False,
+                max_latency=None,
+                profile=None):
+
+    """""
+    source - источник видео, если 0,то это камера ноутбука
+    model - модель, выдающая координаты
+    embedding_model - модель для эмбеддингов
+    database_path = путь к папке хранилища GalleryStore или к базе данных в формате csv
+    limit - количество милисекунд, в течение которых работает камера
+    index - готовый EmbeddingIndex, если не задан, то загружается из database_path один раз перед циклом
+    threshold - порог расстояния, выше которого человек считается неизвестным
+    pipelined - если True, то захват, распознавание и вывод работают параллельно и старые кадры
+                выбрасываются, задержка от камеры до экрана остается ограниченной (см. src/pipeline.py)
+    max_latency - только для pipelined: кадры старше стольких секунд пропускаются без инференса
+    profile - замер длительности стадий (см. src/profiling.py): True - сводка p50/p95/p99 и FPS печатается
+              раз в 5 секунд и в конце, или готовый StageTimer со своим периодом и callback
+
+    """""
+
+    if index is None:
+        index = load_index(database_path)
+
+    timer = get_timer(profile)
+
+    def process(frame):
+        return recognize_frame(frame, model, embedding_model, index, threshold, timer=timer)
+
+    if pipelined:
+        stats = run_pipeline(source, process, _show_frame, limit=limit, max_latency=max_latency, timer=timer)
+        cv2.destroyAllWindows()
+        timer.report()
+        return stats
+
+    cap = cv2.VideoCapture(source)
+    i = 0 
+
+    while i<=limit:
+
+        with timer.stage('capture'):
+            ret, frame = cap.read()
+
+        if not ret:
+            print("Failed to grab frame")
+            break
+
+        results = process(frame)
+        with timer.stage('display'):
+            keep_running = _show_frame(frame, results)
+        timer.frame_done()
+
+        if not keep_running:
+            break
+        i += 1
+    
+    cap.release()
+    cv2.destroyAllWindows()
+    timer.report()
+
+
+# функция чтения фото человека для эмбеддинга (в том же виде, что и раньше в add2db)
+def read_image_for_recognition(path, size=160):
+    image = cv2.imread(str(path))
+    if image is None:
+        return None
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    return cv2.resize(image, (size, size))
+
+
+def iter_decoded_batches(paths, labels, batch_size=64, num_workers=8, prefetch=2):
+
+    """
+    Параллельное чтение изображений пулом потоков и выдача их батчами.
+
+    Пока модель считает текущий батч, следующие prefetch батчей уже декодируются,
+    при этом в памяти одновременно находится не больше (prefetch + 1) * batch_size изображений.
+
+    Parameters:
+    - paths (list): Пути к изображениям.
+    - labels (list): Метки изображений (например, номер человека), возвращаются вместе с батчем.
+    - batch_size (int): Размер батча.
+    - num_workers (int): Количество потоков для чтения (cv2 отпускает GIL при декодировании).
+    - prefetch (int): Сколько батчей читать заранее.
+
+    Returns:
+    generator: Пары (список изображений uint8 HxWx3, список меток); нечитаемые файлы пропускаются.
+
+    """
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        in_flight = deque()
+
+        def collect(futures):
+            images, batch_labels = [], []
+            for (path, label), future in futures:
+                image = future.result()
+                if image is None:
+                    print(f"Can't read image {path}, skipping")
+                    continue
+                images.append(image)
+                batch_labels.append(label)
+            return images, batch_labels
+
+        for start in range(0, len(paths), batch_size):
+            batch = list(zip(paths[start:start + batch_size], labels[start:start + batch_size]))
+            in_flight.append([(item, executor.submit(read_image_for_recognition, item[0])) for item in batch])
+            if len(in_flight) > prefetch:
+                yield collect(in_flight.popleft())
+
+        while in_flight:
+            yield collect(in_flight.popleft())
+
+
+def embed_images(images, rec_model, batch_size):
+
+    """
+    Эмбеддинг списка изображений одним проходом модели.
+
+    Батч всегда дополняется нулями до batch_size, чтобы форма входа модели не менялась.
+
+    Parameters:
+    - images (list): Изображения uint8 HxWx3 одного размера.
+    - rec_model: Модель для эмбеддингов.
+    - batch_size (int): Фиксированный размер батча.
+
+    Returns:
+    np.ndarray: Эмбеддинги формы (len(images), D).
+
+    """
+
+    batch = torch.from_numpy(np.stack(images)).permute(0, 3, 1, 2).float().div_(255)  # как tf.ToTensor()
+    if batch.shape[0] < batch_size:
+        padding = batch.new_zeros((batch_size - batch.shape[0], *batch.shape[1:]))
+        batch = torch.cat([batch, padding])
+
+    with torch.no_grad():
+        embeddings = rec_model(batch)
+
+    return embeddings[:len(images)].detach().cpu().numpy()
+
+
+def enrol_people(people, rec_model, store, index=None, batch_size=64, num_workers=8, images_out=None):
+
+    """
+    Добавление в базу данных нескольких людей сразу: все фото всех людей идут через общие батчи,
+    а в хранилище записывается одна пачка средних эмбеддингов.
+
+    Parameters:
+    - people (dict): Имя человека -> список путей к его фото.
+    - rec_model: Модель для эмбеддингов.
+    - store (GalleryStore): Хранилище базы данных людей.
+    - index: EmbeddingIndex или IVFIndex работающего распознавания, обновляется вместе с хранилищем.
+    - batch_size (int): Размер батча для модели.
+    - num_workers (int): Количество потоков для чтения фото.
+    - images_out (list): Если задан, в него складываются прочитанные фото как PIL изображения.
+
+    Returns:
+    list: Имена добавленных людей (люди без единого читаемого фото не добавляются).
+
+    """
+
+    names = list(people)
+    paths, labels = [], []
+    for label, name in enumerate(names):
+        paths += people[name]
+        labels += [label] * len(people[name])
+
+    sums = None
+    counts = np.zeros(len(names), dtype=np.int64)
+    for images, batch_labels in iter_decoded_batches(paths, labels, batch_size, num_workers):
+        if not images:
+            continue
+        if images_out is not None:
+            from PIL import Image
+            images_out += [Image.fromarray(image) for image in images]
+        embeddings = embed_images(images, rec_model, batch_size)
+        if sums is None:
+            sums = np.zeros((len(names), embeddings.shape[1]), dtype=np.float64)
+        np.add.at(sums, batch_labels, embeddings)
+        np.add.at(counts, batch_labels, 1)
+
+    enrolled = np.flatnonzero(counts)
+    if enrolled.size == 0:
+        return []
+
+    # средний эмбеддинг по всем фото человека, хранилище само его нормализует
+    mean_embeddings = sums[enrolled] / counts[enrolled, None]
+    enrolled_names = [names[i] for i in enrolled]
+    ids = store.add_many(enrolled_names, mean_embeddings)
+    if index is not None:
+        index.add(mean_embeddings, enrolled_names, ids)
+
+    return enrolled_names
+
+
+def _list_photos(folder_path):
+    return [os.path.join(folder_path, pic) for pic in sorted(os.listdir(folder_path))
+            if pic != ".DS_Store" and os.path.isfile(os.path.join(folder_path, pic))]
+
+
+def add2db(folder_path, owner, rec_model, gallery_path=None, index=None, batch_size=64, num_workers=8):
+
+    """
+    Add images from the specified folder to a database.
+
+    Parameters:
+    - folder_path (str): Path to the folder containing the photos.
+    - owner (str): Name of the person in the photos.
+    - rec_model: The model for embeddings.
+    - gallery_path (str): Path to the GalleryStore folder, get_config()['path_to_gallery'] by default.
+    - index: EmbeddingIndex or IVFIndex used by a running recognition loop, updated in place.
+    - batch_size (int): Number of photos per forward pass of rec_model.
+    - num_workers (int): Number of threads decoding the photos.
+
+    Returns:
+    - cropped_imgs (list): List of PIL images after cropping.
+    """
+    
+    store = open_store(gallery_path or get_config()['path_to_gallery'])
+    if owner in store:
+        print("Name exists, enter new name or delete old")
+        return []
+
+    cropped_imgs = []
+    enrol_people({owner: _list_photos(folder_path)}, rec_model, store, index,
+                 batch_size, num_workers, images_out=cropped_imgs)
+
+    return cropped_imgs
+
+
+def add_folder_of_people2db(root_folder, rec_model, gallery_path=None, index=None, batch_size=64, num_workers=8):
+
+    """
+    Массовое добавление людей в базу данных из папки с подпапками: одна подпапка - один человек,
+    имя подпапки - имя человека. Люди, которые уже есть в базе данных, пропускаются.
+
+    Parameters:
+    - root_folder (str): Путь к папке с подпапками людей.
+    - rec_model: Модель для эмбеддингов.
+    - gallery_path (str): Путь к папке хранилища, по умолчанию get_config()['path_to_gallery'].
+    - index: EmbeddingIndex или IVFIndex работающего распознавания, обновляется вместе с хранилищем.
+    - batch_size (int): Размер батча для модели.
+    - num_workers (int): Количество потоков для чтения фото.
+
+    Returns:
+    list: Имена добавленных людей.
+
+    """
+
+    store = open_store(gallery_path or get_config()['path_to_gallery'])
+
+    people = {}
+    for owner in sorted(os.listdir(root_folder)):
+        folder_path = os.path.join(root_folder, owner)
+        if not os.path.isdir(folder_path):
+            continue
+        if owner in store:
+            print(f"Name {owner} exists, skipping")
+            continue
+        people[owner] = _list_photos(folder_path)
+
+    return enrol_people(people, rec_model, store, index, batch_size, num_workers)
+
+
+
+def drop_from_database(value_to_drop, gallery_path=None, index=None):
+    """
+    Удаляет из базы данных GalleryStore всех людей, имя которых равно указанному значению.
+
+    Параметры:
+    - value_to_drop (str): Имя человека, записи с которым следует удалить из базы данных.
+    - gallery_path (str): Путь к папке хранилища, по умолчанию get_config()['path_to_gallery'].
+    - index: EmbeddingIndex или IVFIndex работающего распознавания, из него удаляются те же люди.
+
+    Пример использования:
+    drop_from_database('John Doe')
+
+    Примечание:
+    Если такого имени в базе нет, будет выведено сообщение "Name doesn't exist".
+    """
+
+    store = open_store(gallery_path or get_config()['path_to_gallery'])
+    dropped_ids = store.drop(value_to_drop)
+    if not dropped_ids:
+        print("Name doesn't exist")
+    elif index is not None:
+        index.remove(dropped_ids)
@@ -0,0 +1,553 @@
+import argparse
+import json
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+import torch
+
+from src.config import get_config
+from src.profiling import RingBuffer
+from src.recognition import detections_from_output, prepare_frame, recognize_batch, rescale_coordinates
+
+
+# Локальный HTTP сервис инференса: запросы /detect, /embed и /identify из разных соединений собираются
+# в микро-батчи и проходят через детектор и модель эмбеддингов одним вызовом на батч.
+
+
+class Overloaded(RuntimeError):
+    # очередь батчера заполнена, запрос отклонен (HTTP 503)
+    pass
+
+
+class MicroBatcher:
+
+    '''
+    Сборка одиночных запросов в батчи для одной функции модели.
+
+    submit кладет запрос в ограниченную очередь и сразу возвращает Future, поток батчера берет первый запрос,
+    ждет следующие не дольше max_wait (или пока батч не наберет max_batch_size) и вызывает batch_fn один раз
+    на весь батч. Если в очереди уже max_queue запросов, submit бросает Overloaded, поэтому при перегрузке
+    клиенты быстро получают отказ, а задержка принятых запросов не растет неограниченно.
+
+    batch_fn - функция (список запросов) -> список результатов той же длины
+    max_batch_size - максимальный размер батча
+    max_wait - сколько секунд ждать запросов после первого запроса батча
+    max_queue - максимальное количество ждущих запросов
+    '''
+
+    def __init__(self, batch_fn, max_batch_size=16, max_wait=0.005, max_queue=256):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        self.submitted = 0
+        self.rejected = 0
+        self.failed = 0
+        self.batches = 0
+        self.batched_requests = 0
+        # время от submit до готового результата, пишется только из потока батчера
+        self.latencies = RingBuffer(1024)
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+        # запросы, которые уже не будут посчитаны, завершаются ошибкой, чтобы их обработчики не ждали таймаута
+        while True:
+            try:
+                _, future, _ = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            future.set_exception(Overloaded('service is stopping'))
+
+    def submit(self, item):
+        """
+        Постановка запроса в очередь.
+
+        Returns:
+        Future: Результат batch_fn для этого запроса.
+
+        """
+
+        if self._stop_event.is_set():
+            raise Overloaded('service is stopping')
+
+        future = Future()
+        try:
+            self._queue.put_nowait((item, future, time.perf_counter()))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise Overloaded(f'queue is full ({self.max_queue} requests)')
+        with self._lock:
+            self.submitted += 1
+        return future
+
+    def _collect(self):
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while not self._stop_event.is_set():
+            batch = self._collect()
+            if not batch:
+                continue
+
+            try:
+                results = self.batch_fn([item for item, _, _ in batch])
+            except Exception as error:
+                # ошибка модели отдается всем запросам батча, поток батчера продолжает работать
+                self.failed += len(batch)
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+
+            now = time.perf_counter()
+            for (_, future, submitted_at), result in zip(batch, results):
+                future.set_result(result)
+                self.latencies.append(now - submitted_at)
+            self.batches += 1
+            self.batched_requests += len(batch)
+
+    def metrics(self):
+        """
+        Returns:
+        dict: Глубина очереди 'queue_depth' и 'max_queue', счетчики запросов ('submitted', 'rejected', 'failed'),
+        количество батчей и средний размер батча, p50/p95/p99 времени от submit до результата в миллисекундах
+        по последним 1024 запросам.
+
+        """
+
+        latencies = self.latencies.values() * 1000
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (0.0, 0.0, 0.0)
+        with self._lock:
+            submitted, rejected = self.submitted, self.rejected
+        return {
+            'queue_depth': self._queue.qsize(),
+            'max_queue': self.max_queue,
+            'submitted': submitted,
+            'rejected': rejected,
+            'failed': self.failed,
+            'batches': self.batches,
+            'mean_batch_size': self.batched_requests / self.batches if self.batches else 0.0,
+            'latency_p50_ms': float(p50),
+            'latency_p95_ms': float(p95),
+            'latency_p99_ms': float(p99),
+        }
+
+
+class InferenceService:
+
+    '''
+    Детекция, эмбеддинги и распознавание для одиночных изображений с микро-батчингом (по MicroBatcher на каждую
+    операцию). Все батчеры используют один экземпляр моделей, вызовы моделей разных батчеров не пересекаются.
+
+    model - модель детекции
+    embedding_model - модель для эмбеддингов
+    index - EmbeddingIndex или IVFIndex с базой данных людей, None - без /identify
+    max_batch_size, max_wait, max_queue - параметры MicroBatcher
+    threshold - порог расстояния, выше которого человек считается неизвестным
+    det_threshold - порог уверенности детектора
+    '''
+
+    def __init__(self, model, embedding_model, index=None, max_batch_size=16, max_wait=0.005, max_queue=256,
+                 threshold=1.2, det_threshold=0.9):
+        self.model = model
+        self.embedding_model = embedding_model
+        self.index = index
+        self.threshold = threshold
+        self.det_threshold = det_threshold
+        # модели не рассчитаны на одновременные вызовы из нескольких потоков, а torch и так занимает все ядра
+        self._model_lock = threading.Lock()
+
+        batch_fns = {'detect': self._detect_batch, 'embed': self._embed_batch}
+        if index is not None:
+            batch_fns['identify'] = self._identify_batch
+        self.batchers = {name: MicroBatcher(batch_fn, max_batch_size, max_wait, max_queue)
+                         for name, batch_fn in batch_fns.items()}
+        self.started_at = time.time()
+
+    def start(self):
+        for batcher in self.batchers.values():
+            batcher.start()
+
+    def stop(self):
+        for batcher in self.batchers.values():
+            batcher.stop()
+
+    def _detect_batch(self, frames):
+        prepared = [prepare_frame(frame) for frame in frames]
+        with self._model_lock, torch.no_grad():
+            res = self.model(torch.stack([det_input for _, det_input in prepared]))
+        detections = detections_from_output(res, self.model, self.det_threshold)
+
+        results = []
+        for (rgb_frame, _), (boxes, scores) in zip(prepared, detections):
+            results.append([{'box': rescale_coordinates(box, rgb_frame.shape), 'score': round(float(score), 4)}
+                            for box, score in zip(boxes, scores)])
+        return results
+
+    def _embed_batch(self, faces):
+        # уже вырезанные лица, как фото людей в базе данных (read_image_for_recognition)
+        images = [cv2.resize(cv2.cvtColor(face, cv2.COLOR_BGR2RGB), (160, 160)) for face in faces]
+        batch = torch.from_numpy(np.stack(images)).permute(0, 3, 1, 2).contiguous().float().div_(255)  # как tf.ToTensor()
+        with self._model_lock, torch.no_grad():
+            embeddings = self.embedding_model(batch)
+        return [embedding.tolist() for embedding in embeddings.cpu().numpy()]
+
+    def _identify_batch(self, frames):
+        prepared = [prepare_frame(frame) for frame in frames]
+        with self._model_lock:
+            results, scores = recognize_batch(prepared, self.model, self.embedding_model, self.index,
+                                              self.threshold, self.det_threshold)
+        return [[{'box': coord, 'score': round(score, 4), 'name': str(name), 'distance': round(distance, 4)}
+                 for (coord, name, distance), score in zip(frame_results, frame_scores)]
+                for frame_results, frame_scores in zip(results, scores)]
+
+    def submit(self, operation, image):
+        """
+        Асинхронный запрос к сервису.
+
+        Parameters:
+        - operation (str): 'detect', 'embed' или 'identify'.
+        - image (np.ndarray): Изображение BGR (для 'embed' - вырезанное лицо).
+
+        Returns:
+        Future: Для 'detect' - список {'box', 'score'}, для 'embed' - эмбеддинг списком чисел,
+        для 'identify' - список {'box', 'score', 'name', 'distance'}.
+
+        """
+
+        if operation not in self.batchers:
+            raise KeyError(operation)
+        return self.batchers[operation].submit(image)
+
+    def metrics(self):
+        return {'uptime_s': round(time.time() - self.started_at, 1),
+                **{name: batcher.metrics() for name, batcher in self.batchers.items()}}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # POST /detect, /embed, /identify с байтами изображения (JPEG, PNG, ...) в теле, GET /metrics и /health
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        elif self.path == '/metrics':
+            self._send_json(200, self.server.service.metrics())
+        else:
+            self._send_json(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        operation = self.path.strip('/')
+        service = self.server.service
+        if operation not in service.batchers:
+            self._send_json(404, {'error': f'unknown path {self.path}'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            length = -1
+        if length < 0 or length > self.server.max_body_size:
+            # тело не читается, поэтому соединение дальше использовать нельзя
+            self.close_connection = True
+            if length < 0:
+                self._send_json(400, {'error': 'missing or invalid Content-Length'})
+            else:
+                self._send_json(413, {'error': f'body is larger than {self.server.max_body_size} bytes'})
+            return
+
+        body = self.rfile.read(length)
+        image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR) if body else None
+        if image is None:
+            self._send_json(400, {'error': "can't decode image"})
+            return
+
+        try:
+            future = service.submit(operation, image)
+        except Overloaded as error:
+            self._send_json(503, {'error': str(error)}, {'Retry-After': '1'})
+            return
+
+        try:
+            result = future.result(timeout=self.server.request_timeout)
+        except FutureTimeoutError:
+            self._send_json(504, {'error': 'inference timeout'})
+            return
+        except Overloaded as error:
+            # сервис остановился, пока запрос ждал в очереди
+            self._send_json(503, {'error': str(error)})
+            return
+        except Exception as error:
+            self._send_json(500, {'error': repr(error)})
+            return
+
+        key = 'embedding' if operation == 'embed' else 'faces'
+        self._send_json(200, {key: result})
+
+    def log_message(self, format, *args):
+        # без строки в stderr на каждый запрос, иначе генератор нагрузки упирается в вывод
+        pass
+
+
+def start_server(service, host='127.0.0.1', port=8000, request_timeout=30.0, max_body_size=16 * 1024 * 1024):
+    """
+    Запуск HTTP сервера сервиса в фоновом потоке (каждое соединение обрабатывается в своем потоке).
+
+    Parameters:
+    - service (InferenceService): Сервис, его батчеры тоже запускаются.
+    - host (str): Адрес, по умолчанию только локальные соединения.
+    - port (int): Порт, 0 - любой свободный (см. server.server_address).
+    - request_timeout (float): Сколько секунд ждать результат модели, потом ответ 504.
+    - max_body_size (int): Максимальный размер изображения в байтах, на большие запросы ответ 413.
+
+    Returns:
+    ThreadingHTTPServer: Сервер, остановка - server.shutdown() и service.stop().
+
+    """
+
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.service = service
+    server.request_timeout = request_timeout
+    server.max_body_size = max_body_size
+
+    service.start()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class ServiceClient:
+
+    '''
+    Клиент HTTP сервиса на urllib, без зависимостей.
+
+    url - адрес сервиса, например http://127.0.0.1:8000
+    timeout - таймаут запроса в секундах
+    '''
+
+    def __init__(self, url='http://127.0.0.1:8000', timeout=30.0):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    @staticmethod
+    def encode(image):
+        # байты файла передаются как есть, массив BGR кодируется в JPEG
+        if isinstance(image, (bytes, bytearray)):
+            return bytes(image)
+        ok, buffer = cv2.imencode('.jpg', image)
+        if not ok:
+            raise ValueError("can't encode image")
+        return buffer.tobytes()
+
+    def _request(self, path, data=None):
+        request = urllib.request.Request(self.url + path, data=data,
+                                         headers={'Content-Type': 'application/octet-stream'} if data else {})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def detect(self, image):
+        return self._request('/detect', self.encode(image))['faces']
+
+    def embed(self, face):
+        return np.array(self._request('/embed', self.encode(face))['embedding'], dtype=np.float32)
+
+    def identify(self, image):
+        return self._request('/identify', self.encode(image))['faces']
+
+    def metrics(self):
+        return self._request('/metrics')
+
+
+def run_load(url, image, endpoint='identify', concurrency=8, duration=10.0, timeout=30.0):
+    """
+    Нагрузка с замкнутым циклом: concurrency клиентов отправляют запросы один за другим в течение duration секунд.
+
+    Parameters:
+    - url (str): Адрес сервиса.
+    - image: Байты файла изображения или массив BGR.
+    - endpoint (str): 'detect', 'embed' или 'identify'.
+    - concurrency (int): Количество одновременных клиентов.
+    - duration (float): Длительность в секундах.
+    - timeout (float): Таймаут одного запроса.
+
+    Returns:
+    dict: 'concurrency', 'requests' (успешных), 'rejected' (503), 'errors', 'throughput' (запросов в секунду)
+    и p50/p95/p99 задержки успешных запросов в миллисекундах.
+
+    """
+
+    client = ServiceClient(url, timeout)
+    body = client.encode(image)
+    latencies, counts = [], {'rejected': 0, 'errors': 0}
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def worker():
+        local_latencies, rejected, errors = [], 0, 0
+        while time.perf_counter() < stop_at:
+            started_at = time.perf_counter()
+            try:
+                client._request('/' + endpoint, body)
+                local_latencies.append(time.perf_counter() - started_at)
+            except urllib.error.HTTPError as error:
+                if error.code == 503:
+                    rejected += 1
+                    time.sleep(0.01)
+                else:
+                    errors += 1
+            except OSError:
+                errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            counts['rejected'] += rejected
+            counts['errors'] += errors
+
+    started_at = time.perf_counter()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started_at
+
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99]) if latencies else (0.0, 0.0, 0.0)
+    return {'concurrency': concurrency, 'requests': len(latencies), **counts,
+            'throughput': len(latencies) / elapsed, 'latency_p50_ms': float(p50),
+            'latency_p95_ms': float(p95), 'latency_p99_ms': float(p99)}
+
+
+def load_curve(url, image, endpoint='identify', concurrencies=(1, 2, 4, 8, 16), duration=10.0):
+    """
+    run_load для нескольких уровней параллельности: зависимость пропускной способности от задержки.
+    Строки печатаются по мере готовности.
+
+    Returns:
+    list: Результаты run_load.
+
+    """
+
+    print(f"{'clients':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'503':>6} {'errors':>6}")
+    rows = []
+    for concurrency in concurrencies:
+        row = run_load(url, image, endpoint, concurrency, duration)
+        rows.append(row)
+        print(f"{concurrency:>8} {row['throughput']:>8.1f} {row['latency_p50_ms']:>8.1f} "
+              f"{row['latency_p95_ms']:>8.1f} {row['latency_p99_ms']:>8.1f} {row['rejected']:>6} {row['errors']:>6}")
+    return rows
+
+
+def _build_service(args):
+    from src.gallery import load_index
+    from src.inference import get_inference_models
+
+    model, embedding_model = get_inference_models(export=args.export, quantized=args.quantized)
+    index = load_index(args.gallery or get_config()['path_to_gallery'])
+    return InferenceService(model, embedding_model, index, args.max_batch_size, args.max_wait, args.max_queue,
+                            args.threshold, args.det_threshold)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local face inference service with dynamic micro-batching')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve = subparsers.add_parser('serve', help='Запустить сервис')
+    load = subparsers.add_parser('load', help='Генератор нагрузки, без --url сервис запускается в этом же процессе')
+    for subparser in (serve, load):
+        subparser.add_argument('--gallery', default=None,
+                               help='База данных людей, по умолчанию path_to_gallery из config.yaml')
+        subparser.add_argument('--max-batch-size', type=int, default=16, help='Запросов в батче')
+        subparser.add_argument('--max-wait', type=float, default=0.005, help='Ожидание запросов в батч, секунды')
+        subparser.add_argument('--max-queue', type=int, default=256, help='Ждущих запросов, остальным 503')
+        subparser.add_argument('--threshold', type=float, default=1.2, help='Порог расстояния для unknown')
+        subparser.add_argument('--det-threshold', type=float, default=0.9, help='Порог уверенности детектора')
+        subparser.add_argument('--export', default=None, choices=['torchscript', 'onnx'], help='Формат моделей')
+        subparser.add_argument('--quantized', action='store_true', help='INT8 модели (src/quantization.py)')
+
+    serve.add_argument('--host', default='127.0.0.1', help='Адрес')
+    serve.add_argument('--port', type=int, default=8000, help='Порт')
+
+    load.add_argument('--url', default=None, help='Адрес работающего сервиса')
+    load.add_argument('--image', required=True, help='Изображение для запросов')
+    load.add_argument('--endpoint', default='identify', choices=['detect', 'embed', 'identify'], help='Операция')
+    load.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='Клиентов')
+    load.add_argument('--duration', type=float, default=10.0, help='Секунд на каждый уровень')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        service = _build_service(args)
+        server = start_server(service, args.host, args.port)
+        print(f'Serving on http://{args.host}:{server.server_address[1]}')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+            service.stop()
+        return
+
+    with open(args.image, 'rb') as image_file:
+        image = image_file.read()
+
+    server = service = None
+    url = args.url
+    if url is None:
+        service = _build_service(args)
+        server = start_server(service, port=0)
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    try:
+        load_curve(url, image, args.endpoint, args.concurrency, args.duration)
+        print(json.dumps(ServiceClient(url).metrics()[args.endpoint], indent=2))
+    finally:
+        if server is not None:
+            server.shutdown()
+            service.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,380 @@
+import argparse
+import os
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from src.config import get_config
+from src.pipeline import STOP, LatestQueue
+from src.profiling import RingBuffer, get_timer
+from src.recognition import prepare_frame, recognize_batch
+
+
+# Сервер для нескольких камер в одном процессе: у каждого источника свой поток захвата и свой поток вывода,
+# а модели одни на всех - кадры разных камер собираются в общий батч детектора и модели эмбеддингов.
+
+
+class Stream:
+
+    '''
+    Один источник видео сервера.
+
+    name - имя потока, передается в sink и в статистику
+    source - номер камеры, RTSP адрес или видеофайл (все, что принимает cv2.VideoCapture)
+    sink_fn - функция (кадр, результаты, задержка в секундах) -> bool, как в run_pipeline, False останавливает поток;
+              результаты - список (coord, name, distance), как у recognize_frame
+    realtime - читать видеофайл со скоростью его fps, как камеру (иначе кадры читаются так быстро,
+               как позволяет диск, и почти все выбрасываются)
+    '''
+
+    def __init__(self, name, source, sink_fn=None, realtime=False):
+        self.name = name
+        self.source = source
+        self.sink_fn = sink_fn
+        self.realtime = realtime
+
+        # в каждой очереди только самый свежий кадр, поэтому медленный сервер не копит задержку
+        self.frames = LatestQueue(1)
+        self.results = LatestQueue(1)
+        self.finished = threading.Event()
+
+        self.captured = 0
+        self.processed = 0
+        self.dropped_deadline = 0
+        self.latencies = RingBuffer(1024)
+
+    def stats(self):
+        latencies = self.latencies.values() * 1000
+        return {
+            'captured': self.captured,
+            'processed': self.processed,
+            'dropped_stale': self.frames.dropped + self.results.dropped,
+            'dropped_deadline': self.dropped_deadline,
+            'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+            'latency_p95_ms': float(np.percentile(latencies, 95)) if len(latencies) else 0.0,
+        }
+
+
+class StreamServer:
+
+    '''
+    Распознавание лиц сразу на нескольких источниках видео с одним экземпляром моделей.
+
+    Потоки захвата читают кадры и готовят вход детектора (prepare_frame), поток инференса собирает микро-батч:
+    не больше одного (самого свежего) кадра от каждого источника, ждет остальные источники не дольше max_wait
+    и считает детектор и модель эмбеддингов один раз на весь батч (recognize_batch). Если источников больше,
+    чем max_batch_size, очередь источников сдвигается по кругу, чтобы каждый попадал в батч одинаково часто.
+    Кадры, которые ждали дольше max_latency, выбрасываются без инференса. Результаты передаются в sink_fn
+    источника в его собственном потоке вывода, поэтому медленный sink не задерживает остальные камеры.
+
+    model - модель детекции
+    embedding_model - модель для эмбеддингов
+    index - EmbeddingIndex или IVFIndex с базой данных людей
+    max_batch_size - максимальное количество кадров в батче
+    max_wait - сколько секунд ждать кадров от других источников после первого кадра батча
+    max_latency - кадры старше стольких секунд пропускаются без инференса, None - не пропускать
+    threshold, det_threshold, embed_batch_size - как в recognize_batch
+    profile - замер стадий: None, True или StageTimer (см. src/profiling.py)
+    '''
+
+    def __init__(self, model, embedding_model, index, max_batch_size=16, max_wait=0.005, max_latency=0.5,
+                 threshold=1.2, det_threshold=0.9, embed_batch_size=64, profile=None):
+        self.model = model
+        self.embedding_model = embedding_model
+        self.index = index
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_latency = max_latency
+        self.threshold = threshold
+        self.det_threshold = det_threshold
+        self.embed_batch_size = embed_batch_size
+        self.timer = get_timer(profile)
+
+        self.streams = []
+        self._threads = []
+        self._stop_event = threading.Event()
+        # потоки захвата сообщают потоку инференса о новом кадре
+        self._frame_ready = threading.Event()
+        self._next_stream = 0
+        # первая ошибка потока инференса или sink, run пробрасывает ее после остановки
+        self._error = None
+
+        self.batches = 0
+        self.batched_frames = 0
+
+    def add_stream(self, source, sink_fn=None, name=None, realtime=None):
+        """
+        Добавление источника (до start).
+
+        Parameters:
+        - source: Номер камеры, RTSP адрес или видеофайл.
+        - sink_fn (callable): Функция (кадр, результаты, задержка) -> bool, None - результаты не выводятся.
+        - name (str): Имя потока, по умолчанию stream<номер>.
+        - realtime (bool): Читать видеофайл со скоростью его fps, по умолчанию True для файлов.
+
+        Returns:
+        Stream: Добавленный поток.
+
+        """
+
+        if realtime is None:
+            realtime = isinstance(source, str) and os.path.isfile(source)
+        stream = Stream(name or f'stream{len(self.streams)}', source, sink_fn, realtime)
+        self.streams.append(stream)
+        return stream
+
+    def _capture_loop(self, stream):
+        cap = cv2.VideoCapture(stream.source)
+        fps = cap.get(cv2.CAP_PROP_FPS) if stream.realtime else 0
+        started_at = time.perf_counter()
+        try:
+            while not self._stop_event.is_set() and not stream.finished.is_set():
+                with self.timer.stage('capture'):
+                    ret, frame = cap.read()
+                if not ret:
+                    print(f'{stream.name}: no more frames')
+                    break
+
+                if fps:
+                    # видеофайл как камера: кадр отдается не раньше его времени
+                    delay = started_at + stream.captured / fps - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                captured_at = time.perf_counter()
+                with self.timer.stage('preprocess'):
+                    prepared = prepare_frame(frame)
+                stream.frames.put((captured_at, frame, prepared))
+                stream.captured += 1
+                self._frame_ready.set()
+        finally:
+            cap.release()
+            stream.frames.put(STOP)
+            self._frame_ready.set()
+
+    def _collect_batch(self):
+        # по одному кадру от источников, начиная со сдвигающегося по кругу, пока батч не заполнится
+        # или не пройдет max_wait после первого кадра
+        batch, taken = [], set()
+        first_at = None
+        while not self._stop_event.is_set():
+            n_streams = len(self.streams)
+            for shift in range(n_streams):
+                stream = self.streams[(self._next_stream + shift) % n_streams]
+                # остановленный источник (sink вернул False или кадры кончились) в батч не попадает
+                if stream in taken or stream.finished.is_set() or len(batch) >= self.max_batch_size:
+                    continue
+                try:
+                    item = stream.frames.get_nowait()
+                except queue.Empty:
+                    continue
+                taken.add(stream)
+                if item is STOP:
+                    stream.finished.set()
+                    stream.results.put(STOP)
+                    continue
+
+                captured_at, frame, prepared = item
+                if self.max_latency is not None and time.perf_counter() - captured_at > self.max_latency:
+                    stream.dropped_deadline += 1
+                    continue
+                batch.append((stream, captured_at, frame, prepared))
+
+            if batch and first_at is None:
+                first_at = time.perf_counter()
+            if len(batch) >= self.max_batch_size:
+                break
+            if all(stream in taken or stream.finished.is_set() for stream in self.streams):
+                break
+            if first_at is not None and time.perf_counter() - first_at >= self.max_wait:
+                break
+            remaining = self.max_wait - (time.perf_counter() - first_at) if first_at is not None else 0.1
+            self._frame_ready.wait(timeout=max(remaining, 0))
+            self._frame_ready.clear()
+
+        self._next_stream = (self._next_stream + 1) % max(1, len(self.streams))
+        return batch
+
+    def _fail(self, error, streams):
+        # ошибка в потоке инференса или вывода останавливает весь сервер, иначе run ждал бы вечно
+        if self._error is None:
+            self._error = error
+        for stream in streams:
+            stream.finished.set()
+        self._stop_event.set()
+        self._frame_ready.set()
+
+    def _inference_loop(self):
+        try:
+            while not self._stop_event.is_set():
+                if all(stream.finished.is_set() for stream in self.streams):
+                    break
+
+                batch = self._collect_batch()
+                if not batch:
+                    continue
+
+                results, _ = recognize_batch([prepared for *_, prepared in batch], self.model,
+                                             self.embedding_model, self.index, self.threshold, self.det_threshold,
+                                             self.embed_batch_size, self.timer)
+                self.batches += 1
+                self.batched_frames += len(batch)
+
+                for (stream, captured_at, frame, _), frame_results in zip(batch, results):
+                    stream.processed += 1
+                    stream.results.put((captured_at, frame, frame_results))
+                    self.timer.frame_done()
+        except Exception as error:
+            self._fail(error, self.streams)
+
+    def _output_loop(self, stream):
+        try:
+            while True:
+                try:
+                    item = stream.results.get(timeout=0.1)
+                except queue.Empty:
+                    if self._stop_event.is_set():
+                        break
+                    continue
+                if item is STOP:
+                    break
+
+                captured_at, frame, results = item
+                latency = time.perf_counter() - captured_at
+                stream.latencies.append(latency)
+                if stream.sink_fn is not None:
+                    with self.timer.stage('display'):
+                        keep_running = stream.sink_fn(frame, results, latency)
+                    if keep_running is False:
+                        # источник останавливается, остальные продолжают работать
+                        stream.finished.set()
+                        break
+        except Exception as error:
+            self._fail(error, [stream])
+
+    def start(self):
+        """
+        Запуск потоков захвата, вывода и инференса всех источников.
+
+        """
+
+        if not self.streams:
+            raise ValueError('add at least one stream before start')
+
+        self._stop_event.clear()
+        self._error = None
+        for stream in self.streams:
+            self._threads.append(threading.Thread(target=self._capture_loop, args=(stream,), daemon=True))
+            self._threads.append(threading.Thread(target=self._output_loop, args=(stream,), daemon=True))
+        self._threads.append(threading.Thread(target=self._inference_loop, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._frame_ready.set()
+        for thread in self._threads:
+            thread.join(timeout=1)
+        self._threads = []
+
+    def run(self, duration=None):
+        """
+        Запуск и ожидание, пока все источники не закончатся, не пройдет duration секунд или не будет Ctrl+C.
+        Ошибка recognize_batch или sink_fn останавливает сервер и пробрасывается отсюда после stop.
+
+        Parameters:
+        - duration (float): Время работы в секундах, None - пока есть кадры.
+
+        Returns:
+        dict: Статистика (см. stats).
+
+        """
+
+        self.start()
+        started_at = time.perf_counter()
+        try:
+            while not self._stop_event.is_set() and not all(stream.finished.is_set() for stream in self.streams):
+                if duration is not None and time.perf_counter() - started_at > duration:
+                    break
+                time.sleep(0.1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            self.timer.report()
+        if self._error is not None:
+            raise self._error
+        return self.stats()
+
+    def stats(self):
+        """
+        Returns:
+        dict: Количество батчей, средний размер батча и статистика каждого источника: захвачено и обработано кадров,
+        выброшено устаревших и просроченных кадров, p50/p95 задержки от захвата до sink.
+
+        """
+
+        return {
+            'batches': self.batches,
+            'mean_batch_size': self.batched_frames / self.batches if self.batches else 0.0,
+            'streams': {stream.name: stream.stats() for stream in self.streams},
+        }
+
+
+def main():
+    from src.gallery import load_index
+    from src.inference import get_inference_models
+    from src.offline import JsonlWriter
+
+    parser = argparse.ArgumentParser(description='Face recognition server for several cameras with shared models')
+    parser.add_argument('sources', nargs='+', help='Номера камер, RTSP адреса или видеофайлы')
+    parser.add_argument('--output-dir', default=None, help='Папка для записей <поток>.jsonl, по умолчанию не писать')
+    parser.add_argument('--gallery', default=None, help='База данных людей, по умолчанию path_to_gallery из config.yaml')
+    parser.add_argument('--max-batch-size', type=int, default=16, help='Кадров в батче')
+    parser.add_argument('--max-wait', type=float, default=0.005, help='Ожидание кадров других камер, секунды')
+    parser.add_argument('--max-latency', type=float, default=0.5, help='Кадры старше пропускаются, секунды')
+    parser.add_argument('--threshold', type=float, default=1.2, help='Порог расстояния для unknown')
+    parser.add_argument('--det-threshold', type=float, default=0.9, help='Порог уверенности детектора')
+    parser.add_argument('--export', default=None, choices=['torchscript', 'onnx'], help='Формат моделей')
+    parser.add_argument('--quantized', action='store_true', help='INT8 модели (src/quantization.py)')
+    parser.add_argument('--duration', type=float, default=None, help='Время работы, секунды')
+    parser.add_argument('--profile', action='store_true', help='Печатать p50/p95/p99 стадий')
+    args = parser.parse_args()
+
+    model, embedding_model = get_inference_models(export=args.export, quantized=args.quantized)
+    index = load_index(args.gallery or get_config()['path_to_gallery'])
+
+    server = StreamServer(model, embedding_model, index, args.max_batch_size, args.max_wait, args.max_latency,
+                          args.threshold, args.det_threshold, profile=args.profile or None)
+
+    writers = []
+    for i, source in enumerate(args.sources):
+        # номер камеры в командной строке - строка из цифр
+        source = int(source) if source.isdigit() else source
+        sink_fn = None
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+            writer = JsonlWriter(os.path.join(args.output_dir, f'stream{i}.jsonl'))
+            writers.append(writer)
+
+            def sink_fn(frame, results, latency, writer=writer):
+                writer.write([{'time': time.time(), 'box': coord, 'name': str(name), 'distance': round(distance, 4)}
+                              for coord, name, distance in results])
+        server.add_stream(source, sink_fn)
+
+    try:
+        stats = server.run(args.duration)
+    finally:
+        for writer in writers:
+            writer.close()
+
+    print(f"{stats['batches']} batches, mean batch size {stats['mean_batch_size']:.1f}")
+    for name, stream_stats in stats['streams'].items():
+        print(name, stream_stats)
+
+
+if __name__ == '__main__':
+    main()
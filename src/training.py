@@ -0,0 +1,159 @@
+import time
+from contextlib import nullcontext
+
+import torch
+from tqdm import tqdm
+
+
+AMP_DTYPES = {'float16': torch.float16, 'bfloat16': torch.bfloat16}
+
+
+def compile_model(model, enabled=True):
+    """
+    torch.compile модели, если он включен и доступен (torch >= 2.0), иначе модель возвращается как есть.
+
+    Скомпилированная модель делит параметры с исходной, поэтому оптимизатор и state_dict исходной модели
+    продолжают работать.
+
+    """
+
+    if enabled and hasattr(torch, 'compile'):
+        return torch.compile(model)
+    return model
+
+
+def get_autocast(device, amp=None):
+    """
+    Контекст autocast и GradScaler для обучения со смешанной точностью.
+
+    Parameters:
+    - device (torch.device): Устройство обучения.
+    - amp (str): None или '' - fp32, 'float16' или 'bfloat16'.
+
+    Returns:
+    tuple: Функция без аргументов, возвращающая контекст autocast, и GradScaler
+    (None, если масштабирование loss не нужно: fp32, bfloat16 или CPU).
+
+    """
+
+    if not amp:
+        return nullcontext, None
+    if amp not in AMP_DTYPES:
+        raise ValueError(f"amp must be '', 'float16' or 'bfloat16', got {amp!r}")
+
+    device_type = torch.device(device).type
+    dtype = AMP_DTYPES[amp]
+
+    scaler = None
+    if dtype == torch.float16 and device_type == 'cuda':
+        # у float16 маленький диапазон, без масштабирования градиенты уходят в 0
+        scaler = torch.amp.GradScaler('cuda') if hasattr(torch.amp, 'GradScaler') else torch.cuda.amp.GradScaler()
+
+    return (lambda: torch.autocast(device_type=device_type, dtype=dtype)), scaler
+
+
+def _as_losses(output):
+    # step_fn может вернуть тензор loss или словарь, в котором 'loss' - то, по чему считаются градиенты
+    return output if isinstance(output, dict) else {'loss': output}
+
+
+def train_epoch(model, dataloader, step_fn, optimizer, device, amp=None, accumulation_steps=1, log_interval=50,
+                scaler=None, desc=None):
+    """
+    Одна эпоха обучения.
+
+    Лоссы копятся на устройстве и переносятся на CPU (синхронизация с GPU) только каждые log_interval шагов
+    для прогресс-бара и в конце эпохи. Градиенты копятся accumulation_steps батчей, поэтому эффективный
+    размер батча - batch_size * accumulation_steps.
+
+    Parameters:
+    - model (nn.Module): Модель (может быть скомпилирована compile_model).
+    - dataloader (DataLoader): Даталоадер обучения.
+    - step_fn (callable): Функция (model, batch, device) -> loss или словарь лоссов с ключом 'loss'.
+    - optimizer (torch.optim.Optimizer): Оптимизатор.
+    - device (torch.device): Устройство обучения.
+    - amp (str): None или '' - fp32, 'float16' или 'bfloat16' (см. get_autocast).
+    - accumulation_steps (int): Количество батчей на один шаг оптимизатора.
+    - log_interval (int): Через сколько шагов обновлять прогресс-бар.
+    - scaler: GradScaler, чтобы его состояние сохранялось между эпохами, по умолчанию создается get_autocast.
+    - desc (str): Подпись прогресс-бара.
+
+    Returns:
+    dict: Суммы лоссов за эпоху, количество шагов 'steps' и скорость 'samples_per_sec'.
+
+    """
+
+    autocast, default_scaler = get_autocast(device, amp)
+    scaler = scaler or default_scaler
+
+    model.train()
+    optimizer.zero_grad(set_to_none=True)
+
+    totals, n_samples = {}, 0
+    started_at = time.perf_counter()
+    n_steps = len(dataloader)
+    # последняя группа может быть короче accumulation_steps, ее лосс делится на ее настоящий размер,
+    # иначе последний шаг оптимизатора был бы в accumulation_steps / размер группы раз слабее
+    last_group_start = (n_steps // accumulation_steps) * accumulation_steps
+    last_group_size = n_steps - last_group_start
+
+    for step, batch in enumerate(pbar := tqdm(dataloader, desc=desc), start=1):
+        with autocast():
+            losses = _as_losses(step_fn(model, batch, device))
+
+        group_size = last_group_size if step > last_group_start else accumulation_steps
+        loss = losses['loss'] / group_size
+        if scaler is not None:
+            scaler.scale(loss).backward()
+        else:
+            loss.backward()
+
+        if step % accumulation_steps == 0 or step == n_steps:
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+        for name, value in losses.items():
+            totals[name] = totals.get(name, 0) + value.detach().float()
+        n_samples += len(batch[0])
+
+        if step % log_interval == 0:
+            pbar.set_postfix({name: (value / step).item() for name, value in totals.items()})
+
+    elapsed = time.perf_counter() - started_at
+    stats = {name: value.item() for name, value in totals.items()}
+    stats['steps'] = n_steps
+    stats['samples_per_sec'] = n_samples / elapsed if elapsed > 0 else 0.0
+    return stats
+
+
+def evaluate(model, dataloader, step_fn, device, amp=None):
+    """
+    Средние лоссы на валидационном даталоадере (без градиентов, одна синхронизация с GPU в конце).
+
+    Parameters:
+    - model (nn.Module): Модель.
+    - dataloader (DataLoader): Даталоадер валидации.
+    - step_fn (callable): Та же функция, что для train_epoch.
+    - device (torch.device): Устройство.
+    - amp (str): None или '' - fp32, 'float16' или 'bfloat16'.
+
+    Returns:
+    dict: Средние лоссы по батчам.
+
+    """
+
+    autocast, _ = get_autocast(device, amp)
+
+    model.eval()
+    totals = {}
+    with torch.no_grad(), autocast():
+        for batch in dataloader:
+            for name, value in _as_losses(step_fn(model, batch, device)).items():
+                totals[name] = totals.get(name, 0) + value.float()
+    model.train()
+
+    return {name: (value / len(dataloader)).item() for name, value in totals.items()}
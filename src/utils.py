@@ -22,31 +22,18 @@ import pandas as pd
 import timm
 
 import src.models as models
+from src.config import get_options
+# функции распознавания и базы данных людей живут в src.recognition (без тяжелых импортов),
+# здесь они доступны под старыми именами
+from src.recognition import (transform, rescale_coordinates, detect_frame, detect_faces, draw_detections,
+                             _show_frame, cam_capture, crop, crop_batch, recognize_frame, recognition_cam,
+                             read_image_for_recognition, iter_decoded_batches, embed_images, enrol_people,
+                             _list_photos, add2db, add_folder_of_people2db, drop_from_database)
 
 
-# функция для загрузки конфига
-def get_options():
-    """
-    Загрузка конфигурационных опций из файла config.yaml.
-
-    Returns:
-    dict: Словарь с конфигурационными опциями.
-
-    """
-    options_path = 'config.yaml'
-    with open(options_path, 'r') as option_file:
-        options = yaml.safe_load(option_file)
-    return options
-
 config = get_options()
 
 
-transform = transforms.Compose([
-    transforms.ToTensor(),
-    transforms.Lambda(lambda x: x / 255.0), # normalization
-])
-
-
 
 ### ФУНКЦИИ ДЛЯ СКАЧИВАНИЯ И ОБРАБОТКИ ДАТАСЕТОВ ###
 
@@ -201,16 +188,22 @@ def preprocessing_of_face_detection_dataset():
     labels2_dir = f"{root}data/face-detection-dataset/labels2"
 
 
-    # Путь к итоговому CSV файлу
+    # Путь к итоговому CSV файлу (только изображения с одним лицом, для InspectorGadjet)
     csv_file_path = f"{root}data/face-detection-dataset/labels_and_coordinates.csv"
 
-    # Открываем CSV файл для записи
-    with open(csv_file_path, mode='w', newline='') as csv_file:
+    # Путь к CSV файлу со всеми лицами всех изображений, по строке на лицо (для InspectorGadjetDense)
+    all_faces_csv_file_path = f"{root}data/face-detection-dataset/labels_and_coordinates_all.csv"
+
+    # Открываем CSV файлы для записи
+    with open(csv_file_path, mode='w', newline='') as csv_file, \
+         open(all_faces_csv_file_path, mode='w', newline='') as all_faces_csv_file:
         fieldnames = ['name', 'x1', 'y1', 'x2', 'y2']
         writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+        all_faces_writer = csv.DictWriter(all_faces_csv_file, fieldnames=fieldnames)
 
-        # Записываем заголовки CSV файла
+        # Записываем заголовки CSV файлов
         writer.writeheader()
+        all_faces_writer.writeheader()
 
         # Проходим по каждому файлу .txt в папке labels2
         for filename in os.listdir(labels2_dir):
@@ -221,6 +214,13 @@ def preprocessing_of_face_detection_dataset():
                 with open(file_path, 'r') as txt_file:
                     lines = txt_file.readlines()
 
+                    # Все лица изображения
+                    for line in lines:
+                        parts = line.split()
+                        if len(parts) == 6 and parts[0] == "Human" and parts[1] == "face":
+                            x1, y1, x2, y2 = map(float, parts[2:])
+                            all_faces_writer.writerow({'name': filename[:-4], 'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2})
+
                     # Проверяем количество строк в файле
                     if len(lines) <= 1:
                         # Получаем имя файла без расширения
@@ -234,7 +234,7 @@ def preprocessing_of_face_detection_dataset():
                             # Записываем данные в CSV файл
                             writer.writerow({'name': name, 'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2})
 
-    print(f"Данные записаны в {csv_file_path}")
+    print(f"Данные записаны в {csv_file_path} и {all_faces_csv_file_path}")
 
 
 # функция для проверки и дозагрузки датасетов на локальную машину
@@ -371,300 +371,6 @@ def save_img_after_epoch(path_to_img, mdl, epoch, device):
 
 
 
-# функция изменения размеров bbox под размер изображения с камеры 
-def rescale_coordinates(bbox, size):
-    # Извлекаем координаты из тензора
-    height, width = size[:2]
-    # height, width = height *1.25, width *1.7
-    x1, y1, x2, y2 = bbox
-    
-    # Масштабирование координат
-    x1 = int((x1 / config['img_size']) * width)
-    y1 = int((y1 / config['img_size']) * height)
-    x2 = int((x2 / config['img_size']) * width)
-    y2 = int((y2 / config['img_size']) * height)
-    
-
-    return [x1, y1, x2, y2]
-
-
-def cam_capture(source=0, model=None, bbox_func=None, limit=inf):
-
-    """""
-
-
-    source - источник видео, если 0,то это камера ноутбука
-    model - модель, выдающая координаты
-    bbox_func - функция, котороая строит изображение с bounding box'ом на основе предиктов модели
-    limit - количество милисекунд, в течение которых работает камера
-
-    """""
-
-    cap = cv2.VideoCapture(source)
-    i = 0 
-
-    while i<=limit:
-
-        ret, frame = cap.read()
-
-        if not ret:
-            print("Failed to grab frame")
-            break
-
-        
-        # Преобразуем изображение из BGR в RGB
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-        # Изменяем размер изображения до 126x126
-        resized_frame = cv2.resize(rgb_frame, (128, 128))
-        
-        pic_tens = transform(resized_frame)
-
-    
-        with torch.no_grad():
-
-            res = model(pic_tens.unsqueeze(0))
-        
-        
-        bbox = res[0][1:].tolist()
-        print(bbox)
-        # bbox = res[0].tolist()[1:]
-
-        coord = rescale_coordinates(bbox, frame.shape)
-        print(coord)
-        cv2.rectangle(frame, (coord[0], coord[1]), ( coord[2], coord[3]), (0, 0, 255), 2)
-        
-  
-        cv2.imshow("Camera Feed with BBox", frame)
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
-        i += 1
-       
-
-    cap.release()
-    cv2.destroyAllWindows()
-
-
-def crop(pic, coords, scale=2, size=256):
-    
-    '''
-    Обрезает изображение вокруг заданных координат и берет площадь не только по рамкам, а вокруг или внутри. 
-
-    Параметры:
-    pic (tensor): Входное изображение.
-    coords (list): Список координат [x_min, y_min, x_max, y_max] рамки.
-    scale (float): Фактор скалирования рамки (во сколько раз обрезанное изображение больше рамки). По умолчанию 2.
-    size (int): Размер выходного изображения. По умолчанию 256.
-
-    Возвращает:
-    tensor: Обрезанное и измененное по размеру изображение.
-    '''
-    
-    pic_width = pic.shape[2]
-    pic_height = pic.shape[1]
-        
-    
-    center = (0.5*(coords[2]+coords[0]), 
-              0.5*(coords[3]+coords[1]))
-    
-    width = scale*(coords[2]-coords[0])
-    height = scale*(coords[3]-coords[1])
-    
-    side = min(max(width, height), min(pic_width, pic_height))
-    
-    bot_right = [min(center[0]+side/2, pic_width), 
-                 min(center[1]+side/2, pic_height)]
-    
-    x0 = max(0, bot_right[0] - side)
-    y0 = max(0, bot_right[1] - side)
-    
-    res = tf.functional.resized_crop(pic, 
-                                     int(y0), 
-                                     int(x0), 
-                                     int(min(side, pic_height)), 
-                                     int(min(side, pic_width)), 
-                                     size=size,
-                                     antialias=True)
-    
-    return res
-
-
-def recognition_cam(source=0, 
-                model=None,
-                embedding_model=None, 
-                database_path = None,
-                limit=inf):
-
-    """""
-    source - источник видео, если 0,то это камера ноутбука
-    model - модель, выдающая координаты
-    embedding_model - модель для эмбеддингов
-    database_path = путь к базе данных в формате csv
-    limit - количество милисекунд, в течение которых работает камера
-
-    """""
-
-    cap = cv2.VideoCapture(source)
-    database = pd.read_csv(database_path, index_col=0)
-    i = 0 
-
-    prev = 0
-
-    while i<=limit:
-
-        ret, frame = cap.read()
-
-        if not ret:
-            print("Failed to grab frame")
-            break
-
-        
-        # Преобразуем изображение из BGR в RGB
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-        # Изменяем размер изображения до 128x128
-        resized_frame = cv2.resize(rgb_frame, (128, 128))
-        
-
-
-        # pic_tens = tf.ToTensor()(resized_frame)
-        pic_tens = transform(resized_frame)
-
-        with torch.no_grad():
-            res = model(pic_tens.unsqueeze(0))
-        
-        # print('res - ', res)
-        if res[0][0] > 0.9:
-            
-
-            bbox = res[0][1:] #*0.5+prev*0.5
-        
-            coord = rescale_coordinates(bbox, frame.shape)
-        
-
-        
-        
-            cropped = crop(tf.ToTensor()(rgb_frame), coord, size=160, scale=1.5).unsqueeze(0)
-        
-        
-            base = torch.from_numpy(database.values)
-        
-
-
-            embedding = embedding_model(cropped)
-       
-            distances = (base-embedding).pow(2).sum(axis=1)
-
-            
-            if torch.min(distances) > 1.2:
-                name = 'unknown'
-            else: 
-                person_id = torch.argmin(distances).item()
-                name = database.index[person_id]
-       
-      
-            cv2.rectangle(frame, (coord[0], coord[1]), (coord[2], coord[3]), (0, 0, 255), 2)
-            cv2.putText(frame , f'{name}', (coord[0], coord[1]), cv2.FONT_HERSHEY_SIMPLEX, fontScale=1, thickness = 2, color = (0, 0, 255))
-
-        
-
-        cv2.imshow("Camera Feed with BBox", frame)
-
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
-        i += 1
-    
-    cap.release()
-    cv2.destroyAllWindows()
-
-
-def add2db(folder_path, owner, rec_model):
-
-    """
-    Add images from the specified folder to a database.
-
-    Parameters:
-    - folder_path (str): Path to the folder containing the photos.
-    - owner (str): Name of the person in the photos.
-    - model: The model providing coordinates.
-    - rec_model: The model for embeddings.
-
-    Returns:
-    - cropped_imgs (list): List of PIL images after cropping.
-    """
-    
-    pic_list = os.listdir(folder_path)
-    if os.path.exists("Database.csv"):
-        database = pd.read_csv("Database.csv")
-    else:
-        database = pd.DataFrame(columns=["name"] + [f"emb{i}" for i in range(512)])
-
-    cropped_imgs = []
-    count_image = 0
-    database_have_such_name = owner in database.name.values
-
-    for pic in pic_list:
-        if pic != ".DS_Store":
-            if not database_have_such_name:
-                image = cv2.imread(f'{folder_path}/{pic}')
-                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-
-                image_for_detection = cv2.resize(image, (128, 128))
-                image_for_detection = transform(image_for_detection)
-
-                image_for_recognition = cv2.resize(image, (160, 160))
-                image_to_crop = tf.ToTensor()(image_for_recognition)
-                
-                with torch.no_grad():
-                    
-                    cropped_image = image_to_crop
-                    if count_image==0:
-                        embedding = rec_model(cropped_image.unsqueeze(0)).detach().numpy()
-                    else:
-                        embedding += rec_model(cropped_image.unsqueeze(0)).detach().numpy()
-
-                cropped_imgs.append(tf.ToPILImage()(cropped_image))
-                count_image += 1
-            else:
-                print("Name exists, enter new name or delete old")
-                break
-
-    if  not database_have_such_name:
-
-        embedding = embedding/count_image
-
-        database.loc[database.shape[0]] = [owner] + np.array(embedding/count_image)[0].tolist()
-        database.to_csv(f'Database.csv', index=False)
-
-    return cropped_imgs
-
-
-
-def drop_from_database(value_to_drop):
-    """
-    Удаляет строки из базы данных, сохраненной в файле 'Database.csv', где значение в столбце 'name' равно указанному значению.
-
-    Параметры:
-    - value_to_drop (str): Значение в столбце 'name', строки с которым следует удалить из базы данных.
-
-    Пример использования:
-    drop_from_database('John Doe')
-
-    Примечание:
-    Если файл 'Database.csv' не существует, будет выведено сообщение "Database doesn't exists".
-    """
-    import os
-    import pandas as pd
-
-    if os.path.exists("Database.csv"):
-        database = pd.read_csv("Database.csv")
-        database = database.loc[database['name'] != value_to_drop]
-        database.to_csv(f'Database.csv', index=False)
-    else:
-        print("Database doesn't exist")
-
-
-
 def plot_images_with_bboxes(batch):
     """
     :param images: Tensor of shape (batch_size, channels, height, width)
@@ -749,6 +455,72 @@ class TripletLoss(nn.Module):
         return result.mean() if self.average else result.sum()
 
 
+class BatchTripletLoss(nn.Module):
+
+    '''
+    Triplet loss с выбором триплетов внутри батча (online mining): матрица квадратов расстояний между всеми
+    эмбеддингами батча считается один раз, и из нее берутся все B^2 пар вместо B фиксированных триплетов.
+    Батч должен содержать несколько изображений каждой личности (см. PKSampler в src/dataloaders.py).
+
+    margin - величина расстояния между позитивными и негативными образцами, как в TripletLoss
+    mining - способ выбора триплетов:
+        'batch_all' - все триплеты батча, среднее по тем, у которых лосс больше 0
+        'batch_hard' - для каждого анкера самый дальний позитив и самый близкий негатив
+        'semi_hard' - для каждой позитивной пары самый близкий негатив, который дальше позитива
+                      (если такого нет, то самый дальний негатив)
+    average - bool, способ агрегации функции потерь, если True, то среднее, если False, то сумма
+    '''
+
+    def __init__(self, margin=2, mining='semi_hard', average=True):
+        super().__init__()
+
+        if mining not in ('batch_all', 'batch_hard', 'semi_hard'):
+            raise ValueError(f"mining must be 'batch_all', 'batch_hard' or 'semi_hard', got {mining!r}")
+
+        self.margin = margin
+        self.mining = mining
+        self.average = average
+
+    def forward(self, embeddings, labels):
+        embeddings = embeddings.flatten(1)
+        labels = labels.to(embeddings.device)
+
+        # квадраты расстояний ||a||^2 + ||b||^2 - 2ab одним матричным умножением (B, B)
+        squared_norms = (embeddings ** 2).sum(dim=1)
+        dist = (squared_norms[:, None] + squared_norms[None, :] - 2 * embeddings @ embeddings.T).clamp(min=0)
+
+        same = labels[:, None] == labels[None, :]
+        eye = torch.eye(len(labels), dtype=torch.bool, device=embeddings.device)
+        positive_mask, negative_mask = same & ~eye, ~same
+
+        if self.mining == 'batch_hard':
+            hardest_positive = dist.masked_fill(~positive_mask, 0).max(dim=1).values
+            hardest_negative = dist.masked_fill(~negative_mask, inf).min(dim=1).values
+            valid = positive_mask.any(dim=1) & negative_mask.any(dim=1)
+            result = F.relu(hardest_positive - hardest_negative + self.margin)[valid]
+
+        elif self.mining == 'batch_all':
+            # (anchor, pos, neg) -> d(a, p) - d(a, n) + margin
+            triplets = dist[:, :, None] - dist[:, None, :] + self.margin
+            valid = positive_mask[:, :, None] & negative_mask[:, None, :]
+            result = F.relu(triplets[valid])
+            result = result[result > 0] if (result > 0).any() else result
+
+        else:
+            positive_dist = dist[:, :, None]  # (a, p, 1)
+            negative_dist = dist[:, None, :].expand(-1, len(labels), -1)  # (a, p, n)
+            semi_hard = negative_mask[:, None, :] & (negative_dist > positive_dist)
+            closest_semi_hard = negative_dist.masked_fill(~semi_hard, inf).min(dim=2).values
+            farthest_negative = dist.masked_fill(~negative_mask, -inf).max(dim=1).values[:, None]
+            negative = torch.where(semi_hard.any(dim=2), closest_semi_hard, farthest_negative)
+            valid = positive_mask & negative_mask.any(dim=1, keepdim=True)
+            result = F.relu(dist - negative + self.margin)[valid]
+
+        if len(result) == 0:
+            return embeddings.sum() * 0
+        return result.mean() if self.average else result.sum()
+
+
 def validate_model(model, test_dataloader, loss_fn, device):
     model.eval()  # Переключение модели в режим оценки
     total_loss = 0.0